@@ -0,0 +1,163 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import *
+from datetime import datetime
+
+from loguru import logger
+
+from scheduler import Scheduler
+from control import (
+    interval_scheduler, buffered_checkpoints, record_reading, filter_reading, dispatch_events, run_interval_instrument
+)
+from devices.database import DatabaseHandler
+from devices.i2c_bus import I2CBusPool
+from devices.reading_cache import ReadingCache
+from devices.retention import RetentionManager
+from devices.metrics import metrics
+from rules import RuleEngine
+from events import EventBus
+
+"""
+asyncio runtime for the greenhouse.
+
+An alternative to the polling loop in main.py (`--async`). Every sensor
+scheduler and every iterative instrument scheduler is its own task, so a slow
+sensor read does not hold up the rest of the tree. Blocking sensor reads run on
+the I2C bus workers and each reading is published to the event bus as soon as
+it lands; the subscribed instruments react on the next pass of the event loop.
+"""
+
+
+class AsyncRuntime:
+    """Runs the sensor and instrument trees as asyncio tasks.
+
+    - One task per sensor scheduler: sleeps until `next_fire_time()`, reads the
+      sensor on its bus worker, records the reading and publishes it to `event_bus`.
+      The first publish in a pass of the event loop schedules a dispatch, so
+      readings that land together update each subscribed instrument once, with the
+      freshest values.
+    - One task per iterative (`run_alone`) instrument scheduler.
+    - One housekeeping task: database heartbeat and retention every `max_sleep_sec`.
+
+    Reads go through `bus_pool`: sensors on the same I2C bus are read one at a
+    time, while other buses and cameras are read in parallel.
+
+    Args:
+        sensor_tree (Dict): Sensor tree from `initialize_from_config`.
+        instrument_tree (Dict): Instrument tree from `initialize_from_config`.
+        db_handler (DatabaseHandler): Database the readings and state changes are written to.
+        bus_pool (I2CBusPool): Bus workers that run the sensor reads.
+        engine (RuleEngine): Rules of the sensor-driven instruments.
+        event_bus (EventBus, optional): Bus the readings are published to. Defaults to one built
+            from `engine` (`EventBus.from_engine`).
+        schedulers (Dict[str, Scheduler], optional): Schedulers to checkpoint after every change
+            (from `scheduler_registry`). Defaults to None (no checkpoints).
+        reading_cache (ReadingCache, optional): Cache the sensor reads go through, so the readings
+            are available to other readers. Defaults to one over `bus_pool` with its default max age.
+        retention (RetentionManager, optional): Retention to step from the housekeeping task. Defaults to None.
+        max_sleep_sec (float, optional): Seconds between housekeeping runs. Defaults to 10.
+
+    Example:
+        >>> engine = RuleEngine.from_trees(sensor_tree, instrument_tree)
+        >>> runtime = AsyncRuntime(sensor_tree, instrument_tree, db_handler, I2CBusPool(), engine)
+        >>> runtime.run()  # blocks until interrupted
+    """
+
+    def __init__(
+        self,
+        sensor_tree: Dict[str, SimpleNamespace],
+        instrument_tree: Dict[str, SimpleNamespace],
+        db_handler: DatabaseHandler,
+        bus_pool: I2CBusPool,
+        engine: RuleEngine,
+        event_bus: Optional[EventBus] = None,
+        schedulers: Optional[Dict[str, Scheduler]] = None,
+        reading_cache: Optional[ReadingCache] = None,
+        retention: Optional[RetentionManager] = None,
+        max_sleep_sec: float = 10.0,
+    ):
+        self.sensor_tree = sensor_tree
+        self.instrument_tree = instrument_tree
+        self.db_handler = db_handler
+        self.bus_pool = bus_pool
+        self.engine = engine
+        self.event_bus = event_bus if event_bus is not None else EventBus.from_engine(engine, sensor_tree)
+        self.schedulers = schedulers
+        self._buffered = buffered_checkpoints(sensor_tree)
+        self.reading_cache = reading_cache if reading_cache is not None else ReadingCache(sensor_tree, bus_pool)
+        self.retention = retention
+        self.max_sleep_sec = max_sleep_sec
+        self._dispatch_pending = False
+
+    def _checkpoint(self) -> None:
+        if self.schedulers is not None:
+            self.db_handler.checkpoint_schedulers(self.schedulers, buffered=self._buffered)
+
+    async def _sleep_until(self, deadline: float) -> None:
+        delay = deadline - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _publish(self, device_name: str, sensor_dict: Dict, sensor_timestamp: datetime) -> None:
+        self.event_bus.publish(device_name, sensor_dict, sensor_timestamp)
+        # Readings published before the dispatch runs are coalesced into it:
+        if not self._dispatch_pending:
+            self._dispatch_pending = True
+            asyncio.get_running_loop().call_soon(self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._dispatch_pending = False
+        with metrics.timer("loop.dispatch"):
+            dispatch_events(self.event_bus, self.instrument_tree, self.engine, self.db_handler)
+            self._checkpoint()
+
+    async def _sensor_task(self, key: str, device_name: str, device: SimpleNamespace, scheduler: Scheduler) -> None:
+        while True:
+            await self._sleep_until(scheduler.next_fire_time())
+            metrics.observe("lateness.{}".format(key), time.time() - scheduler.next_fire_time())
+            if not scheduler.can_schedule():
+                continue
+
+            self._checkpoint()
+            sensor_timestamp, sensor_dict = await asyncio.wrap_future(self.reading_cache.submit(device, device_name))
+            record_reading(device_name, device, sensor_dict, sensor_timestamp, self.db_handler)
+
+            if device.type != "camera":
+                self._publish(device_name, filter_reading(device, sensor_dict), sensor_timestamp)
+
+    async def _interval_task(self, instrument_name: str, instrument: SimpleNamespace, scheduler: Scheduler) -> None:
+        while True:
+            await self._sleep_until(scheduler.next_fire_time())
+            metrics.observe("lateness.instrument/{}".format(instrument_name), time.time() - scheduler.next_fire_time())
+            if scheduler.can_schedule():
+                run_interval_instrument(instrument_name, instrument, scheduler, self.db_handler)
+                self._checkpoint()
+
+    async def _housekeeping_task(self) -> None:
+        while True:
+            self.db_handler.heartbeat()
+            # Spend a few milliseconds on expiring old rows:
+            if self.retention is not None:
+                self.retention.step()
+            metrics.report_if_due()
+            await asyncio.sleep(self.max_sleep_sec)
+
+    async def main(self) -> None:
+        """Create every task and run them until one fails or the runtime is cancelled."""
+        tasks = [self._housekeeping_task()]
+        for device_name, device in self.sensor_tree.items():
+            for idx, scheduler in enumerate(device.scheduler):
+                key = "sensor/{}/{}".format(device_name, idx)
+                tasks.append(self._sensor_task(key, device_name, device, scheduler))
+
+        for instrument_name, instrument in self.instrument_tree.items():
+            if instrument.run_alone:
+                tasks.append(self._interval_task(instrument_name, instrument, interval_scheduler(instrument)))
+
+        logger.info("Starting asyncio runtime with {} tasks".format(len(tasks)))
+        await asyncio.gather(*tasks)
+
+    def run(self) -> None:
+        """Run the runtime on a new event loop (blocks)."""
+        asyncio.run(self.main())
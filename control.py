@@ -0,0 +1,218 @@
+import json
+from types import SimpleNamespace
+from typing import *
+from datetime import datetime
+
+from loguru import logger
+
+from scheduler import Scheduler, DeviceScheduler, TimerHeap
+from rules import RuleEngine
+from events import EventBus
+from devices.database import DatabaseHandler, LogRecord, ImageRecord, ReadingRecord
+from devices.i2c_bus import I2CBusPool
+from devices.reading_cache import ReadingCache
+from devices.metrics import metrics
+
+"""
+Building blocks of the greenhouse control loop.
+
+Both the polling loop in main.py and the asyncio runtime (async_runtime.py) are
+put together from these: read a sensor, record the reading, let the connected
+instruments react to it, and run the instruments that only work on a timer.
+"""
+
+
+def interval_scheduler(instrument: SimpleNamespace) -> DeviceScheduler:
+    """Return the iterative (timer-only) scheduler of a `run_alone` instrument."""
+    # TODO: This is a workaround; break scheduler list into Namespace objects
+    if len(instrument.scheduler) > 1:
+        return instrument.scheduler[1]
+    return instrument.scheduler[0]
+
+
+def scheduler_registry(sensor_tree: Dict, instrument_tree: Dict) -> Dict[str, Scheduler]:
+    """Every scheduler in the trees under a stable name (ex: `"instrument/fan_1/1"`), for checkpointing."""
+    schedulers = {}
+    for kind, tree in [("sensor", sensor_tree), ("instrument", instrument_tree)]:
+        for name, entry in tree.items():
+            for idx, scheduler in enumerate(entry.scheduler):
+                schedulers["{}/{}/{}".format(kind, name, idx)] = scheduler
+    return schedulers
+
+
+def buffered_checkpoints(sensor_tree: Dict) -> Set[str]:
+    """Names (as in `scheduler_registry`) of the schedulers whose checkpoint may wait in the write buffer.
+
+    Losing one of these only repeats a sensor read. Instrument and camera
+    schedulers are left out: their state keeps a device from firing twice.
+    """
+    return {
+        "sensor/{}/{}".format(name, idx)
+        for name, entry in sensor_tree.items()
+        if entry.type != "camera"
+        for idx in range(len(entry.scheduler))
+    }
+
+
+def build_timers(sensor_tree: Dict, instrument_tree: Dict, max_sleep_sec: float = 10.0) -> TimerHeap:
+    """Queue every sensor scheduler and every iterative instrument scheduler on a TimerHeap.
+
+    Keys are `("sensor", device_name, index)` and `("instrument", instrument_name)`.
+    Instruments that only react to sensor readings are not queued; they run when
+    a reading for them arrives.
+    """
+    timers = TimerHeap(max_sleep_sec=max_sleep_sec)
+    for device_name, device in sensor_tree.items():
+        for idx, scheduler in enumerate(device.scheduler):
+            timers.push(("sensor", device_name, idx), scheduler)
+    for instrument_name, instrument in instrument_tree.items():
+        if instrument.run_alone:
+            timers.push(("instrument", instrument_name), interval_scheduler(instrument))
+    return timers
+
+
+def record_reading(
+    device_name: str, device: SimpleNamespace, sensor_dict: Dict, sensor_timestamp: datetime, db_handler: DatabaseHandler
+) -> None:
+    """Write a sensor reading (or captured image) to the database."""
+    logger.info(f"Captured sensor data from {device_name} | group: {device.type}")
+    # log sensor data:
+    if device.type != "camera":
+        record = ReadingRecord(
+            name=device_name,
+            values=sensor_dict,
+            timestamp=sensor_timestamp.timestamp(),
+        )
+        db_handler.log_reading(record)
+    else:
+        image_record = ImageRecord(
+            name=sensor_dict["name"], path=sensor_dict["save_path"]
+        )
+        db_handler.record_image(image_record)
+
+
+def filter_reading(device: SimpleNamespace, sensor_dict: Dict) -> Dict:
+    """The reading instruments act on: `sensor_dict` cleaned by the sensor's `filter`, if it has one.
+
+    The raw reading is what gets recorded; the filter keeps the latest raw and
+    filtered readings (`device.filter.raw`, `device.filter.filtered`).
+    """
+    signal_filter = getattr(device, "filter", None)
+    return sensor_dict if signal_filter is None else signal_filter(sensor_dict)
+
+
+def poll_sensors(
+    devices: List[Tuple[str, SimpleNamespace]],
+    bus_pool: I2CBusPool,
+    db_handler: DatabaseHandler,
+    event_bus: EventBus,
+    reading_cache: Optional[ReadingCache] = None,
+) -> Dict[str, Dict]:
+    """Read the given sensors, log the readings and publish them for the subscribed instruments.
+
+    The reads run on the bus workers of `bus_pool`, so sensors on different buses
+    (and cameras) are read in parallel. The raw readings are recorded and the
+    filtered ones (`filter_reading`) are published. With a `reading_cache`, the readings also
+    refresh the cache, and a sensor some other reader is already refreshing is
+    not read twice.
+    """
+    readings = bus_pool.sweep(devices, submit=None if reading_cache is None else reading_cache.submit)
+    for device_name, device in devices:
+        sensor_timestamp, sensor_dict = readings[device_name]
+        record_reading(device_name, device, sensor_dict, sensor_timestamp, db_handler)
+
+        if device.type != "camera":
+            logger.debug("Publishing {}".format(device_name))
+            event_bus.publish(device_name, filter_reading(device, sensor_dict), sensor_timestamp)
+    return {device_name: reading for device_name, (_, reading) in readings.items()}
+
+
+def apply_rules(
+    engine: RuleEngine,
+    sources: Dict[str, Tuple[str, datetime]],
+    instrument_tree: Dict,
+    db_handler: DatabaseHandler,
+) -> None:
+    """Evaluate every rule once and update the instruments that received a reading.
+
+    Args:
+        engine (RuleEngine): Rule engine holding the latest readings.
+        sources (Dict[str, Tuple[str, datetime]]): Instrument name -> (sensor name, reading timestamp)
+            of the reading that triggered the update.
+        instrument_tree (Dict): Instrument tree from `initialize_from_config`.
+        db_handler (DatabaseHandler): Database the state changes are written to.
+    """
+    conditions = engine.evaluate()
+    for instrument_name, (dname, dtimestamp) in sources.items():
+        instrument = instrument_tree[instrument_name]
+        # TODO: This is a workaround; break scheduler list into Namespace objects
+        scheduler: DeviceScheduler = instrument.scheduler[0]  # Get just the sensor-based scheduler
+
+        # Outside its time window the instrument stays off until the window opens:
+        if scheduler.parked:
+            continue
+
+        # Can the instrument be changed?
+        if scheduler.can_schedule():
+            # What is the new state that the instrument should be in?
+            new_state = scheduler.decide(conditions[engine.index[instrument_name]])
+            scheduler.update_budget(
+                new_state, dtimestamp
+            )  # Update the internal scheduling budget (ex: light budget)
+            with metrics.timer("trigger.{}".format(instrument_name)):
+                instrument.device.trigger(state=new_state)
+
+            record = LogRecord(
+                name=dname,
+                level="INFO",
+                message="{} instrument state change".format(dname),
+                metadata=json.dumps(
+                    {"connection": instrument_name, "state": new_state}
+                ),
+            )
+            db_handler.log(record)
+
+
+def dispatch_events(event_bus: EventBus, instrument_tree: Dict, engine: RuleEngine, db_handler: DatabaseHandler) -> None:
+    """Feed the latest reading of every topic to the rule engine, then update each subscribed instrument once.
+
+    An instrument subscribed to several topics is credited to the freshest reading.
+    """
+    sources: Dict[str, Tuple[str, datetime]] = {}
+    for dname, (dsensor, dtimestamp) in event_bus.drain().items():
+        engine.update(dname, dsensor)
+        for instrument_name in event_bus.subscribers(dname, dsensor):
+            if not (instrument_name in sources) or sources[instrument_name][1] < dtimestamp:
+                sources[instrument_name] = (dname, dtimestamp)
+
+    if sources:
+        apply_rules(engine, sources, instrument_tree, db_handler)
+
+
+def run_interval_instrument(
+    instrument_name: str, instrument: SimpleNamespace, scheduler: DeviceScheduler, db_handler: DatabaseHandler
+) -> None:
+    """Trigger an instrument from its iterative scheduler (no sensor attached)."""
+    # What is the new state that the instrument should be in?
+    new_state = scheduler.change(0)
+    scheduler.update_budget(
+        new_state, datetime.fromtimestamp(scheduler.clock())
+    )  # Update the internal scheduling budget (ex: light budget)
+
+    with metrics.timer("trigger.{}".format(instrument_name)):
+        if instrument_name in ["fan_1", "fan_2"]:
+            instrument.device.trigger(state=None)
+        else:
+            instrument.device.trigger(state=new_state)
+
+    record = LogRecord(
+        name=instrument_name,
+        level="INFO",
+        message="{} interval instrument state change".format(
+            instrument_name
+        ),
+        metadata=json.dumps(
+            {"connection": None, "state": new_state}
+        ),
+    )
+    db_handler.log(record)
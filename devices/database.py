@@ -1,10 +1,19 @@
 import sqlite3
 from typing import *
 import os
+import json
+import time
+from collections import deque
+import threading
+from threading import Condition, Lock, Thread, get_ident
+from datetime import datetime, timezone
+import numpy as np
 from loguru import logger
 from dataclasses import dataclass, field
 from pathlib import Path
 
+from devices.metrics import metrics
+
 @dataclass
 class LogRecord:
     name: str = field()
@@ -12,6 +21,12 @@ class LogRecord:
     message: Optional[str] = field(default="")
     metadata: Optional[str] = field(default="")
 
+@dataclass
+class ReadingRecord:
+    name: str = field()
+    values: Dict[str, Any] = field(default_factory=dict)
+    timestamp: Optional[float] = field(default=None)  # Unix epoch seconds; defaults to write time
+
 @dataclass
 class ImageRecord:
     name: str = field()
@@ -19,25 +34,154 @@ class ImageRecord:
     active: bool = field(default=True)
 
 class SQLiteAPI:
-    """A simple SQLite database interface using only native Python modules."""
+    """A simple SQLite database interface using only native Python modules.
+
+    Every thread gets its own connection from a small pool, and a forked child
+    process never reuses its parent's connections, so one `SQLiteAPI` object can
+    be shared between the main loop, the database writer thread and the file
+    manager process. Writer connections put the database in WAL mode so readers
+    and a writer do not block each other, and every connection waits up to
+    `busy_timeout_ms` for a lock instead of failing with `database is locked`.
+
+    Args:
+        db_path (str, optional): Path to the SQLite database file. Defaults to "database.db".
+        read_only (bool, optional): Open connections read-only (the database must already exist). Defaults to False.
+        journal_mode (str, optional): SQLite journal mode set by writer connections. Defaults to "WAL".
+        busy_timeout_ms (int, optional): How long to wait on a locked database. Defaults to 5000.
+        auto_vacuum (str, optional): `PRAGMA auto_vacuum` value for writer connections. It only takes effect
+            on a database without tables (or after a VACUUM). Defaults to None (leave unchanged).
+        pool_size (int, optional): Connections kept before those of finished threads are closed. Defaults to 4.
+    """
 
-    def __init__(self, db_path: str = "database.db"):
+    def __init__(
+        self,
+        db_path: str = "database.db",
+        read_only: bool = False,
+        journal_mode: str = "WAL",
+        busy_timeout_ms: int = 5000,
+        auto_vacuum: Optional[str] = None,
+        pool_size: int = 4,
+    ):
         """Initialize the connection to the SQLite database."""
         self.db_path = db_path
-        self.connection = sqlite3.connect(self.db_path)
-        self.connection.row_factory = sqlite3.Row  # Access rows as dictionaries
-        self.cursor = self.connection.cursor()
+        self.auto_vacuum = auto_vacuum
+        self.read_only = read_only
+        self.journal_mode = journal_mode
+        self.busy_timeout_ms = busy_timeout_ms
+        self.pool_size = pool_size
+        self._pool_lock = Lock()
+        self._pool_pid = os.getpid()
+        self._pool: Dict[int, Tuple[sqlite3.Connection, sqlite3.Cursor]] = {}  # thread ident -> connection
+        self.rows_written = 0  # rows inserted, updated or deleted through this object (any thread)
+        self._count_lock = Lock()
+        _ = self.connection  # connect eagerly so a bad path fails here
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            uri = "file:{}?mode=ro".format(Path(self.db_path).resolve().as_posix())
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            # check_same_thread is off only so close() can close other threads' connections
+            connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        connection.row_factory = sqlite3.Row  # Access rows as dictionaries
+        connection.execute("PRAGMA busy_timeout = {}".format(int(self.busy_timeout_ms)))
+        if not self.read_only:
+            if self.auto_vacuum is not None:
+                # Has to come before the journal mode switch, which initializes the file:
+                connection.execute("PRAGMA auto_vacuum = {}".format(self.auto_vacuum))
+            connection.execute("PRAGMA journal_mode = {}".format(self.journal_mode))
+            if self.journal_mode.upper() == "WAL":
+                connection.execute("PRAGMA synchronous = NORMAL")  # durable in WAL mode, far fewer fsyncs
+        return connection
+
+    def _pooled(self) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                # Forked child: the inherited connections belong to the parent and must not be touched.
+                self._pool = {}
+                self._pool_pid = os.getpid()
+
+            ident = get_ident()
+            pooled = self._pool.get(ident)
+            if pooled is None:
+                if len(self._pool) >= self.pool_size:
+                    self._prune()
+                connection = self._connect()
+                pooled = (connection, connection.cursor())
+                self._pool[ident] = pooled
+            return pooled
+
+    def _prune(self) -> None:
+        alive = set(thread.ident for thread in threading.enumerate())
+        for ident in [ident for ident in self._pool if not (ident in alive)]:
+            self._pool.pop(ident)[0].close()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection."""
+        return self._pooled()[0]
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """The calling thread's cursor."""
+        return self._pooled()[1]
+
+    def _count(self, rowcount: int) -> None:
+        if rowcount > 0:  # -1 for statements that modify no rows (ex: CREATE TABLE)
+            with self._count_lock:
+                self.rows_written += rowcount
 
     def execute(self, query: str, params: Tuple[Any, ...] = ()) -> None:
         """Execute a query (INSERT, UPDATE, DELETE, etc.)."""
         self.cursor.execute(query, params)
         self.connection.commit()
+        self._count(self.cursor.rowcount)
+
+    def executemany(self, query: str, params_seq: Iterable[Tuple[Any, ...]]) -> int:
+        """Execute the same query for every parameter tuple in a single transaction.
+
+        Returns:
+            int: Total number of rows modified.
+        """
+        self.cursor.executemany(query, params_seq)
+        self.connection.commit()
+        self._count(self.cursor.rowcount)
+        return self.cursor.rowcount
+
+    def execute_batch(self, statements: List[Tuple[str, List[Tuple[Any, ...]]]]) -> None:
+        """Execute several (query, params_seq) pairs inside one transaction.
+
+        Either every statement is committed or, on error, none of them are.
+        """
+        rowcount = 0
+        try:
+            for query, params_seq in statements:
+                self.cursor.executemany(query, params_seq)
+                rowcount += max(self.cursor.rowcount, 0)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        self._count(rowcount)
 
     def fetch_all(self, query: str, params: Tuple[Any, ...] = ()) -> List[sqlite3.Row]:
         """Execute a SELECT query and return all rows."""
         self.cursor.execute(query, params)
         return self.cursor.fetchall()
 
+    def fetch_array(self, query: str, params: Tuple[Any, ...], dtype: np.dtype) -> np.ndarray:
+        """Execute a SELECT query and stream the rows into a NumPy structured array.
+
+        The selected columns must line up with the fields of `dtype`.
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = None  # plain tuples; np.fromiter consumes them directly
+        try:
+            cursor.execute(query, params)
+            return np.fromiter(cursor, dtype=dtype)
+        finally:
+            cursor.close()
+
     def fetch_one(
         self, query: str, params: Tuple[Any, ...] = ()
     ) -> Optional[sqlite3.Row]:
@@ -77,22 +221,437 @@ class SQLiteAPI:
         self.execute(query, params)
 
     def close(self) -> None:
-        """Close the database connection."""
-        self.connection.close()
+        """Close every pooled connection owned by this process."""
+        with self._pool_lock:
+            if self._pool_pid == os.getpid():
+                for connection, _ in self._pool.values():
+                    connection.close()
+            self._pool = {}
+
+
+def _utc_timestamp() -> str:
+    """Current UTC time in the same format SQLite uses for CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Rollup tables kept up to date as readings are written; bucket width in seconds.
+# Buckets are aligned to Unix epoch, so "day" rollups are UTC days.
+ROLLUP_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+_READING_INSERT = "INSERT INTO sensor_readings (device, key, timestamp, value) VALUES (?, ?, ?, ?)"
+
+_ROLLUP_UPSERTS = {
+    name: """
+        INSERT INTO sensor_rollup_{0} (device, key, bucket, min_value, max_value, sum_value, count)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (device, key, bucket) DO UPDATE SET
+            min_value = MIN(min_value, excluded.min_value),
+            max_value = MAX(max_value, excluded.max_value),
+            sum_value = sum_value + excluded.sum_value,
+            count = count + excluded.count
+    """.format(name)
+    for name in ROLLUP_RESOLUTIONS
+}
+
+_SCHEDULER_UPSERT = """
+    INSERT INTO scheduler_state (name, state, updated) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET state = excluded.state, updated = excluded.updated
+"""
+
+
+def _rollup_rows(readings: List[Tuple[str, str, float, float]], width: int) -> List[Tuple[Any, ...]]:
+    """Pre-aggregate (device, key, timestamp, value) rows into rollup upsert parameters."""
+    buckets: Dict[Tuple[str, str, float], List[float]] = {}
+    for device, key, timestamp, value in readings:
+        bucket = (device, key, timestamp - timestamp % width)
+        agg = buckets.get(bucket)
+        if agg is None:
+            buckets[bucket] = [value, value, value, 1]
+        else:
+            agg[0] = min(agg[0], value)
+            agg[1] = max(agg[1], value)
+            agg[2] += value
+            agg[3] += 1
+    return [bucket + tuple(agg) for bucket, agg in buckets.items()]
+
+
+def _to_epoch(value: Union[datetime, float]) -> float:
+    """Convert a datetime (or an epoch value) to Unix epoch seconds."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
 
 
 class DatabaseHandler:
-    def __init__(self, db_file_path: str):
+    """Writes greenhouse records (sensor logs, images, heartbeats) to SQLite.
+
+    By default every record is committed as soon as it is written. Setting
+    `batch_size` above 1 (or giving a `flush_interval_sec`) enables the batched
+    write mode: records are buffered in memory and written with `executemany`
+    inside a single transaction once `batch_size` records are pending or
+    `flush_interval_sec` seconds have passed since the last flush. Call
+    `flush()` or `close()` on shutdown so buffered records are not lost.
+
+    With `threaded=True`, records are instead placed on a bounded queue and the
+    caller returns immediately; a background writer thread drains the queue in
+    batches using the same `batch_size`/`flush_interval_sec` triggers. When the
+    queue is full, `overflow_policy` decides what happens:
+
+    - `"block"`: the caller waits until the writer frees up space.
+    - `"drop_oldest"`: the oldest queued record is discarded.
+    - `"coalesce"`: the new record replaces a queued record from the same source
+      (same device and message, or the previous heartbeat); if there is none,
+      the oldest queued record is discarded.
+
+    A batch the writer fails to write goes back to the head of the queue and is
+    retried after `retry_backoff_sec`, doubling after every failure. The overflow
+    policy still applies to the requeued records. After `write_retries` failed
+    retries the batch is dropped, and the number of lost records is logged.
+
+    `heartbeat_mode` picks how `heartbeat()` records liveness. `"events"` inserts a
+    row into `events` on every call. `"ledger"` keeps run-length uptime intervals
+    in the `uptime` table instead: one row per interval with its start and
+    last-seen time, updated in place. A new interval (a gap marker) is opened
+    when the application starts or when heartbeats stop for longer than
+    `heartbeat_gap_sec`. `last_seen` is written at most once every
+    `heartbeat_gap_sec`, so the ledger costs a handful of writes per hour.
+
+    Args:
+        db_file_path (str): Path to the SQLite database file.
+        batch_size (int, optional): Number of buffered records that triggers a flush. Defaults to 1 (no buffering).
+        flush_interval_sec (float, optional): Maximum age of the oldest buffered record before a flush. Defaults to None (no deadline).
+        threaded (bool, optional): Write from a background thread through a bounded queue. Defaults to False.
+        queue_size (int, optional): Capacity of the queue in threaded mode. Defaults to 1000.
+        overflow_policy (str, optional): One of `"block"`, `"drop_oldest"` or `"coalesce"`. Defaults to `"block"`.
+        write_retries (int, optional): Retries of a batch the writer thread failed to write. Defaults to 3.
+        retry_backoff_sec (float, optional): Wait before the first retry; doubles with every retry. Defaults to 0.5.
+        heartbeat_mode (str, optional): `"events"` or `"ledger"`. Defaults to `"events"`.
+        heartbeat_gap_sec (float, optional): Heartbeat silence that counts as a stall in ledger mode. Defaults to 30.
+        journal_mode (str, optional): SQLite journal mode; WAL lets the file manager process and readers work alongside the writer. Defaults to "WAL".
+        busy_timeout_ms (int, optional): How long a connection waits on a locked database. Defaults to 5000.
+
+    Example:
+        >>> db = DatabaseHandler("./logs/internal.db", batch_size=100, flush_interval_sec=30)
+        >>> db.heartbeat()
+        >>> db.close()
+    """
+
+    OVERFLOW_POLICIES = ["block", "drop_oldest", "coalesce"]
+    HEARTBEAT_MODES = ["events", "ledger"]
+
+    def __init__(
+        self,
+        db_file_path: str,
+        batch_size: int = 1,
+        flush_interval_sec: Optional[float] = None,
+        threaded: bool = False,
+        queue_size: int = 1000,
+        overflow_policy: Literal["block", "drop_oldest", "coalesce"] = "block",
+        write_retries: int = 3,
+        retry_backoff_sec: float = 0.5,
+        heartbeat_mode: Literal["events", "ledger"] = "events",
+        heartbeat_gap_sec: float = 30.0,
+        journal_mode: str = "WAL",
+        busy_timeout_ms: int = 5000,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1, got {}".format(batch_size))
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1, got {}".format(queue_size))
+        if not (overflow_policy in self.OVERFLOW_POLICIES):
+            raise ValueError(
+                "{} is not a valid overflow policy. Supported policies: {}".format(
+                    overflow_policy, ", ".join(self.OVERFLOW_POLICIES)
+                )
+            )
+        if not (heartbeat_mode in self.HEARTBEAT_MODES):
+            raise ValueError(
+                "{} is not a valid heartbeat mode. Supported modes: {}".format(
+                    heartbeat_mode, ", ".join(self.HEARTBEAT_MODES)
+                )
+            )
+
         db_dir = Path(db_file_path).parent
         os.makedirs(db_dir, exist_ok=True)
 
         db_exists = os.path.exists(db_file_path)
         self.db_file_path = db_file_path
-        self.connector = SQLiteAPI(db_file_path)
-        if not db_exists:
-            self.generate_schema()
+        # Incremental auto-vacuum lets retention shrink the file in small steps (new databases only):
+        self.connector = SQLiteAPI(
+            db_file_path, journal_mode=journal_mode, busy_timeout_ms=busy_timeout_ms, auto_vacuum="INCREMENTAL"
+        )
+        # Every statement is idempotent, so existing databases pick up new tables too:
+        self.generate_schema(announce=not db_exists)
+        # History queries go through read-only connections, which never block the writers in WAL mode:
+        self.reader = SQLiteAPI(db_file_path, read_only=True, busy_timeout_ms=busy_timeout_ms)
+        self._pid = os.getpid()
+
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self._pending: List[Tuple[str, Tuple[Any, ...]]] = []
+        self._last_flush = time.monotonic()
+
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.write_retries = write_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self._writer: Optional[Thread] = None
+        if self.threaded:
+            self._start_writer()
+
+        self.heartbeat_mode = heartbeat_mode
+        self.heartbeat_gap_sec = heartbeat_gap_sec
+        self._uptime_start: Optional[float] = None  # start of the current uptime interval
+        self._uptime_opened_by = "start"
+        self._uptime_last_seen = 0.0
+        self._uptime_last_written = 0.0
+        self._scheduler_states: Dict[str, str] = {}  # last checkpointed JSON per scheduler
+
+    def _start_writer(self) -> None:
+        # Queue entries are [key, query, params] lists so a coalesced record can
+        # be swapped in place without searching the deque.
+        self._queue: Deque[List[Any]] = deque()
+        self._queue_keys: Dict[Hashable, List[Any]] = {}
+        self._cond = Condition()
+        self._inflight = 0
+        self._stop = False
+        self._flush_requested = False
+        self._failures = 0  # consecutive failed writes of the batch at the head of the queue
+        self._retry_at = 0.0
+        self._counters = {"written": 0, "dropped": 0, "coalesced": 0, "errors": 0, "lost": 0, "max_queue_depth": 0}
+        self._writer = Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _check_fork(self) -> None:
+        # A forked child (ex: the file manager process) must not write the
+        # parent's buffered records, and threads do not survive a fork, so the
+        # child starts with an empty buffer and its own writer thread.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        if self.threaded:
+            self._start_writer()
+
+    @property
+    def batched(self) -> bool:
+        """Whether records are buffered before being written."""
+        return self.batch_size > 1 or self.flush_interval_sec is not None
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered records that have not been written yet."""
+        if self.threaded:
+            return len(self._queue) + self._inflight
+        return len(self._pending)
 
-    def generate_schema(self) -> None:
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Writer counters: current queue depth plus written/dropped/coalesced totals.
+
+        Returns:
+            Dict[str, int]: Empty when not running in threaded mode.
+        """
+        if not self.threaded:
+            return {}
+        with self._cond:
+            return {"queue_depth": len(self._queue), **self._counters}
+
+    def _write(self, query: str, params: Tuple[Any, ...], key: Optional[Hashable] = None) -> None:
+        # Time the call as the loop sees it: queueing, blocking on a full queue or a synchronous flush
+        with metrics.timer("db.write"):
+            self._check_fork()
+            if self.threaded:
+                self._enqueue(query, params, key)
+                return
+
+            if not self.batched:
+                self._write_records([(query, params)])
+                return
+
+            self._pending.append((query, params))
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    def _enqueue(self, query: str, params: Tuple[Any, ...], key: Optional[Hashable]) -> None:
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                if self.overflow_policy == "block":
+                    while len(self._queue) >= self.queue_size:
+                        self._cond.wait()
+                elif self.overflow_policy == "coalesce" and key in self._queue_keys:
+                    entry = self._queue_keys[key]
+                    entry[1], entry[2] = query, params
+                    self._counters["coalesced"] += 1
+                    return
+                else:
+                    self._forget_checkpoints([self._pop_entry()])
+                    self._counters["dropped"] += 1
+
+            entry = [key, query, params]
+            self._queue.append(entry)
+            if key is not None:
+                self._queue_keys[key] = entry
+            self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], len(self._queue))
+            self._cond.notify_all()
+
+    def _pop_entry(self) -> List[Any]:
+        entry = self._queue.popleft()
+        if entry[0] is not None and self._queue_keys.get(entry[0]) is entry:
+            del self._queue_keys[entry[0]]
+        return entry
+
+    def _forget_checkpoints(self, entries: List[List[Any]]) -> None:
+        # A scheduler state that never reached the database has to be sent again by the next checkpoint:
+        for _, query, params in entries:
+            if query == _SCHEDULER_UPSERT and self._scheduler_states.get(params[0]) == params[1]:
+                del self._scheduler_states[params[0]]
+
+    def _batch_ready(self) -> bool:
+        if not self._queue:
+            return False
+        if time.monotonic() < self._retry_at:
+            return False
+        if self._stop or self._flush_requested or len(self._queue) >= min(self.batch_size, self.queue_size):
+            return True
+        if self.flush_interval_sec is None:
+            return not self.batched
+        return time.monotonic() - self._last_flush >= self.flush_interval_sec
+
+    def _writer_loop(self) -> None:
+        # The connector hands this thread its own pooled connection:
+        while True:
+            with self._cond:
+                while not self._batch_ready():
+                    if self._stop and not self._queue:
+                        return
+                    timeout = None
+                    if self._queue and self.flush_interval_sec is not None:
+                        timeout = max(0.0, self._last_flush + self.flush_interval_sec - time.monotonic())
+                    if self._queue and self._retry_at > time.monotonic():
+                        retry_in = self._retry_at - time.monotonic()
+                        timeout = retry_in if timeout is None else max(timeout, retry_in)
+                    self._cond.wait(timeout=timeout)
+
+                batch = [self._pop_entry() for _ in range(len(self._queue))]
+                self._inflight = len(batch)
+                self._cond.notify_all()  # wake producers blocked on a full queue
+
+            try:
+                self._write_records([(query, params) for _, query, params in batch])
+                error = None
+            except Exception as e:
+                error = e
+
+            with self._cond:
+                if error is None:
+                    self._counters["written"] += len(batch)
+                    self._failures = 0
+                else:
+                    self._counters["errors"] += 1
+                    self._retry_failed(batch, error)
+                self._inflight = 0
+                self._last_flush = time.monotonic()
+                self._cond.notify_all()
+
+    def _retry_failed(self, batch: List[List[Any]], error: Exception) -> None:
+        # Called with the condition held.
+        self._failures += 1
+        if self._failures > self.write_retries:
+            self._failures = 0
+            self._retry_at = 0.0
+            self._counters["lost"] += len(batch)
+            self._forget_checkpoints(batch)
+            logger.error(
+                "Database writer gave up on {} records after {} failed attempts: {}".format(
+                    len(batch), self.write_retries + 1, error
+                )
+            )
+            return
+
+        delay = self.retry_backoff_sec * 2 ** (self._failures - 1)
+        logger.warning(
+            "Database writer failed to write {} records ({}); retry {}/{} in {:.1f}s".format(
+                len(batch), error, self._failures, self.write_retries, delay
+            )
+        )
+        self._retry_at = time.monotonic() + delay
+        for entry in reversed(batch):
+            self._queue.appendleft(entry)
+            if entry[0] is not None and not (entry[0] in self._queue_keys):
+                self._queue_keys[entry[0]] = entry
+        # Records that arrived meanwhile and no longer fit are handled by the overflow policy:
+        if self.overflow_policy != "block":
+            while len(self._queue) > self.queue_size:
+                self._forget_checkpoints([self._pop_entry()])
+                self._counters["dropped"] += 1
+
+    def _write_records(self, records: List[Tuple[str, Tuple[Any, ...]]]) -> None:
+        # Group by statement so each table gets one executemany call; insertion
+        # order is preserved within each group.
+        grouped: Dict[str, List[Tuple[Any, ...]]] = {}
+        for query, params in records:
+            grouped.setdefault(query, []).append(params)
+
+        # Rollups are updated in the same transaction as the raw readings:
+        readings = grouped.get(_READING_INSERT)
+        if readings:
+            for name, width in ROLLUP_RESOLUTIONS.items():
+                grouped[_ROLLUP_UPSERTS[name]] = _rollup_rows(readings, width)
+
+        with metrics.timer("db.commit"):
+            self.connector.execute_batch(list(grouped.items()))
+
+    def flush_if_due(self) -> None:
+        """Flush buffered records if the flush deadline has passed."""
+        if self.threaded:
+            return  # the writer thread keeps its own deadline
+        if self.flush_interval_sec is None or not self._pending:
+            return
+        if time.monotonic() - self._last_flush >= self.flush_interval_sec:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write every buffered record in a single transaction.
+
+        In threaded mode this wakes the writer and waits until the queue is drained.
+        """
+        self._check_fork()
+        if self.threaded:
+            with self._cond:
+                self._flush_requested = True
+                self._cond.notify_all()
+                while (self._queue or self._inflight) and self._writer.is_alive():
+                    self._cond.wait()
+                self._flush_requested = False
+            return
+
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+
+        self._write_records(self._pending)
+        logger.debug("Flushed {} buffered database records".format(len(self._pending)))
+        self._pending.clear()
+
+    def close(self) -> None:
+        """Flush any buffered records and close the database connection."""
+        if self._uptime_start is not None:
+            self._write_uptime()
+        self.flush()
+        if self.threaded:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            self._writer.join()
+            logger.info("Database writer stopped: {}".format(self.stats))
+        self.reader.close()
+        self.connector.close()
+
+    def generate_schema(self, announce: bool = True) -> None:
         """
         Define and create the schema for the SQLite database.
         Add all CREATE TABLE statements here.
@@ -118,31 +677,319 @@ class DatabaseHandler:
             );
             """,
             """
+            CREATE INDEX IF NOT EXISTS idx_images_name ON images (image_name);
+            """,
+            """
             CREATE TABLE IF NOT EXISTS events (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
             """,
+            """
+            CREATE TABLE IF NOT EXISTS sensor_readings (
+                id INTEGER PRIMARY KEY,
+                device TEXT NOT NULL,
+                key TEXT NOT NULL,
+                timestamp REAL NOT NULL, -- Unix epoch seconds
+                value REAL NOT NULL
+            );
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_sensor_readings_device_timestamp
+            ON sensor_readings (device, timestamp);
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS uptime (
+                start REAL PRIMARY KEY, -- Unix epoch seconds
+                last_seen REAL NOT NULL,
+                opened_by TEXT NOT NULL -- 'start' (application launch) or 'stall' (loop stopped beating)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS scheduler_state (
+                name TEXT PRIMARY KEY, -- ex: 'instrument/light_1/0'
+                state TEXT NOT NULL, -- JSON from Scheduler.state_dict()
+                updated REAL NOT NULL -- Unix epoch seconds
+            );
+            """,
         ]
+        for name in ROLLUP_RESOLUTIONS:
+            schema_statements.append(
+                f"""
+                CREATE TABLE IF NOT EXISTS sensor_rollup_{name} (
+                    device TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    bucket REAL NOT NULL, -- Unix epoch seconds at the start of the bucket
+                    min_value REAL NOT NULL,
+                    max_value REAL NOT NULL,
+                    sum_value REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (device, key, bucket)
+                ) WITHOUT ROWID;
+                """
+            )
 
         for stmt in schema_statements:
             self.connector.execute(stmt)
 
-        logger.info("✅ Database schema generated successfully.")
+        if announce:
+            logger.info("✅ Database schema generated successfully.")
 
+    # Timestamps are taken when a record is written rather than left to the
+    # column default, so buffered records keep the time they were produced.
     def log(self, data: LogRecord):
         query = (
-            "INSERT INTO logs (device, level, message, metadata) VALUES (?, ?, ?, ?)"
+            "INSERT INTO logs (device, timestamp, level, message, metadata) VALUES (?, ?, ?, ?, ?)"
         )
-        params = (data.name, data.level, data.message, data.metadata)
-        self.connector.execute(query, params)
+        params = (data.name, _utc_timestamp(), data.level, data.message, data.metadata)
+        self._write(query, params, key=(query, data.name, data.message))
+
+    def log_reading(self, data: ReadingRecord):
+        """Store one numeric row per key of a sensor reading in `sensor_readings`.
+
+        Non-numeric values are skipped.
+
+        Example:
+            >>> db.log_reading(ReadingRecord(name="main_temp_sensor_1", values={"temperature": 72.1, "relative_humidity": 40.2}))
+        """
+        timestamp = data.timestamp if data.timestamp is not None else time.time()
+        for key, value in data.values.items():
+            if not isinstance(value, (int, float)):
+                continue
+            self._write(_READING_INSERT, (data.name, key, timestamp, float(value)), key=(_READING_INSERT, data.name, key))
+
+    def query_readings(
+        self,
+        device: str,
+        start: Union[datetime, float],
+        end: Union[datetime, float],
+        key: Optional[str] = None,
+    ) -> List[sqlite3.Row]:
+        """Fetch raw readings for a device between `start` and `end` (inclusive).
+
+        Args:
+            device (str): Device name as it appears in the sensor tree.
+            start (datetime | float): Start of the range (datetime or Unix epoch seconds).
+            end (datetime | float): End of the range (datetime or Unix epoch seconds).
+            key (str, optional): Only return readings for this key (ex: "temperature").
+
+        Returns:
+            List[sqlite3.Row]: Rows with `key`, `timestamp` and `value`, ordered by timestamp.
+        """
+        query = "SELECT key, timestamp, value FROM sensor_readings WHERE device = ? AND timestamp BETWEEN ? AND ?"
+        params: Tuple[Any, ...] = (device, _to_epoch(start), _to_epoch(end))
+        if key is not None:
+            query += " AND key = ?"
+            params += (key,)
+        query += " ORDER BY timestamp"
+        return self.reader.fetch_all(query, params)
+
+    def query_rollup(
+        self,
+        device: str,
+        key: str,
+        start: Union[datetime, float],
+        end: Union[datetime, float],
+        resolution_sec: float,
+    ) -> List[sqlite3.Row]:
+        """Aggregate a device's readings into buckets of `resolution_sec` seconds.
+
+        The coarsest rollup table whose bucket width divides the requested
+        resolution is used (day, hour, then minute), falling back to
+        `sensor_readings` for resolutions that no rollup divides (ex: 90 s). With a
+        rollup, buckets that only partly overlap `start`..`end` are included whole.
+
+        Args:
+            device (str): Device name as it appears in the sensor tree.
+            key (str): Reading key (ex: "temperature").
+            start (datetime | float): Start of the range (datetime or Unix epoch seconds).
+            end (datetime | float): End of the range (datetime or Unix epoch seconds).
+            resolution_sec (float): Width of each returned bucket in seconds.
+
+        Returns:
+            List[sqlite3.Row]: Rows with `bucket`, `min_value`, `max_value`, `mean_value` and `count`, ordered by bucket.
+
+        Example:
+            >>> db.query_rollup("main_temp_sensor_1", "temperature", start, end, resolution_sec=3600)
+        """
+        query, params = self._rollup_query(device, key, start, end, resolution_sec)
+        return self.reader.fetch_all(query, params)
+
+    def _rollup_query(
+        self,
+        device: str,
+        key: str,
+        start: Union[datetime, float],
+        end: Union[datetime, float],
+        resolution_sec: float,
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        if resolution_sec <= 0:
+            raise ValueError("resolution_sec must be positive, got {}".format(resolution_sec))
+
+        start, end = _to_epoch(start), _to_epoch(end)
+        table = self._rollup_table(resolution_sec)
+        if table is None:
+            source = "sensor_readings"
+            columns = "timestamp AS bucket, value AS min_value, value AS max_value, value AS sum_value, 1 AS count"
+            condition = "timestamp BETWEEN ? AND ?"
+            range_params = (start, end)
+        else:
+            source = table
+            columns = "bucket, min_value, max_value, sum_value, count"
+            # Every bucket that overlaps the range, including one that starts before `start`
+            # (bucket + width > start, written so the primary key index still applies):
+            condition = "bucket > ? AND bucket <= ?"
+            range_params = (start - ROLLUP_RESOLUTIONS[table[len("sensor_rollup_"):]], end)
+
+        query = f"""
+            SELECT CAST(bucket / ? AS INTEGER) * ? AS bucket,
+                   MIN(min_value) AS min_value,
+                   MAX(max_value) AS max_value,
+                   SUM(sum_value) / SUM(count) AS mean_value,
+                   SUM(count) AS count
+            FROM (
+                SELECT {columns} FROM {source}
+                WHERE device = ? AND key = ? AND {condition}
+            )
+            GROUP BY 1
+            ORDER BY 1
+        """
+        params = (resolution_sec, resolution_sec, device, key) + range_params
+        return query, params
+
+    def query_series(
+        self,
+        device: str,
+        key: str,
+        start: Union[datetime, float],
+        end: Union[datetime, float],
+        resolution: Optional[float] = None,
+        structured: bool = False,
+    ) -> Union[Tuple[np.ndarray, np.ndarray], np.ndarray]:
+        """Read a sensor key's history straight into NumPy arrays.
+
+        Rows are streamed from the cursor into the array as plain tuples, so no
+        `sqlite3.Row` objects or JSON parsing are involved. With a `resolution`
+        the values are bucket means taken from the rollup tables (see `query_rollup`).
+
+        Args:
+            device (str): Device name as it appears in the sensor tree.
+            key (str): Reading key (ex: "temperature").
+            start (datetime | float): Start of the range (datetime or Unix epoch seconds).
+            end (datetime | float): End of the range (datetime or Unix epoch seconds).
+            resolution (float, optional): Bucket width in seconds. Defaults to None (raw readings).
+            structured (bool, optional): Return one structured array instead of a `(timestamps, values)` tuple. Defaults to False.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray] | np.ndarray: Float64 timestamps (Unix epoch seconds) and values,
+            or a structured array with `timestamp` and `value` fields (plus `min`, `max` and `count` when
+            `resolution` is given).
+
+        Example:
+            >>> timestamps, temps = db.query_series("main_temp_sensor_1", "temperature", start, end)
+            >>> hourly = db.query_series("main_temp_sensor_1", "temperature", start, end, resolution=3600, structured=True)
+            >>> hourly["max"].max()
+            91.2
+        """
+        if resolution is None:
+            query = """
+                SELECT timestamp, value FROM sensor_readings
+                WHERE device = ? AND key = ? AND timestamp BETWEEN ? AND ?
+                ORDER BY timestamp
+            """
+            params = (device, key, _to_epoch(start), _to_epoch(end))
+            dtype = np.dtype([("timestamp", "f8"), ("value", "f8")])
+        else:
+            query, params = self._rollup_query(device, key, start, end, resolution)
+            query = f"SELECT bucket, mean_value, min_value, max_value, count FROM ({query})"
+            dtype = np.dtype([("timestamp", "f8"), ("value", "f8"), ("min", "f8"), ("max", "f8"), ("count", "i8")])
+
+        series = self.reader.fetch_array(query, params, dtype)
+        if structured:
+            return series
+        return series["timestamp"].copy(), series["value"].copy()
+
+    def _rollup_table(self, resolution_sec: float) -> Optional[str]:
+        """Coarsest rollup table whose bucket width divides `resolution_sec`, or None for raw readings.
+
+        Buckets of a width that does not divide the resolution would straddle
+        the requested buckets (ex: hour buckets regrouped into 5400 s ones).
+        """
+        best = None
+        for name, width in ROLLUP_RESOLUTIONS.items():
+            multiple = resolution_sec / width
+            if multiple >= 1 and abs(multiple - round(multiple)) < 1e-9:
+                if best is None or width > ROLLUP_RESOLUTIONS[best]:
+                    best = name
+        return None if best is None else f"sensor_rollup_{best}"
+
+    def backfill_from_logs(self, chunk_rows: int = 5000) -> int:
+        """Copy legacy JSON sensor readings from `logs` into `sensor_readings` and the rollups.
+
+        Progress is remembered in the `meta` table, so the backfill can be run
+        repeatedly (or interrupted) without counting a row twice.
+
+        Args:
+            chunk_rows (int, optional): Number of `logs` rows converted per transaction. Defaults to 5000.
+
+        Returns:
+            int: Number of readings written.
+        """
+        self.flush()
+        row = self.connector.fetch_one("SELECT value FROM meta WHERE key = 'backfill_logs_id'")
+        last_id = int(row["value"]) if row else 0
+        written = 0
+
+        while True:
+            rows = self.connector.fetch_all(
+                """
+                SELECT id, device, timestamp, metadata FROM logs
+                WHERE id > ? AND message LIKE '% sensor reading'
+                ORDER BY id LIMIT ?
+                """,
+                (last_id, chunk_rows),
+            )
+            if not rows:
+                break
+
+            records = []
+            for log_row in rows:
+                try:
+                    values = json.loads(log_row["metadata"])
+                    timestamp = datetime.strptime(log_row["timestamp"], "%Y-%m-%d %H:%M:%S")
+                except (TypeError, ValueError) as e:
+                    logger.warning("Skipping log row {} during backfill: {}".format(log_row["id"], e))
+                    continue
+                timestamp = timestamp.replace(tzinfo=timezone.utc).timestamp()
+                for key, value in values.items():
+                    if isinstance(value, (int, float)):
+                        records.append((_READING_INSERT, (log_row["device"], key, timestamp, float(value))))
+
+            last_id = rows[-1]["id"]
+            records.append(
+                ("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfill_logs_id', ?)", (str(last_id),))
+            )
+            self._write_records(records)
+            written += len(records) - 1
+
+        logger.info("Backfilled {} readings from logs".format(written))
+        return written
 
     def record_image(self, image_data: ImageRecord):
-        query = "INSERT INTO images (image_name, image_path, active) VALUES (?, ?, ?)"
-        params = (image_data.name, image_data.path, True)
-        self.connector.execute(query, params)
+        query = "INSERT INTO images (timestamp, image_name, image_path, active) VALUES (?, ?, ?, ?)"
+        params = (_utc_timestamp(), image_data.name, image_data.path, True)
+        self._write(query, params)
 
     def record_delete_image(self, image_name:str):
+        # The image may still be sitting in the write buffer:
+        self.flush()
+
         # Find the image in the table and set the active column to False
         query = """
             SELECT *
@@ -160,10 +1007,160 @@ class DatabaseHandler:
         else:
             raise ValueError(f"Cannot find {image_name} in image table!")
 
+    def record_delete_images(self, image_names: Iterable[str]) -> int:
+        """Mark many images as inactive in one transaction.
+
+        Each name is an indexed lookup on `image_name`, so evicting a large batch
+        of files costs one commit instead of one per file. Names that are not in
+        the table are skipped with a warning.
+
+        Args:
+            image_names (Iterable[str]): File names of the deleted images (ex: "2025-10-25_14-20-00.jpg").
+
+        Returns:
+            int: Number of image rows that were deactivated.
+
+        Example:
+            >>> db.record_delete_images(["2025-10-25_14-20-00.jpg", "2025-10-26_14-20-00.jpg"])
+            2
+        """
+        image_names = list(image_names)
+        if not image_names:
+            return 0
+
+        # The images may still be sitting in the write buffer:
+        self.flush()
+        updated = self.connector.executemany(
+            "UPDATE images SET active = 0 WHERE image_name = ? AND active = 1",
+            [(name,) for name in image_names],
+        )
+        if updated < len(image_names):
+            logger.warning(
+                "Only {} of {} deleted images were active in the image table".format(updated, len(image_names))
+            )
+        return updated
+
     def heartbeat(self):
-        query = "INSERT INTO events DEFAULT VALUES;"
-        self.connector.execute(query)
+        if self.heartbeat_mode == "events":
+            query = "INSERT INTO events (timestamp) VALUES (?)"
+            self._write(query, (_utc_timestamp(),), key=query)
+            return
+
+        now = time.time()
+        if self._uptime_start is None or now - self._uptime_last_seen > self.heartbeat_gap_sec:
+            if self._uptime_start is not None:
+                logger.warning(
+                    "Main loop stalled for {:.1f} seconds; opening a new uptime interval".format(
+                        now - self._uptime_last_seen
+                    )
+                )
+                self._write_uptime()  # close out the previous interval at its real last_seen
+                opened_by = "stall"
+            else:
+                opened_by = "start"
+            self._uptime_start = now
+            self._uptime_opened_by = opened_by
+            self._uptime_last_seen = now
+            self._write_uptime()
+            return
 
+        self._uptime_last_seen = now
+        if now - self._uptime_last_written >= self.heartbeat_gap_sec:
+            self._write_uptime()
+
+    def _write_uptime(self) -> None:
+        query = """
+            INSERT INTO uptime (start, last_seen, opened_by) VALUES (?, ?, ?)
+            ON CONFLICT (start) DO UPDATE SET last_seen = excluded.last_seen
+        """
+        params = (self._uptime_start, self._uptime_last_seen, self._uptime_opened_by)
+        self._write(query, params, key=(query, self._uptime_start))
+        self._uptime_last_written = self._uptime_last_seen
+
+    def query_downtime(
+        self, start: Union[datetime, float] = 0.0, end: Optional[Union[datetime, float]] = None
+    ) -> List[sqlite3.Row]:
+        """List the windows in which the main loop was not running (ledger heartbeat mode).
+
+        Args:
+            start (datetime | float, optional): Only return windows ending at or after this time. Defaults to the beginning.
+            end (datetime | float, optional): Only return windows starting at or before this time. Defaults to now.
+
+        Returns:
+            List[sqlite3.Row]: Rows with `down_start`, `down_end` (Unix epoch seconds) and `reason`
+            (`"start"` for a restart, `"stall"` for a stalled loop), ordered by time.
+        """
+        end = time.time() if end is None else end
+        self.flush()
+        query = """
+            SELECT down_start, down_end, reason FROM (
+                SELECT LAG(last_seen) OVER (ORDER BY start) AS down_start,
+                       start AS down_end,
+                       opened_by AS reason
+                FROM uptime
+            )
+            WHERE down_start IS NOT NULL AND down_end >= ? AND down_start <= ?
+            ORDER BY down_start
+        """
+        return self.reader.fetch_all(query, (_to_epoch(start), _to_epoch(end)))
+
+    def checkpoint_schedulers(self, schedulers: Dict[str, Any], buffered: Collection[str] = ()) -> int:
+        """Save the state of every scheduler that changed since the last checkpoint.
+
+        Unchanged schedulers cost one `state_dict()` and a string comparison, so
+        this can run after every loop iteration. Changed states are committed
+        straight away (not buffered) so a crash right after an instrument or camera
+        fires cannot make it fire again. Schedulers named in `buffered` only repeat
+        a sensor read if their state is lost; those states go through the write
+        buffer with the readings, and one the buffer drops is sent again by the
+        next checkpoint.
+
+        Args:
+            schedulers (Dict[str, Scheduler]): Schedulers by name (ex: `"instrument/light_1/0"`).
+            buffered (Collection[str], optional): Names of schedulers whose state may be buffered. Defaults to ().
+
+        Returns:
+            int: Number of scheduler states written or queued.
+        """
+        self._check_fork()
+        now = time.time()
+        rows = []
+        queued = 0
+        for name, scheduler in schedulers.items():
+            state = json.dumps(scheduler.state_dict(), sort_keys=True)
+            if self._scheduler_states.get(name) == state:
+                continue
+            if name in buffered:
+                self._write(_SCHEDULER_UPSERT, (name, state, now), key=(_SCHEDULER_UPSERT, name))
+                self._scheduler_states[name] = state
+                queued += 1
+            else:
+                rows.append((name, state, now))
+        if rows:
+            self.connector.executemany(_SCHEDULER_UPSERT, rows)
+            # Only remembered once committed, so a failed write is retried by the next checkpoint:
+            for name, state, _ in rows:
+                self._scheduler_states[name] = state
+        return len(rows) + queued
+
+    def restore_schedulers(self, schedulers: Dict[str, Any]) -> int:
+        """Load checkpointed state into the given schedulers (ones without a checkpoint are left as they are).
+
+        Args:
+            schedulers (Dict[str, Scheduler]): Schedulers by the names used with `checkpoint_schedulers`.
+
+        Returns:
+            int: Number of schedulers restored.
+        """
+        restored = 0
+        for row in self.connector.fetch_all("SELECT name, state FROM scheduler_state"):
+            if row["name"] in schedulers:
+                schedulers[row["name"]].load_state_dict(json.loads(row["state"]))
+                self._scheduler_states[row["name"]] = row["state"]
+                restored += 1
+        if restored > 0:
+            logger.info("Restored the state of {} schedulers".format(restored))
+        return restored
 
 if __name__ == "__main__":
     handler = DatabaseHandler("test.db")
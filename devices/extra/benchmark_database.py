@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append("./")
+from loguru import logger
+from devices.database import DatabaseHandler, ImageRecord, LogRecord, ReadingRecord
+
+
+# ---------------------------------------------------------------------------
+# Storage modes under test
+# ---------------------------------------------------------------------------
+
+# Keyword arguments handed to DatabaseHandler for each mode. "commit" is the
+# current handler without buffering: one commit per record, but with the typed
+# tables, rollups and connection pool. "baseline" is not a DatabaseHandler mode;
+# it runs BaselineHandler below, the original commit-per-row setup.
+MODES = {
+    "baseline": None,
+    "commit": dict(),
+    "batched": dict(batch_size=100, flush_interval_sec=30),
+    "threaded": dict(batch_size=100, flush_interval_sec=30, threaded=True, overflow_policy="block"),
+}
+
+SENSOR_KEYS = {
+    "temperature_sensor": ["temperature", "relative_humidity"],
+    "light_sensor": ["lux", "infrared", "spectrum"],
+}
+
+
+# ---------------------------------------------------------------------------
+# Original storage
+# ---------------------------------------------------------------------------
+
+
+class BaselineHandler:
+    """The database layer as it was before any storage change, kept as the reference.
+
+    One connection in SQLite's default (DELETE) journal mode, the original
+    `logs`/`images`/`events` schema, and a commit after every statement. Sensor
+    readings go to `logs` as JSON through `log()`.
+    """
+
+    def __init__(self, db_file_path: str):
+        self.connection = sqlite3.connect(db_file_path)
+        self.cursor = self.connection.cursor()
+        self.rows_written = 0
+        for stmt in [
+            """CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, device TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, level TEXT DEFAULT 'INFO',
+                message TEXT NOT NULL, metadata TEXT)""",
+            """CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                image_name TEXT NOT NULL, image_path TEXT NOT NULL, active BOOLEAN NOT NULL)""",
+            """CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+        ]:
+            self.cursor.execute(stmt)
+        self.connection.commit()
+
+    def _execute(self, query: str, params: tuple = ()) -> None:
+        self.cursor.execute(query, params)
+        self.connection.commit()
+        self.rows_written += max(self.cursor.rowcount, 0)
+
+    def log(self, data: LogRecord) -> None:
+        self._execute(
+            "INSERT INTO logs (device, level, message, metadata) VALUES (?, ?, ?, ?)",
+            (data.name, data.level, data.message, data.metadata),
+        )
+
+    def record_image(self, image_data: ImageRecord) -> None:
+        self._execute(
+            "INSERT INTO images (image_name, image_path, active) VALUES (?, ?, ?)",
+            (image_data.name, image_data.path, True),
+        )
+
+    def record_delete_image(self, image_name: str) -> None:
+        self.cursor.execute("SELECT * FROM images WHERE image_name = ?", (image_name,))
+        if self.cursor.fetchone() is None:
+            raise ValueError(f"Cannot find {image_name} in image table!")
+        self._execute("UPDATE images SET active = 0 WHERE image_name = ?", (image_name,))
+
+    def heartbeat(self) -> None:
+        self._execute("INSERT INTO events DEFAULT VALUES;")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# ---------------------------------------------------------------------------
+# Workload
+# ---------------------------------------------------------------------------
+
+
+def fake_reading(sensor_type: str) -> dict:
+    """Same shape as the --fake-data sensor readings in main.py."""
+    return {key: random.random() * 100.0 for key in SENSOR_KEYS[sensor_type]}
+
+
+def run_benchmark(
+    db_file_path: str,
+    mode: str,
+    devices: int = 8,
+    interval_sec: float = 10.0,
+    sim_hours: float = 1.0,
+    image_interval_sec: float = 600.0,
+    cameras: int = 2,
+    keep_images: int = 50,
+    heartbeat_mode: str = "events",
+    journal_mode: str = "WAL",
+    readings: str = "log",
+    speedup: float = 0.0,
+) -> dict:
+    """Drive DatabaseHandler with a simulated main loop and measure it.
+
+    The main loop is simulated one second per tick: a heartbeat every tick, one
+    reading per device every `interval_sec`, and one image per camera every
+    `image_interval_sec` (the oldest image is deleted once more than
+    `keep_images` exist, like FileManager does). Simulated time runs as fast as
+    possible unless `speedup` is given, in which case each simulated second takes
+    1 / speedup wall seconds.
+
+    Readings are written with `log()` as JSON `LogRecord`s, like the original
+    main loop, unless `readings` is `"typed"` (`log_reading()` into
+    `sensor_readings` and the rollups). The baseline mode always uses `log()`.
+
+    Returns:
+        dict: rows written (every row any statement inserted, updated or deleted, rollup
+        upserts included), wall time, rows/sec, per-operation latency percentiles (ms)
+        and database growth per simulated day (MB).
+    """
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(db_file_path + suffix):
+            os.remove(db_file_path + suffix)
+
+    if mode == "baseline":
+        handler = BaselineHandler(db_file_path)
+        counter = handler
+        readings = "log"
+    else:
+        handler = DatabaseHandler(
+            db_file_path, heartbeat_mode=heartbeat_mode, journal_mode=journal_mode, **MODES[mode]
+        )
+        counter = handler.connector
+    rows_start = counter.rows_written
+    size_start = _db_size(db_file_path)
+
+    sensor_types = list(SENSOR_KEYS)
+    device_list = [("sensor_{}".format(i), sensor_types[i % len(sensor_types)]) for i in range(devices)]
+    latencies = {"log": [], "heartbeat": [], "record_image": [], "record_delete_image": []}
+    images = []
+
+    sim_seconds = int(sim_hours * 3600)
+    sim_start = time.time() - sim_seconds
+    wall_start = time.perf_counter()
+
+    for tick in range(sim_seconds):
+        sim_now = sim_start + tick
+
+        t = time.perf_counter()
+        handler.heartbeat()
+        latencies["heartbeat"].append(time.perf_counter() - t)
+
+        if tick % interval_sec < 1:
+            for name, sensor_type in device_list:
+                reading = fake_reading(sensor_type)
+                t = time.perf_counter()
+                if readings == "typed":
+                    handler.log_reading(ReadingRecord(name=name, values=reading, timestamp=sim_now))
+                else:
+                    handler.log(LogRecord(name=name, message=sensor_type, metadata=json.dumps(reading)))
+                latencies["log"].append(time.perf_counter() - t)
+
+        if tick % image_interval_sec < 1:
+            for camera in range(cameras):
+                image_name = "camera_{}_{}.jpg".format(camera, tick)
+                t = time.perf_counter()
+                handler.record_image(ImageRecord(name=image_name, path="./camera_data/" + image_name))
+                latencies["record_image"].append(time.perf_counter() - t)
+                images.append(image_name)
+
+            while len(images) > keep_images:
+                t = time.perf_counter()
+                handler.record_delete_image(images.pop(0))
+                latencies["record_delete_image"].append(time.perf_counter() - t)
+
+        if speedup > 0:
+            delay = wall_start + (tick + 1) / speedup - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    handler.close()
+    wall_time = time.perf_counter() - wall_start
+    rows = counter.rows_written - rows_start
+    growth_mb = (_db_size(db_file_path) - size_start) / (1024 * 1024)
+
+    result = {
+        "mode": mode,
+        "path": str(Path(db_file_path).parent),
+        "rows": rows,
+        "wall_sec": wall_time,
+        "rows_per_sec": rows / wall_time if wall_time > 0 else float("inf"),
+        "growth_mb_per_day": growth_mb * 86400 / max(sim_seconds, 1),
+    }
+    for op, samples in latencies.items():
+        if samples:
+            samples_ms = np.asarray(samples) * 1000.0
+            result[op + "_p50_ms"] = float(np.percentile(samples_ms, 50))
+            result[op + "_p99_ms"] = float(np.percentile(samples_ms, 99))
+    return result
+
+
+def _db_size(db_file_path: str) -> int:
+    """Size of the database including its WAL file, in bytes."""
+    return sum(
+        os.path.getsize(db_file_path + suffix)
+        for suffix in ["", "-wal"]
+        if os.path.exists(db_file_path + suffix)
+    )
+
+
+def print_results(results: list) -> None:
+    ops = ["heartbeat", "log", "record_image", "record_delete_image"]
+    header = "{:<10} {:<24} {:>10} {:>12} {:>12}".format("mode", "path", "rows/sec", "MB/day", "wall (s)")
+    header += "".join(" {:>22}".format(op + " p50/p99") for op in ops)
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        line = "{:<10} {:<24} {:>10.0f} {:>12.2f} {:>12.2f}".format(
+            r["mode"], r["path"][-24:], r["rows_per_sec"], r["growth_mb_per_day"], r["wall_sec"]
+        )
+        for op in ops:
+            if op + "_p50_ms" in r:
+                line += " {:>22}".format("{:.3f}/{:.3f} ms".format(r[op + "_p50_ms"], r[op + "_p99_ms"]))
+            else:
+                line += " {:>22}".format("-")
+        print(line)
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark DatabaseHandler write throughput with synthetic greenhouse data.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--paths",
+        nargs="+",
+        default=["/dev/shm/greenhouse_bench", "./logs/bench"],
+        help="Directories to benchmark in (ex: a tmpfs and a disk-backed path)",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=list(MODES),
+        choices=list(MODES),
+        help="Storage modes to compare",
+    )
+    parser.add_argument("--devices", type=int, default=8, help="Number of simulated sensors")
+    parser.add_argument("--interval-sec", type=float, default=10.0, help="Sensor reading interval (simulated seconds)")
+    parser.add_argument("--sim-hours", type=float, default=1.0, help="Length of the simulated run")
+    parser.add_argument("--cameras", type=int, default=2, help="Number of simulated cameras")
+    parser.add_argument("--image-interval-sec", type=float, default=600.0, help="Camera capture interval (simulated seconds)")
+    parser.add_argument("--keep-images", type=int, default=50, help="Images kept before the oldest is deleted")
+    parser.add_argument("--heartbeat-mode", choices=DatabaseHandler.HEARTBEAT_MODES, default="events", help="Heartbeat storage mode")
+    parser.add_argument(
+        "--journal-mode",
+        default="WAL",
+        help="SQLite journal mode of the DatabaseHandler modes (the baseline mode always runs the original setup)",
+    )
+    parser.add_argument(
+        "--readings",
+        choices=["log", "typed"],
+        default="log",
+        help="Write readings as JSON logs (log) or into sensor_readings and the rollups (typed)",
+    )
+    parser.add_argument("--speedup", type=float, default=0.0, help="Simulated seconds per wall second (0 = as fast as possible)")
+    parser.add_argument("--keep", action="store_true", default=False, help="Keep the benchmark databases afterwards")
+    args = parser.parse_args()
+
+    logger.remove()  # per-flush debug logging would dominate the measurements
+    logger.add(sys.stderr, level="WARNING")
+
+    results = []
+    for path in args.paths:
+        os.makedirs(path, exist_ok=True)
+        for mode in args.modes:
+            db_file_path = os.path.join(path, "bench_{}.db".format(mode))
+            print(f"Running {mode} in {path} ...")
+            results.append(
+                run_benchmark(
+                    db_file_path,
+                    mode,
+                    devices=args.devices,
+                    interval_sec=args.interval_sec,
+                    sim_hours=args.sim_hours,
+                    image_interval_sec=args.image_interval_sec,
+                    cameras=args.cameras,
+                    keep_images=args.keep_images,
+                    heartbeat_mode=args.heartbeat_mode,
+                    journal_mode=args.journal_mode,
+                    readings=args.readings,
+                    speedup=args.speedup,
+                )
+            )
+            if not args.keep:
+                for suffix in ["", "-wal", "-shm"]:
+                    if os.path.exists(db_file_path + suffix):
+                        os.remove(db_file_path + suffix)
+
+    print()
+    print_results(results)
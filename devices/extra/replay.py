@@ -0,0 +1,283 @@
+import argparse
+import csv
+import sys
+import time
+from datetime import datetime
+from typing import *
+
+sys.path.append("./")
+from loguru import logger
+from main import initialize_from_config
+from control import scheduler_registry, interval_scheduler, apply_rules, run_interval_instrument
+from rules import RuleEngine
+from scheduler import TimerHeap
+from devices.database import SQLiteAPI
+from devices.metrics import metrics
+from devices.instrument.water import WaterPump
+
+
+# ---------------------------------------------------------------------------
+# Virtual clock and stand-ins
+# ---------------------------------------------------------------------------
+
+
+class VirtualClock:
+    """Clock handed to every scheduler during replay; it only moves when the replay advances it."""
+
+    def __init__(self, start: float):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, timestamp: float) -> None:
+        self.now = max(self.now, timestamp)
+
+
+class ActuationRecorder:
+    """Takes the place of an instrument during replay and records what the relay would have done.
+
+    Only switches are recorded: repeated triggers with the state the relay is
+    already in are not. Fans triggered without a state and the water pump run
+    for a fixed time; each of those runs is recorded as "on" with `duration_sec`
+    set, and like the real devices, every trigger during such a run is ignored.
+    """
+
+    def __init__(self, name: str, device: Any, clock: VirtualClock, timeline: List[Dict]):
+        self.name = name
+        self.clock = clock
+        self.timeline = timeline
+        self.pump = isinstance(device, WaterPump)
+        self.duration = device.period if self.pump else getattr(device, "__duration__", None)
+        self.state: Optional[bool] = None
+        self.busy_until = 0.0  # end of the current timed run
+
+    def trigger(self, state: Optional[bool] = None) -> Dict:
+        now = self.clock()
+        if now < self.busy_until:
+            return {"state": state}
+        timed = state is None or self.pump
+        if timed:
+            self.busy_until = now + (self.duration or 0.0)
+            self.state = False  # the relay is off again once the run ends
+        elif self.state == bool(state):
+            return {"state": state}
+        else:
+            self.state = bool(state)
+        self.timeline.append(
+            {
+                "timestamp": now,
+                "instrument": self.name,
+                "state": True if timed else bool(state),
+                "duration_sec": self.duration if timed else None,
+            }
+        )
+        return {"state": state}
+
+
+class DiscardLog:
+    """Accepts the LogRecords the control functions write and keeps only a count."""
+
+    def __init__(self):
+        self.records = 0
+
+    def log(self, record) -> None:
+        self.records += 1
+
+
+# ---------------------------------------------------------------------------
+# Replay
+# ---------------------------------------------------------------------------
+
+
+def load_readings(db_file_path: str, start: float = 0.0, end: float = float("inf")) -> List[Tuple[float, str, Dict]]:
+    """Read recorded sensor readings as `(timestamp, device, {key: value})`, ordered by time.
+
+    Rows are scanned in insertion order (no sort in SQLite) and grouped back
+    into one reading per device and timestamp.
+    """
+    reader = SQLiteAPI(db_file_path, read_only=True)
+    cursor = reader.connection.execute(
+        "SELECT timestamp, device, key, value FROM sensor_readings WHERE timestamp >= ? AND timestamp < ? ORDER BY id",
+        (start, min(end, 1e18)),
+    )
+    events = []
+    append = events.append
+    last_timestamp, last_device, reading = None, None, None
+    for timestamp, device, key, value in cursor:
+        if timestamp != last_timestamp or device != last_device:
+            reading = {}
+            append((timestamp, device, reading))
+            last_timestamp, last_device = timestamp, device
+        reading[key] = value
+    reader.close()
+    events.sort(key=lambda event: event[0])  # nearly sorted already; batched writers can interleave slightly
+    return events
+
+
+def filter_series(events: List[Tuple[float, str, Dict]], sensor_tree: Dict) -> None:
+    """Replace every recorded (raw) reading in `events` with what the sensor's filter makes of it, in place.
+
+    A filter only ever sees its own sensor's readings, so each sensor's series
+    goes through `SignalFilter.run` in one piece instead of reading by reading.
+    """
+    series: Dict[str, List[int]] = {}
+    for idx, (_, device_name, _) in enumerate(events):
+        if getattr(sensor_tree.get(device_name), "filter", None) is not None:
+            series.setdefault(device_name, []).append(idx)
+    for device_name, indices in series.items():
+        filtered = sensor_tree[device_name].filter.run([events[idx][2] for idx in indices])
+        for idx, reading in zip(indices, filtered):
+            events[idx] = (events[idx][0], device_name, reading)
+
+
+def replay(
+    config_file: str,
+    db_file_path: str,
+    start: float = 0.0,
+    end: Optional[float] = None,
+) -> Tuple[List[Dict], Dict[str, Any]]:
+    """Run the control logic of `config_file` against readings recorded in `db_file_path`.
+
+    The device tree, schedulers and rules are built exactly as `main.py` builds
+    them (with fake devices), but every scheduler runs on a virtual clock that
+    jumps from one recorded reading to the next, and instruments are replaced by
+    recorders. Nothing sleeps and nothing touches a relay.
+
+    Args:
+        config_file (str): Configuration to validate (ex: `config.json`).
+        db_file_path (str): Database with recorded `sensor_readings`.
+        start (float, optional): Replay readings from this Unix time. Defaults to the first reading.
+        end (float, optional): Replay readings before this Unix time. Defaults to the last reading.
+
+    Returns:
+        Tuple[List[Dict], Dict]: Actuation timeline (`timestamp`, `instrument`, `state`, `duration_sec`)
+        and run statistics.
+
+    Example:
+        >>> timeline, stats = replay("config.json", "./logs/internal.db")
+        >>> timeline[0]
+        {'timestamp': 1760000000.0, 'instrument': 'light_1', 'state': True, 'duration_sec': None}
+    """
+    wall_start = time.perf_counter()
+    metrics.enabled = False  # latencies and lateness under a virtual clock mean nothing
+    events = load_readings(db_file_path, start, float("inf") if end is None else end)
+    if not events:
+        return [], {"readings": 0, "wall_sec": time.perf_counter() - wall_start}
+    end = events[-1][0] if end is None else end
+
+    sensor_tree, instrument_tree, _ = initialize_from_config(config_file, fake_data=True)
+    clock = VirtualClock(events[0][0])
+    for scheduler in scheduler_registry(sensor_tree, instrument_tree).values():
+        scheduler.set_clock(clock)
+
+    timeline: List[Dict] = []
+    for name, instrument in instrument_tree.items():
+        instrument.device = ActuationRecorder(name, instrument.device, clock, timeline)
+
+    filter_series(events, sensor_tree)
+    engine = RuleEngine.from_trees(sensor_tree, instrument_tree)
+    sink = DiscardLog()
+    timers = TimerHeap()
+    for name, instrument in instrument_tree.items():
+        if instrument.run_alone:
+            timers.push(name, interval_scheduler(instrument))
+
+    def run_timers(until: float) -> None:
+        # Fire every iterative instrument that falls due before `until`:
+        while True:
+            deadline = timers.next_deadline()
+            if deadline is None or deadline > until:
+                return
+            clock.advance(deadline)
+            for name, scheduler in timers.pop_due(now=clock()):
+                if scheduler.can_schedule():
+                    run_interval_instrument(name, instrument_tree[name], scheduler, sink)
+                timers.push(name, scheduler)
+
+    for timestamp, device_name, reading in events:
+        run_timers(timestamp)
+        clock.advance(timestamp)
+        affected = engine.update(device_name, reading)
+        if affected:
+            reading_time = datetime.fromtimestamp(timestamp)
+            apply_rules(engine, {name: (device_name, reading_time) for name in affected}, instrument_tree, sink)
+    run_timers(end)
+
+    wall_sec = time.perf_counter() - wall_start
+    stats = {
+        "readings": len(events),
+        "actuations": len(timeline),
+        "simulated_days": (end - events[0][0]) / 86400,
+        "wall_sec": wall_sec,
+        "readings_per_sec": len(events) / wall_sec,
+    }
+    return timeline, stats
+
+
+def summarize(timeline: List[Dict], end: float) -> Dict[str, Dict[str, float]]:
+    """Actuations and total on-time (hours) per instrument."""
+    summary: Dict[str, Dict[str, float]] = {}
+    on_since: Dict[str, Optional[float]] = {}
+    for event in timeline:
+        name = event["instrument"]
+        entry = summary.setdefault(name, {"actuations": 0, "on_hours": 0.0})
+        entry["actuations"] += 1
+        if event["duration_sec"] is not None:
+            entry["on_hours"] += event["duration_sec"] / 3600
+        elif event["state"]:
+            if on_since.get(name) is None:
+                on_since[name] = event["timestamp"]
+        elif on_since.get(name) is not None:
+            entry["on_hours"] += (event["timestamp"] - on_since[name]) / 3600
+            on_since[name] = None
+    for name, since in on_since.items():
+        if since is not None:
+            summary[name]["on_hours"] += (end - since) / 3600
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay recorded sensor readings through the control logic and print the relay actuation timeline.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--config", default="config.json", help="Configuration to validate")
+    parser.add_argument("--db", default="./logs/internal.db", help="Database with recorded sensor readings")
+    parser.add_argument("--start", default=None, help="First day to replay (YYYY-MM-DD, local time)")
+    parser.add_argument("--end", default=None, help="Day to stop before (YYYY-MM-DD, local time)")
+    parser.add_argument("--output", default=None, help="Write the actuation timeline to this CSV file")
+    args = parser.parse_args()
+
+    logger.remove()  # per-decision logging would dominate the replay
+    logger.add(sys.stderr, level="WARNING")
+
+    start = datetime.strptime(args.start, "%Y-%m-%d").timestamp() if args.start else 0.0
+    end = datetime.strptime(args.end, "%Y-%m-%d").timestamp() if args.end else None
+    timeline, stats = replay(args.config, args.db, start=start, end=end)
+
+    print(
+        "Replayed {} readings ({:.1f} days) in {:.2f}s ({:.0f} readings/s): {} actuations".format(
+            stats["readings"],
+            stats.get("simulated_days", 0.0),
+            stats["wall_sec"],
+            stats.get("readings_per_sec", 0.0),
+            stats.get("actuations", 0),
+        )
+    )
+    if timeline:
+        print("{:<12} {:>12} {:>10}".format("instrument", "actuations", "on (h)"))
+        for name, entry in sorted(summarize(timeline, end or timeline[-1]["timestamp"]).items()):
+            print("{:<12} {:>12} {:>10.1f}".format(name, entry["actuations"], entry["on_hours"]))
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["timestamp", "time", "instrument", "state", "duration_sec"])
+            writer.writeheader()
+            for event in timeline:
+                writer.writerow({**event, "time": datetime.fromtimestamp(event["timestamp"]).isoformat(sep=" ")})
+        print("Wrote {} actuations to {}".format(len(timeline), args.output))
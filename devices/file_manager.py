@@ -55,35 +55,36 @@ class FileManager:
             if total_size > self.size_limit:
                 i = 0
                 files = list(sorted_file_modified.keys())
-                while total_size > self.size_limit:
-                    _file = files[i]
-                    _file_stem = Path(_file).name
-
+                removed_names = []
+                try:
+                    while total_size > self.size_limit:
+                        if i >= len(files):
+                            raise ValueError(
+                                "Iterator shouldn't exceed total size of entire directory"
+                            )
+
+                        _file = files[i]
+                        _file_stem = Path(_file).name
+
+                        logger.info(f"Removing image {_file_stem}")
+                        os.remove(_file)
+                        removed_names.append(_file_stem)
+
+                        total_size -= file_sizes.pop(_file)
+                        i += 1
+                finally:
+                    # Deactivate every evicted image in a single transaction:
                     if db_handler:
-                        db_handler.record_delete_image(_file_stem)
-
-                    logger.info(f"Removing image {_file_stem}")
-                    os.remove(_file)
-
-                    del file_sizes[_file]
-                    #print(len(file_sizes))
-                    #del sorted_file_modified[_file]
-
-                    i += 1
-
-                    if i > len(files):
-                        raise ValueError(
-                            "Iterator shouldn't exceed total size of entire directory"
-                        )
-                    
-                    total_size = sum(list(file_sizes.values()))
-                    #print(total_size)
+                        db_handler.record_delete_images(removed_names)
             else:
                 logger.info(f"Files not big enough: {total_size}")
             self.last_datetime = current_time
 
 
-def exec_manager(image_folder:str, db_handler: DatabaseHandler):
+def exec_manager(image_folder:str, db_file_path: str):
+    # Runs in its own process, so open a separate handler rather than sharing
+    # the parent's connections; WAL mode lets both processes write.
+    db_handler = DatabaseHandler(db_file_path)
     file_manager = FileManager(image_folder)
     while True:
         file_manager.probe(db_handler=db_handler)
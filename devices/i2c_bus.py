@@ -0,0 +1,415 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from threading import RLock
+from types import SimpleNamespace
+from typing import *
+from loguru import logger
+
+from devices.metrics import metrics
+
+"""
+Bus access for the I2C sensors.
+
+Every sensor behind the TCA9548A shares one physical bus, and selecting a
+multiplexer channel is only safe if nothing else talks on that bus until the
+read is done. Each bus therefore gets a single worker thread that runs all of
+its reads, and the channel is selected under a lock. Devices that are not on an
+I2C bus (cameras) run on a separate pool, so they never wait on a bus.
+
+Drivers do not open the bus or the multiplexer themselves. They borrow a
+handle from `i2c_registry`, which opens each physical bus once per process and
+keeps track of which channel every multiplexer on it has selected. A read on
+the channel that is already selected therefore skips the select write, and
+several multiplexers (side by side or chained behind each other's channels)
+can share one bus without their channels clashing.
+"""
+
+DEFAULT_BUS = "i2c-1"  # board.SCL / board.SDA on the Raspberry Pi
+DEFAULT_MULTIPLEXER = 0x70  # TCA9548A address with A0-A2 low
+OFF = -1  # `SharedI2CBus.selected` of a multiplexer with every channel switched off
+
+
+class I2CBus:
+    """A physical I2C bus with one worker thread that runs every read on it.
+
+    The worker does not select multiplexer channels itself; the drivers do that
+    through their `i2c_registry` handles. `order` uses the registry's view of
+    what every multiplexer has selected to sequence a sweep.
+
+    Args:
+        name (str): Name of the bus (ex: `"i2c-1"`).
+
+    Example:
+        >>> bus = I2CBus("i2c-1")
+        >>> future = bus.submit(temperature_sensor, name="main_temp_sensor_1")
+        >>> future.result()
+        (datetime(...), {'temperature': 72.1, 'relative_humidity': 40.2})
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = RLock()  # held for the whole read
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def _read(self, read_fn: Callable[[], Dict], name: str) -> Tuple[datetime, Dict]:
+        with self.lock:
+            timestamp = datetime.now()
+            with metrics.timer("read.{}".format(name)):
+                return timestamp, read_fn()
+
+    def submit(self, read_fn: Callable[[], Dict], name: Optional[str] = None) -> Future:
+        """Queue a read on this bus.
+
+        Args:
+            read_fn (Callable): Performs the read and returns the reading.
+            name (str, optional): Name the read latency is recorded under. Defaults to the bus name.
+
+        Returns:
+            Future: Resolves to `(timestamp, reading)`; the timestamp is taken when the read starts.
+        """
+        return self._executor.submit(self._read, read_fn, self.name if name is None else name)
+
+    def order(self, selections: List[List[Tuple[int, int]]]) -> List[int]:
+        """Order in which reads should run to write to the multiplexers as little as possible.
+
+        Starting from the channels the multiplexers on this bus have selected
+        (as tracked by `i2c_registry`), the read needing the fewest select writes
+        goes next, ties in the order given. A device that reads several channels
+        (the fused light sensor) is costed over all of them.
+
+        Args:
+            selections (List[List[Tuple[int, int]]]): `(multiplexer, channel)` pairs each device
+                reads from, in read order (empty for devices wired to the bus directly).
+
+        Returns:
+            List[int]: Indices into `selections`.
+        """
+        shared = i2c_registry.buses.get(self.name, None)  # not opened with fake devices
+        selected = {} if shared is None else dict(shared.selected)
+
+        def plan(idx: int, state: Dict[int, Optional[int]]) -> int:
+            writes = 0
+            for multiplexer, channel in selections[idx]:
+                if shared is None:
+                    if state.get(multiplexer, None) != channel:
+                        state[multiplexer] = channel
+                        writes += 1
+                else:
+                    path = shared.path(multiplexer, channel, register=False)
+                    writes += len(shared.plan(path, state)[0])
+            return writes
+
+        remaining = list(range(len(selections)))
+        order = []
+        while remaining:
+            best = min(remaining, key=lambda idx: plan(idx, dict(selected)))
+            plan(best, selected)
+            remaining.remove(best)
+            order.append(best)
+        return order
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class I2CBusPool:
+    """Routes device reads to the worker of the bus they sit on.
+
+    Devices in the sensor tree carry `bus` (None if not on an I2C bus) and
+    `selections` (the `(multiplexer, channel)` pairs they read from, empty if
+    wired directly). Reads on different
+    buses, and reads of off-bus devices such as cameras, run in parallel; reads
+    on the same bus run one at a time.
+
+    Args:
+        io_workers (int, optional): Threads for devices that are not on an I2C bus. Defaults to 2.
+
+    Example:
+        >>> pool = I2CBusPool()
+        >>> readings = pool.sweep([("main_temp_sensor_1", sensor_tree["main_temp_sensor_1"])])
+        >>> readings["main_temp_sensor_1"]
+        (datetime(...), {'temperature': 72.1, 'relative_humidity': 40.2})
+    """
+
+    def __init__(self, io_workers: int = 2):
+        self.buses: Dict[str, I2CBus] = {}
+        self._io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io")
+
+    def bus(self, name: str) -> I2CBus:
+        """Return the bus called `name`, creating its worker on first use."""
+        if not (name in self.buses):
+            self.buses[name] = I2CBus(name)
+        return self.buses[name]
+
+    @staticmethod
+    def _read_io(device: SimpleNamespace, name: str) -> Tuple[datetime, Dict]:
+        timestamp = datetime.now()
+        with metrics.timer("read.{}".format(name)):
+            return timestamp, device.device()
+
+    def submit(self, device: SimpleNamespace, name: Optional[str] = None) -> Future:
+        """Queue one read of `device` (a sensor tree entry).
+
+        Args:
+            device (SimpleNamespace): Sensor tree entry.
+            name (str, optional): Device name the read latency is recorded under. Defaults to its type.
+
+        Returns:
+            Future: Resolves to `(timestamp, reading)`.
+        """
+        name = device.type if name is None else name
+        bus_name = getattr(device, "bus", None)
+        if bus_name is None:
+            return self._io_executor.submit(self._read_io, device, name)
+        return self.bus(bus_name).submit(device.device, name=name)
+
+    def sweep(
+        self, devices: List[Tuple[str, SimpleNamespace]], submit: Optional[Callable[..., Future]] = None
+    ) -> Dict[str, Tuple[datetime, Dict]]:
+        """Read every device once and wait for all of them.
+
+        Reads are queued per bus in `I2CBus.order`, so the sweep takes as long as
+        the slowest bus rather than the sum of every read.
+
+        Args:
+            devices (List[Tuple[str, SimpleNamespace]]): `(name, sensor tree entry)` of each device to read.
+            submit (Callable, optional): Queues one read, with the signature of `submit`
+                (ex: `ReadingCache.submit`). Defaults to `submit`.
+
+        Returns:
+            Dict[str, Tuple[datetime, Dict]]: `(timestamp, reading)` per device name, in the order given.
+        """
+        submit = self.submit if submit is None else submit
+        start = time.perf_counter()
+        futures: Dict[str, Future] = {}
+        by_bus: Dict[Optional[str], List[Tuple[str, SimpleNamespace]]] = {}
+        for name, device in devices:
+            by_bus.setdefault(getattr(device, "bus", None), []).append((name, device))
+
+        for bus_name, entries in by_bus.items():
+            if bus_name is not None:
+                selections = [getattr(device, "selections", []) for _, device in entries]
+                entries = [entries[idx] for idx in self.bus(bus_name).order(selections)]
+            for name, device in entries:
+                futures[name] = submit(device, name=name)
+
+        readings = {name: futures[name].result() for name, _ in devices}
+        logger.debug("Read {} devices on {} buses in {:.3f}s".format(len(devices), len(by_bus), time.perf_counter() - start))
+        return readings
+
+    def shutdown(self) -> None:
+        """Stop every worker; queued reads are cancelled."""
+        for bus in self.buses.values():
+            bus.shutdown()
+        self._io_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------------------------------------------------------------------------
+# Shared bus and multiplexer registry
+# ---------------------------------------------------------------------------
+
+
+def _open_bus(name: str) -> Any:
+    # Imported here so the loop can run with fake devices on machines without Blinka:
+    import board
+    import busio
+
+    if name == DEFAULT_BUS:
+        return busio.I2C(board.SCL, board.SDA)
+    try:
+        from adafruit_extended_bus import ExtendedI2C
+    except ImportError as e:
+        raise ImportError(
+            "I2C bus {} needs the adafruit-extended-bus package (pip install -r requirements.txt); "
+            "only {} works without it".format(name, DEFAULT_BUS)
+        ) from e
+
+    return ExtendedI2C(int(name.rsplit("-", 1)[-1]))
+
+
+class SharedI2CBus:
+    """One physical I2C bus and the multiplexers on it, opened once per process.
+
+    Multiplexers are identified by address. A multiplexer either sits on the
+    bus itself (`parent` None) or behind a channel of another multiplexer
+    (`parent` `(address, channel)`). `selected` caches the channel each
+    multiplexer has switched on (`OFF` for none, None until first written). Selecting a channel writes only to the
+    multiplexers whose state has to change, and it switches off the other
+    multiplexers on the same segment so that devices with the same address
+    behind them do not answer together.
+
+    Args:
+        name (str): Name of the bus (ex: `"i2c-1"`).
+        i2c (Any, optional): Opened bus object (`busio.I2C`). Defaults to opening `name`.
+    """
+
+    def __init__(self, name: str, i2c: Any = None):
+        self.name = name
+        self.i2c = i2c if i2c is not None else _open_bus(name)
+        self.parents: Dict[int, Optional[Tuple[int, int]]] = {}
+        self.selected: Dict[int, Optional[int]] = {}
+        self.select_writes = 0
+        self.select_skips = 0
+
+    def add_multiplexer(self, address: int = DEFAULT_MULTIPLEXER, parent: Optional[Tuple[int, int]] = None) -> None:
+        """Register a multiplexer at `address`, on the bus or behind `parent` `(address, channel)`."""
+        if parent is not None and not (parent[0] in self.parents):
+            raise ValueError("Multiplexer {} is chained behind unknown multiplexer {}".format(hex(address), hex(parent[0])))
+        if address in self.parents and self.parents[address] != parent:
+            raise ValueError("Multiplexer {} is already registered on {}".format(hex(address), self.name))
+        if not (address in self.parents):
+            self.parents[address] = parent
+            self.selected[address] = None  # unknown until first written
+            logger.info("Registered multiplexer {} on {}".format(hex(address), self.name))
+
+    def path(self, address: int, channel: int, register: bool = True) -> Tuple[Tuple[int, int], ...]:
+        """Chain of `(multiplexer, channel)` selections from the bus down to `channel` of `address`.
+
+        An unknown multiplexer is registered on the bus itself, unless `register` is False.
+        """
+        if not (address in self.parents):
+            if not register:
+                return ((address, channel),)
+            self.add_multiplexer(address)
+        chain = [(address, channel)]
+        while self.parents[chain[-1][0]] is not None:
+            chain.append(self.parents[chain[-1][0]])
+        return tuple(reversed(chain))
+
+    def plan(
+        self, path: Tuple[Tuple[int, int], ...], selected: Dict[int, Optional[int]]
+    ) -> Tuple[List[Tuple[int, int]], int]:
+        """Select writes that make the segment at the end of `path` reachable from the state `selected`.
+
+        `selected` is updated as if the writes were made.
+
+        Returns:
+            Tuple[List[Tuple[int, int]], int]: `(multiplexer, channel or OFF)` writes, in order, and the
+            number of selections along `path` that were already in place.
+        """
+        writes, skips = [], 0
+        parent = None
+        for address, channel in path + ((None, None),):
+            # Other multiplexers on this segment must be off so their devices stay quiet:
+            for other, other_parent in self.parents.items():
+                if other != address and other_parent == parent and selected.get(other, None) != OFF:
+                    writes.append((other, OFF))
+                    selected[other] = OFF
+            if address is None:
+                return writes, skips
+            if selected.get(address, None) == channel:
+                skips += 1
+            else:
+                writes.append((address, channel))
+                selected[address] = channel
+            parent = (address, channel)
+
+    def select(self, path: Tuple[Tuple[int, int], ...]) -> None:
+        """Make the segment at the end of `path` reachable (an empty path is the bus itself).
+
+        Must be called with the bus locked.
+        """
+        writes, skips = self.plan(path, dict(self.selected))
+        for address, channel in writes:
+            self.i2c.writeto(address, bytes([0 if channel == OFF else 1 << channel]))
+            self.selected[address] = channel  # only once the write went through
+        self.select_writes += len(writes)
+        self.select_skips += skips
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"select_writes": self.select_writes, "select_skips": self.select_skips}
+
+
+class I2CHandle:
+    """A driver's view of one bus segment; stands in for `busio.I2C` or a `TCA9548A` channel.
+
+    Locking the handle locks the shared bus and selects the segment through
+    `SharedI2CBus.select`. Unlocking leaves the channel selected, so the next
+    transaction on the same channel does not write to the multiplexer again.
+    """
+
+    def __init__(self, bus: SharedI2CBus, path: Tuple[Tuple[int, int], ...]):
+        self.bus = bus
+        self.path = path
+        self._multiplexers = set(address for address, _ in path)
+
+    def try_lock(self) -> bool:
+        while not self.bus.i2c.try_lock():
+            time.sleep(0)
+        try:
+            self.bus.select(self.path)
+        except Exception:
+            self.bus.i2c.unlock()
+            raise
+        return True
+
+    def unlock(self) -> None:
+        self.bus.i2c.unlock()
+
+    def _check(self, address: int) -> None:
+        if address in self._multiplexers:
+            raise ValueError("Device address must be different than the multiplexer address {}".format(hex(address)))
+
+    def readfrom_into(self, address: int, buffer: bytearray, **kwargs) -> None:
+        self._check(address)
+        return self.bus.i2c.readfrom_into(address, buffer, **kwargs)
+
+    def writeto(self, address: int, buffer: bytes, **kwargs) -> None:
+        self._check(address)
+        return self.bus.i2c.writeto(address, buffer, **kwargs)
+
+    def writeto_then_readfrom(self, address: int, buffer_out: bytes, buffer_in: bytearray, **kwargs) -> None:
+        self._check(address)
+        return self.bus.i2c.writeto_then_readfrom(address, buffer_out, buffer_in, **kwargs)
+
+    def scan(self) -> List[int]:
+        """Addresses that answer on this segment (multiplexers excluded)."""
+        return [address for address in self.bus.i2c.scan() if not (address in self.bus.parents)]
+
+
+class I2CRegistry:
+    """Process-wide registry of shared buses; drivers borrow handles from it.
+
+    Example:
+        >>> i2c_registry.add_multiplexer("i2c-1", 0x71, parent=(0x70, 7))  # second TCA9548A behind channel 7
+        >>> sensor = sht31d.SHT31D(i2c_registry.handle("i2c-1", channel=6))
+        >>> soil = Seesaw(i2c_registry.handle("i2c-1", channel=2, multiplexer=0x71))
+        >>> i2c_registry.stats()
+        {'i2c-1': {'select_writes': 3, 'select_skips': 41}}
+    """
+
+    def __init__(self):
+        self.buses: Dict[str, SharedI2CBus] = {}
+        self._lock = RLock()
+
+    def bus(self, name: str = DEFAULT_BUS) -> SharedI2CBus:
+        """Return the bus called `name`, opening it on first use."""
+        with self._lock:
+            if not (name in self.buses):
+                self.buses[name] = SharedI2CBus(name)
+            return self.buses[name]
+
+    def add_multiplexer(
+        self, bus_name: str, address: int = DEFAULT_MULTIPLEXER, parent: Optional[Tuple[int, int]] = None
+    ) -> None:
+        """Register a multiplexer; see `SharedI2CBus.add_multiplexer`."""
+        with self._lock:
+            self.bus(bus_name).add_multiplexer(address, parent=parent)
+
+    def handle(
+        self, bus_name: str = DEFAULT_BUS, channel: Optional[int] = None, multiplexer: int = DEFAULT_MULTIPLEXER
+    ) -> I2CHandle:
+        """Handle for a device on `channel` of `multiplexer`, or on the bus itself if `channel` is None."""
+        with self._lock:
+            bus = self.bus(bus_name)
+            return I2CHandle(bus, () if channel is None else bus.path(multiplexer, channel))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: bus.stats for name, bus in self.buses.items()}
+
+
+# Shared by every driver in the process:
+i2c_registry = I2CRegistry()
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import *
+from loguru import logger
+
+"""
+Latency histograms for the control loop.
+
+Every timed section of the loop (a tick, a sensor read, an instrument trigger,
+a database write, how late a scheduler fired) records its duration into a
+histogram with fixed, log-spaced buckets. Recording is a bisect and a few
+additions, so it can stay on in production. The loop logs a summary of the
+last interval every `report_interval_sec` and writes a snapshot to
+`snapshot_path`, which `python devices/metrics.py` prints while the greenhouse runs.
+
+Histogram names use a `<kind>.<name>` convention:
+
+    loop.tick                          one pass of the main loop
+    loop.dispatch                      one event-bus dispatch (asyncio runtime)
+    read.main_temp_sensor_1            one sensor read
+    trigger.fan_1                      one instrument trigger
+    db.write                           one database call from the loop (includes queueing)
+    db.commit                          one database transaction
+    lateness.sensor/main_temp_sensor_1/0   how late a scheduler ran after its fire time
+"""
+
+# Bucket upper bounds in seconds: 10 µs to ~6 min, four buckets per doubling.
+BUCKET_BOUNDS = [1e-5 * 2 ** (i / 4) for i in range(100)]
+
+
+class Histogram:
+    """Counts of observed durations in log-spaced buckets.
+
+    Percentiles are read from the buckets, so they are accurate to about 19%
+    (one bucket width); `max_sec` is exact.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # last bucket catches everything above the bounds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # State at the last report, so a report can cover just its interval:
+        self._mark_counts = list(self.counts)
+        self._mark_count = 0
+        self._mark_total = 0.0
+        self._window_max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds > self._window_max:
+            self._window_max = seconds
+
+    @staticmethod
+    def _quantile(counts: List[int], count: int, q: float, max_sec: float) -> float:
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for idx, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[idx], max_sec) if idx < len(BUCKET_BOUNDS) else max_sec
+        return max_sec
+
+    def summary(self, window: bool = False) -> Dict[str, float]:
+        """Count, mean, p50/p90/p99 and max in milliseconds.
+
+        Args:
+            window (bool, optional): Only cover observations since the last `mark()`. Defaults to False.
+        """
+        if window:
+            counts = [now - then for now, then in zip(self.counts, self._mark_counts)]
+            count, total, max_sec = self.count - self._mark_count, self.total - self._mark_total, self._window_max
+        else:
+            counts, count, total, max_sec = self.counts, self.count, self.total, self.max
+        return {
+            "count": count,
+            "mean_ms": 1000 * total / count if count else 0.0,
+            "p50_ms": 1000 * self._quantile(counts, count, 0.50, max_sec),
+            "p90_ms": 1000 * self._quantile(counts, count, 0.90, max_sec),
+            "p99_ms": 1000 * self._quantile(counts, count, 0.99, max_sec),
+            "max_ms": 1000 * max_sec,
+        }
+
+    def mark(self) -> None:
+        """Start a new reporting window."""
+        self._mark_counts = list(self.counts)
+        self._mark_count = self.count
+        self._mark_total = self.total
+        self._window_max = 0.0
+
+
+class Metrics:
+    """Named histograms for the control loop, with a periodic summary and a snapshot file.
+
+    Args:
+        report_interval_sec (float, optional): Seconds between summaries. Defaults to 300.
+        snapshot_path (str, optional): JSON file the snapshot is written to with every summary.
+            Defaults to None (no file).
+        enabled (bool, optional): Record observations. Defaults to True.
+
+    Example:
+        >>> metrics = Metrics(report_interval_sec=60, snapshot_path="./logs/metrics.json")
+        >>> with metrics.timer("read.main_temp_sensor_1"):
+        ...     reading = sensor()
+        >>> metrics.snapshot()["histograms"]["read.main_temp_sensor_1"]["total"]["count"]
+        1
+    """
+
+    def __init__(self, report_interval_sec: float = 300.0, snapshot_path: Optional[str] = None, enabled: bool = True):
+        self.report_interval_sec = report_interval_sec
+        self.snapshot_path = snapshot_path
+        self.enabled = enabled
+        self.histograms: Dict[str, Histogram] = {}
+        self.started = time.time()
+        self._last_report = time.monotonic()
+        self._lock = Lock()  # sensor reads and database writes are recorded from worker threads
+
+    def configure(self, report_interval_sec: float = 300.0, snapshot_path: Optional[str] = None, enabled: bool = True) -> None:
+        """Apply the `metrics` section of the configuration file."""
+        self.report_interval_sec = report_interval_sec
+        self.snapshot_path = snapshot_path
+        self.enabled = enabled
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record one duration (in seconds) under `name`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Record how long the `with` block takes under `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Summary of every histogram, both since startup (`total`) and since the last report (`window`)."""
+        with self._lock:
+            histograms = {
+                name: {"total": histogram.summary(), "window": histogram.summary(window=True)}
+                for name, histogram in sorted(self.histograms.items())
+            }
+        return {"started": self.started, "timestamp": time.time(), "histograms": histograms}
+
+    def report_if_due(self) -> bool:
+        """Log a summary and write the snapshot if `report_interval_sec` has passed.
+
+        Returns:
+            bool: True if a report was made.
+        """
+        if not self.enabled or time.monotonic() - self._last_report < self.report_interval_sec:
+            return False
+        self.report()
+        return True
+
+    def report(self) -> None:
+        """Log the slowest histograms of the last interval, write the snapshot and start a new interval."""
+        snapshot = self.snapshot()
+        rows = [(name, entry["window"]) for name, entry in snapshot["histograms"].items() if entry["window"]["count"]]
+        rows.sort(key=lambda row: row[1]["p99_ms"], reverse=True)
+        lines = ["{:<48} {:>7} {:>9} {:>9} {:>9}".format("histogram", "count", "p50 ms", "p99 ms", "max ms")]
+        for name, summary in rows:
+            lines.append(
+                "{:<48} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                    name, summary["count"], summary["p50_ms"], summary["p99_ms"], summary["max_ms"]
+                )
+            )
+        logger.info("Loop timing for the last {:.0f}s:\n{}".format(time.monotonic() - self._last_report, "\n".join(lines)))
+
+        if self.snapshot_path is not None:
+            # Write to a temporary file first so readers never see half a snapshot:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f, indent=1)
+            os.replace(tmp_path, self.snapshot_path)
+
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.mark()
+        self._last_report = time.monotonic()
+
+
+# Shared by the whole control loop, like loguru's `logger`:
+metrics = Metrics()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the latest loop timing snapshot.")
+    parser.add_argument("--snapshot", default="./logs/metrics.json", help="Snapshot written by the running greenhouse")
+    parser.add_argument("--prefix", default="", help="Only show histograms starting with this (ex: read.)")
+    parser.add_argument("--window", action="store_true", help="Show the last report interval instead of totals")
+    parser.add_argument("--sort", default="p99_ms", choices=["count", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"])
+    args = parser.parse_args()
+
+    snapshot = json.load(open(args.snapshot, "r"))
+    scope = "window" if args.window else "total"
+    rows = [(name, entry[scope]) for name, entry in snapshot["histograms"].items() if name.startswith(args.prefix)]
+    rows.sort(key=lambda row: row[1][args.sort], reverse=True)
+    print("{:<48} {:>8} {:>9} {:>9} {:>9} {:>9}".format("histogram", "count", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    for name, summary in rows:
+        print(
+            "{:<48} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                name, summary["count"], summary["mean_ms"], summary["p50_ms"], summary["p99_ms"], summary["max_ms"]
+            )
+        )
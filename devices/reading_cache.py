@@ -0,0 +1,141 @@
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from threading import RLock
+from types import SimpleNamespace
+from typing import *
+from loguru import logger
+
+from devices.i2c_bus import I2CBusPool
+
+"""
+Shared cache of the latest reading of every sensor.
+
+Scheduled polls and anything else that wants current conditions (the status
+log, a dashboard) read sensors through the cache instead of calling the device
+directly. A reading younger than the sensor's max age is served from memory.
+Older readings are refreshed on the sensor's bus worker, and every caller that
+misses while that read is in flight waits on the same read rather than issuing
+its own, so the I2C load stays the same however often the cache is read.
+
+Cameras are not cached: a camera "reading" takes and saves a photo.
+"""
+
+
+class ReadingCache:
+    """Latest `(timestamp, reading)` of each sensor, refreshed at most once per max age.
+
+    Args:
+        sensor_tree (Dict[str, SimpleNamespace]): Sensor tree from `initialize_from_config`.
+        bus_pool (I2CBusPool): Bus workers that run the hardware reads.
+        max_age_sec (float, optional): Oldest reading `get` serves without a new read. Defaults to 10.0.
+        max_ages (Dict[str, float], optional): Max age per sensor name, overriding `max_age_sec`. Defaults to None.
+        clock (Callable[[], float], optional): Time source in seconds. Defaults to `time.time`.
+
+    Example:
+        >>> cache = ReadingCache(sensor_tree, I2CBusPool(), max_age_sec=10.0)
+        >>> cache.get("main_temp_sensor_1")  # reads the sensor
+        (datetime(...), {'temperature': 72.1, 'relative_humidity': 40.2})
+        >>> cache.get("main_temp_sensor_1")  # served from memory
+        (datetime(...), {'temperature': 72.1, 'relative_humidity': 40.2})
+    """
+
+    def __init__(
+        self,
+        sensor_tree: Dict[str, SimpleNamespace],
+        bus_pool: I2CBusPool,
+        max_age_sec: float = 10.0,
+        max_ages: Optional[Dict[str, float]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.sensor_tree = sensor_tree
+        self.bus_pool = bus_pool
+        self.max_age_sec = max_age_sec
+        self.max_ages = max_ages or {}
+        self.clock = clock
+        self._entries: Dict[str, Tuple[float, datetime, Dict]] = {}  # name -> (clock time, timestamp, reading)
+        self._inflight: Dict[str, Future] = {}
+        self._lock = RLock()  # a read that is already done runs its callback inside submit()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def set_clock(self, clock: Callable[[], float]) -> None:
+        self.clock = clock
+
+    def max_age(self, name: str) -> float:
+        # A fused sensor ("light_sensor_1+light_sensor_2") is as fresh as its most demanding part:
+        return min(self.max_ages.get(part, self.max_age_sec) for part in name.split("+"))
+
+    def _store(self, name: str, future: Future) -> None:
+        with self._lock:
+            if self._inflight.get(name) is future:
+                del self._inflight[name]
+            if future.cancelled() or future.exception() is not None:
+                return
+            timestamp, reading = future.result()
+            self._entries[name] = (self.clock(), timestamp, reading)
+
+    def submit(self, device: SimpleNamespace, name: str) -> Future:
+        """Read `device` on its bus worker now, or join the read of it that is already in flight.
+
+        Takes the place of `I2CBusPool.submit` for scheduled polls: the reading
+        they get also refreshes the cache. Cameras go straight to the bus pool.
+
+        Returns:
+            Future: Resolves to `(timestamp, reading)`.
+        """
+        if device.type == "camera":
+            return self.bus_pool.submit(device, name=name)
+        with self._lock:
+            if name in self._inflight:
+                self.coalesced += 1
+                logger.debug("Joining the read of {} already in flight".format(name))
+                return self._inflight[name]
+            future = self.bus_pool.submit(device, name=name)
+            self._inflight[name] = future
+            future.add_done_callback(lambda done: self._store(name, done))
+            return future
+
+    def get(self, name: str, max_age_sec: Optional[float] = None) -> Tuple[datetime, Dict]:
+        """Latest reading of sensor `name`, read from the sensor only if the cached one is too old.
+
+        Args:
+            name (str): Sensor name in the sensor tree.
+            max_age_sec (float, optional): Oldest reading to accept. Defaults to the sensor's max age.
+
+        Raises:
+            ValueError: If `name` is a camera.
+            KeyError: If `name` is not in the sensor tree.
+
+        Returns:
+            Tuple[datetime, Dict]: `(timestamp, reading)`; the timestamp is when the reading was taken.
+        """
+        device = self.sensor_tree[name]
+        if device.type == "camera":
+            raise ValueError("{} is a camera; cameras are not cached".format(name))
+        max_age_sec = self.max_age(name) if max_age_sec is None else max_age_sec
+        with self._lock:
+            entry = self._entries.get(name, None)
+            if entry is not None and self.clock() - entry[0] <= max_age_sec:
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+            future = self.submit(device, name)
+        return future.result()  # waited on outside the lock so other sensors stay readable
+
+    def peek(self, name: str) -> Optional[Tuple[datetime, Dict]]:
+        """Cached `(timestamp, reading)` of sensor `name` however old it is, without reading the sensor."""
+        with self._lock:
+            entry = self._entries.get(name, None)
+        return None if entry is None else (entry[1], entry[2])
+
+    def age(self, name: str) -> Optional[float]:
+        """Seconds since the cached reading of `name` was stored (None if there is none)."""
+        with self._lock:
+            entry = self._entries.get(name, None)
+        return None if entry is None else self.clock() - entry[0]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "inflight": len(self._inflight)}
@@ -0,0 +1,274 @@
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import *
+from loguru import logger
+
+from devices.database import SQLiteAPI, ROLLUP_RESOLUTIONS
+
+"""
+Retention for the greenhouse database.
+
+Expired rows are removed (or moved into an archive database) in small chunks,
+and freed pages are handed back to the file system with incremental vacuum.
+All of the work happens inside `RetentionManager.step`, which stops as soon as
+its time budget is used up so it can be called from the main loop every tick.
+"""
+
+# How each table is scanned:
+#   time_column: column compared against the retention cutoff
+#   time_format: "text" for CURRENT_TIMESTAMP strings (UTC), "epoch" for REAL seconds
+#   key_columns: primary key columns (only used for series tables; scanned tables delete by rowid)
+#   device_column: column used for per-device windows (None if the table has no device)
+#   series: True if rows are found per device/key through an index instead of scanning in insertion order
+RETENTION_TABLES = {
+    "logs": dict(time_column="timestamp", time_format="text", key_columns=("id",), device_column="device", series=False),
+    "events": dict(time_column="timestamp", time_format="text", key_columns=("id",), device_column=None, series=False),
+    "images": dict(time_column="timestamp", time_format="text", key_columns=("id",), device_column=None, series=False),
+    "uptime": dict(time_column="last_seen", time_format="epoch", key_columns=("start",), device_column=None, series=False),
+    "sensor_readings": dict(time_column="timestamp", time_format="epoch", key_columns=("id",), device_column="device", series=True),
+}
+for _name in ROLLUP_RESOLUTIONS:
+    RETENTION_TABLES[f"sensor_rollup_{_name}"] = dict(
+        time_column="bucket", time_format="epoch", key_columns=("device", "key", "bucket"), device_column="device", series=True
+    )
+
+
+class RetentionManager:
+    """Deletes or archives expired rows from the greenhouse database in time-sliced steps.
+
+    Each configured table has a retention window in days, optionally overridden
+    per device. Once every `interval_sec` a pass walks the tables and removes
+    expired rows `chunk_rows` at a time (one transaction per chunk), copying
+    them into `archive_path` first when the table has `"archive": true`. A pass
+    ends with `PRAGMA incremental_vacuum` so the file actually shrinks.
+
+    Args:
+        db_file_path (str): Path to the SQLite database file.
+        tables (Dict): Per-table settings, ex: `{"sensor_readings": {"days": 180, "devices": {"light_sensor_1": 30}, "archive": true}}`.
+        archive_path (str, optional): Database file that archived rows are moved into. Defaults to None (no archiving).
+        step_ms (float, optional): Time budget of a single `step()` call in milliseconds. Defaults to 5.
+        chunk_rows (int, optional): Rows removed per transaction. Defaults to 200.
+        vacuum_pages (int, optional): Free pages released per incremental vacuum call. Defaults to 64.
+        interval_sec (float, optional): Seconds between the start of retention passes. Defaults to 3600.
+
+    Raises:
+        ValueError: If a configured table is not supported.
+
+    Example:
+        >>> retention = RetentionManager("./logs/internal.db", {"events": {"days": 7}})
+        >>> while True:
+        ...     retention.step()  # never takes much more than step_ms
+    """
+
+    def __init__(
+        self,
+        db_file_path: str,
+        tables: Dict[str, Dict],
+        archive_path: Optional[str] = None,
+        step_ms: float = 5.0,
+        chunk_rows: int = 200,
+        vacuum_pages: int = 64,
+        interval_sec: float = 3600.0,
+    ):
+        for table in tables:
+            if not (table in RETENTION_TABLES):
+                raise ValueError(
+                    "{} is not a supported retention table. Supported tables: {}".format(
+                        table, ", ".join(RETENTION_TABLES)
+                    )
+                )
+        self.tables = tables
+        self.archive_path = archive_path
+        self.step_ms = step_ms
+        self.chunk_rows = chunk_rows
+        self.vacuum_pages = vacuum_pages
+        self.interval_sec = interval_sec
+
+        # Never wait on a writer for long; a locked step is simply retried next tick.
+        self.connector = SQLiteAPI(db_file_path, busy_timeout_ms=max(1, int(step_ms)))
+        if archive_path is not None and any(t.get("archive", False) for t in tables.values()):
+            self.connector.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+
+        auto_vacuum = self.connector.fetch_one("PRAGMA auto_vacuum")[0]
+        if auto_vacuum != 2:  # 2 == INCREMENTAL
+            logger.warning(
+                "Database auto_vacuum is not INCREMENTAL; deleted rows will be reused but the file will not shrink "
+                "until a one-off `PRAGMA auto_vacuum = INCREMENTAL; VACUUM;` is run"
+            )
+        self._vacuum = auto_vacuum == 2
+
+        self._next_pass = 0.0
+        self._tasks: List[Tuple[str, Any]] = []  # remaining work of the current pass
+        self._archived_tables: Set[str] = set()
+        self.removed = 0
+
+    def _cutoff(self, days: float, time_format: str, now: float) -> Union[str, float]:
+        cutoff = now - days * 86400
+        if time_format == "text":
+            return datetime.fromtimestamp(cutoff, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        return cutoff
+
+    def _start_pass(self) -> None:
+        now = time.time()
+        for table, settings in self.tables.items():
+            spec = RETENTION_TABLES[table]
+            cutoffs = {
+                device: self._cutoff(days, spec["time_format"], now)
+                for device, days in settings.get("devices", {}).items()
+            }
+            default_cutoff = None
+            if settings.get("days") is not None:
+                default_cutoff = self._cutoff(settings["days"], spec["time_format"], now)
+
+            if spec["series"]:
+                # One indexed range per device (and key, for rollups), found one at a time by `_next_series`:
+                if default_cutoff is not None or cutoffs:
+                    self._tasks.append(("series", [table, default_cutoff, cutoffs, None]))
+            else:
+                if spec["device_column"] is None and cutoffs:
+                    logger.warning("{} has no device column; ignoring per-device retention".format(table))
+                # Rows are stored in insertion (time) order, so the scan can stop at the first
+                # row younger than the newest cutoff; the cursor skips rows kept by a longer window.
+                all_cutoffs = [c for c in [default_cutoff, *cutoffs.values()] if c is not None]
+                if all_cutoffs:
+                    self._tasks.append(("scan", [table, default_cutoff, cutoffs, max(all_cutoffs), None]))
+
+        if self._vacuum:
+            self._tasks.append(("vacuum", None))
+
+    def _next_series(self, table: str, series: Optional[Tuple[str, ...]]) -> Optional[Tuple[str, ...]]:
+        """The series after `series` (the first one if None), or None after the last one.
+
+        Skip-scans the table's device index (primary key for rollups) with MIN()
+        lookups, so every call is a couple of index seeks however large the table is.
+        """
+        if table == "sensor_readings":
+            device = self.connector.fetch_one(
+                f"SELECT MIN(device) FROM {table} WHERE device > ?", ("" if series is None else series[0],)
+            )[0]
+            return None if device is None else (device,)
+
+        if series is not None:
+            key = self.connector.fetch_one(
+                f"SELECT MIN(key) FROM {table} WHERE device = ? AND key > ?", series
+            )[0]
+            if key is not None:
+                return (series[0], key)
+        device = self.connector.fetch_one(
+            f"SELECT MIN(device) FROM {table} WHERE device > ?", ("" if series is None else series[0],)
+        )[0]
+        if device is None:
+            return None
+        key = self.connector.fetch_one(f"SELECT MIN(key) FROM {table} WHERE device = ?", (device,))[0]
+        return (device, key)
+
+    def _remove(self, table: str, keys: List[Tuple[Any, ...]], key_columns: Tuple[str, ...]) -> None:
+        """Archive (if configured) and delete the given rows in one transaction."""
+        where = " AND ".join(f"{col} = ?" for col in key_columns)
+        statements = []
+        if self.archive_path is not None and self.tables[table].get("archive", False):
+            if not (table in self._archived_tables):
+                self.connector.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0")
+                self._archived_tables.add(table)
+            statements.append((f"INSERT INTO archive.{table} SELECT * FROM main.{table} WHERE {where}", keys))
+        statements.append((f"DELETE FROM main.{table} WHERE {where}", keys))
+        self.connector.execute_batch(statements)
+        self.removed += len(keys)
+
+    def _run_series(self, task: List[Any]) -> bool:
+        table, default_cutoff, cutoffs, series = task
+        if series is not None:
+            cutoff = cutoffs.get(series[0], default_cutoff)
+            if cutoff is not None:
+                spec = RETENTION_TABLES[table]
+                key_columns = ", ".join(spec["key_columns"])
+                where = "device = ?" + (" AND key = ?" if len(series) > 1 else "")
+                rows = self.connector.fetch_all(
+                    f"SELECT {key_columns} FROM {table} WHERE {where} AND {spec['time_column']} < ? LIMIT ?",
+                    (*series, cutoff, self.chunk_rows),
+                )
+                if rows:
+                    self._remove(table, [tuple(row) for row in rows], spec["key_columns"])
+                if len(rows) == self.chunk_rows:
+                    return False  # more expired rows in this series
+
+        task[3] = self._next_series(table, series)
+        return task[3] is None
+
+    def _run_scan(self, task: List[Any]) -> bool:
+        table, default_cutoff, cutoffs, newest_cutoff, cursor = task
+        spec = RETENTION_TABLES[table]
+        device_column = spec["device_column"] or "NULL"
+        rows = self.connector.fetch_all(
+            f"""
+            SELECT rowid, {spec['time_column']}, {device_column} FROM {table}
+            WHERE rowid > ? ORDER BY rowid LIMIT ?
+            """,
+            (cursor if cursor is not None else -1, self.chunk_rows),
+        )
+        expired = []
+        done = len(rows) < self.chunk_rows
+        for rowid, timestamp, device in rows:
+            if timestamp is None:
+                task[4] = rowid  # its age is unknown; keep it and move past it
+                continue
+            if timestamp >= newest_cutoff:
+                done = True
+                break
+            cutoff = cutoffs.get(device, default_cutoff)
+            if cutoff is not None and timestamp < cutoff:
+                expired.append((rowid,))
+            else:
+                task[4] = rowid  # kept by a longer window; skip it from now on
+
+        if expired:
+            self._remove(table, expired, ("rowid",))
+        return done
+
+    def step(self, budget_ms: Optional[float] = None) -> int:
+        """Do retention work until the time budget is used up.
+
+        Args:
+            budget_ms (float, optional): Time budget in milliseconds. Defaults to `step_ms`.
+
+        Returns:
+            int: Rows removed during this step.
+        """
+        now = time.monotonic()
+        if not self._tasks:
+            if now < self._next_pass:
+                return 0
+            self._next_pass = now + self.interval_sec
+            self._start_pass()
+
+        budget = (self.step_ms if budget_ms is None else budget_ms) / 1000.0
+        deadline = time.perf_counter() + budget
+        removed_before = self.removed
+        try:
+            while self._tasks and time.perf_counter() < deadline:
+                kind, task = self._tasks[0]
+                if kind == "series":
+                    done = self._run_series(task)
+                elif kind == "scan":
+                    done = self._run_scan(task)
+                else:
+                    # Pages are only freed as the pragma is stepped, so drain it:
+                    self.connector.fetch_all("PRAGMA incremental_vacuum({})".format(self.vacuum_pages))
+                    self.connector.connection.commit()
+                    free_pages = self.connector.fetch_one("PRAGMA freelist_count")[0]
+                    done = free_pages == 0
+                if done:
+                    self._tasks.pop(0)
+        except sqlite3.OperationalError as e:
+            # Most likely the writer holds the lock; try again on the next step.
+            logger.debug("Retention step skipped: {}".format(e))
+
+        removed = self.removed - removed_before
+        if removed > 0:
+            logger.debug("Retention removed {} rows".format(removed))
+        return removed
+
+    def close(self) -> None:
+        """Close the retention database connection."""
+        self.connector.close()
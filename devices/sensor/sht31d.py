@@ -1,11 +1,13 @@
 import adafruit_sht31d as sht31d
-import board
 from typing import *
-import busio
 from loguru import logger
-import adafruit_tca9548a
 import random
 
+from devices.i2c_bus import i2c_registry, DEFAULT_BUS, DEFAULT_MULTIPLEXER
+
+# Sampling rates (Hz) the SHT31D supports in periodic mode:
+PERIODIC_FREQUENCIES = [0.5, 1, 2, 4, 10]
+
 class TemperatureSensor:
     """
     Interface for an SHT31D temperature and humidity sensor.
@@ -14,6 +16,12 @@ class TemperatureSensor:
     temperature (in Celsius or Fahrenheit) and relative humidity readings.
     It also supports usage with a TCA9548A multiplexer for multi-channel setups.
 
+    Calling the sensor takes one measurement and returns both values. By default
+    every call is a single-shot measurement (about 15 ms). With `periodic_hz`,
+    the SHT31D samples on its own at that rate and a call only fetches the
+    latest sample; calls within the same sample period reuse it without
+    touching the bus.
+
     Args:
         address (int): The I2C address of the sensor or multiplexer channel.
         description (str): A user-defined description of the sensor.
@@ -23,9 +31,14 @@ class TemperatureSensor:
             raise an exception. Default is True.
         use_multi_channel (bool, optional): If True, attempts connection through a
             TCA9548A multiplexer. Default is False.
+        i2c_bus (str, optional): Bus the sensor is wired to. Default is `"i2c-1"`.
+        multiplexer (int, optional): Address of the TCA9548A the sensor sits behind
+            (when `use_multi_channel`). Default is `0x70`.
+        periodic_hz (float, optional): Let the sensor sample in the background at this
+            rate (0.5, 1, 2, 4 or 10). Default is None (single-shot measurements).
 
     Raises:
-        ValueError: If an unsupported temperature unit is provided.
+        ValueError: If an unsupported temperature unit or sampling rate is provided.
         Exception: If connection fails and `skip_on_fail` is False.
 
     Example:
@@ -36,6 +49,9 @@ class TemperatureSensor:
         22.5
         >>> sensor.relative_humidity
         45.3
+        >>> sensor = TemperatureSensor(address=6, description="Greenhouse sensor", use_multi_channel=True, periodic_hz=1)
+        >>> sensor()
+        {'temperature': 22.5, 'relative_humidity': 45.3}
     """
 
     def __init__(
@@ -45,7 +61,10 @@ class TemperatureSensor:
         temp_unit: Literal["celsius", "fahrenheit"] = "celsius",
         skip_on_fail=True,
         use_multi_channel=False,
-        fake_data=False
+        fake_data=False,
+        i2c_bus: str = DEFAULT_BUS,
+        multiplexer: int = DEFAULT_MULTIPLEXER,
+        periodic_hz: Optional[float] = None,
     ):
         # Check if given temperature unit is valid
         self.__sunits__ = ["celsius", "fahrenheit"]
@@ -55,6 +74,12 @@ class TemperatureSensor:
                     temp_unit, *self.__sunits__
                 )
             )
+        if periodic_hz is not None and not (periodic_hz in PERIODIC_FREQUENCIES):
+            raise ValueError(
+                "{} is not a valid sampling rate. Supported rates (Hz): {}".format(
+                    periodic_hz, ", ".join(str(hz) for hz in PERIODIC_FREQUENCIES)
+                )
+            )
 
         self.addr = address
         self.__desc__ = description
@@ -63,44 +88,39 @@ class TemperatureSensor:
         self._i2c_fail = False
         self.use_multi = use_multi_channel
         self.fake_data = fake_data
+        self.i2c_bus = i2c_bus
+        self.multiplexer = multiplexer
+        self.periodic_hz = periodic_hz
 
-        # Connect to temp sensor:
+        # Connect to temp sensor; the probe's reading is the bad first data we push off:
         if not self.fake_data:
             self.__connect__()
-            self.__init_probe__()
-    
-        # Push off bad first data:
-        if not self._i2c_fail:
-            _first_temp = self.temperature
-            _first_humd = self.relative_humidity
-            logger.debug(
-                "Dumped first reading (temp: {} | rh: {})".format(
-                    _first_temp, _first_humd
-                )
-            )
+            if not self._i2c_fail:
+                self.__init_probe__()
+                self.__start_periodic__()
 
     def __connect__(self):
         """
         Establish I2C connection with the sensor.
 
         If `use_multi` is True, connects via a TCA9548A multiplexer channel.
-        Otherwise, connects directly to the I2C bus.
+        Otherwise, connects directly to the I2C bus. Both are borrowed from the
+        shared `i2c_registry`.
 
         Raises:
             Exception: Re-raised if `skip_on_fail` is False and connection fails.
         """
         try:
             logger.info(
-                "Connecting (SCL:{} | SDA:{} | Address: {})".format(
-                    board.SCL, board.SDA, self.addr
+                "Connecting (Bus:{} | Address: {})".format(
+                    self.i2c_bus, self.addr
                 )
             )
-            self.i2c = busio.I2C(board.SCL, board.SDA)
-
             if self.use_multi:
-                self.tca = adafruit_tca9548a.TCA9548A(self.i2c)
-                self.sht31d = sht31d.SHT31D(self.tca[self.addr])
+                self.i2c = i2c_registry.handle(self.i2c_bus, channel=self.addr, multiplexer=self.multiplexer)
+                self.sht31d = sht31d.SHT31D(self.i2c)
             else:
+                self.i2c = i2c_registry.handle(self.i2c_bus)
                 self.sht31d = sht31d.SHT31D(self.i2c, address=self.addr)
         
         except Exception as e:
@@ -173,22 +193,26 @@ class TemperatureSensor:
 
     def __init_probe__(self, probe_attempts=5):
         """
-        Whether the sensor is successfully readable.
+        Take one measurement to check the sensor answers, and discard it
+        (the first reading after power-up is unreliable).
 
-        Returns:
-            bool: True if sensor is working, False if initialization failed.
+        Raises:
+            Exception: The last error if every attempt fails.
 
         Example:
             >>> sensor = TemperatureSensor(0x44, "Test sensor")
-            >>> sensor.readable
-            True
+            >>> sensor.__init_probe__()
         """
         successes = 0
         last_exception = None
         for i in range(probe_attempts):
             try:
-                _ = self.temperature
-                _ = self.relative_humidity
+                _first_temp, _first_humd = self.measure()
+                logger.debug(
+                    "Dumped first reading (temp: {} | rh: {})".format(
+                        _first_temp, _first_humd
+                    )
+                )
                 successes += 1
                 break
             except Exception as e:
@@ -198,7 +222,43 @@ class TemperatureSensor:
             logger.error("Failed to probe SHT31D properly...")
             raise last_exception
         else:
-            return None 
+            return None
+
+    def __start_periodic__(self):
+        """
+        Switch the sensor to periodic acquisition at `periodic_hz` (no-op in single-shot mode).
+        """
+        if self.periodic_hz is None:
+            return
+        self.sht31d.frequency = self.periodic_hz
+        self.sht31d.mode = sht31d.MODE_PERIODIC
+        logger.info("{} sampling in the background at {} Hz".format(self.__desc__, self.periodic_hz))
+
+    def measure(self) -> Tuple[float, float]:
+        """
+        One measurement of both values.
+
+        Returns:
+            Tuple[float, float]: Temperature (in `temp_unit`) and relative humidity.
+
+        Example:
+            >>> sensor = TemperatureSensor(0x44, "Test sensor")
+            >>> sensor.measure()
+            (22.5, 45.3)
+        """
+        if self.fake_data:
+            return random.random()*100.0, random.random()*100.0
+
+        # The driver's `temperature` and `relative_humidity` properties each run their own
+        # measurement; `_read` returns both from one (or the latest periodic sample):
+        _temp, _humd = self.sht31d._read()
+        if isinstance(_temp, list):
+            # A periodic fetch can return several buffered samples; the last is the newest
+            _temp, _humd = _temp[-1], _humd[-1]
+
+        if self.temp_unit == "fahrenheit":
+            _temp = (_temp * 1.8) + 32
+        return _temp, _humd
 
     @property
     def keys(self):
@@ -229,7 +289,8 @@ class TemperatureSensor:
             >>> sensor()
             {'temperature': 22.5, 'relative_humidity': 45.3}
         """
-        return {"temperature": self.temperature, "relative_humidity": self.relative_humidity}
+        _temp, _humd = self.measure()
+        return {"temperature": _temp, "relative_humidity": _humd}
 
 if __name__ == "__main__":
     import time
@@ -1,13 +1,12 @@
 from typing import *
-import board
-import busio
 from loguru import logger
 from adafruit_seesaw.seesaw import (
     Seesaw,
 )  # Generic soil sensor that can be used for Adafruit STEMMA soil sensor
-import adafruit_tca9548a
 import random
 
+from devices.i2c_bus import i2c_registry, DEFAULT_BUS, DEFAULT_MULTIPLEXER
+
 class SoilSensor:
     """A class for interfacing with Adafruit STEMMA-compatible soil sensors (Seesaw).
 
@@ -20,6 +19,8 @@ class SoilSensor:
         temp_unit (Literal["celsius", "fahrenheit"], optional): Unit for temperature readings. Defaults to `"celsius"`.
         skip_on_fail (bool, optional): Whether to skip sensor initialization errors instead of raising exceptions. Defaults to `True`.
         use_multi_channel (bool, optional): Whether to connect through a TCA9548A multiplexer. Defaults to `False`.
+        i2c_bus (str, optional): Bus the sensor is wired to. Defaults to `"i2c-1"`.
+        multiplexer (int, optional): Address of the TCA9548A the sensor sits behind. Defaults to `0x70`.
 
     Raises:
         ValueError: If an invalid temperature unit is provided.
@@ -41,7 +42,9 @@ class SoilSensor:
         temp_unit: Literal["celsius", "fahrenheit"] = "celsius",
         skip_on_fail=True,
         use_multi_channel=False,
-        fake_data=False
+        fake_data=False,
+        i2c_bus: str = DEFAULT_BUS,
+        multiplexer: int = DEFAULT_MULTIPLEXER,
     ):
         """Initializes the soil sensor and establishes an I²C connection.
 
@@ -51,6 +54,8 @@ class SoilSensor:
             temp_unit (Literal["celsius", "fahrenheit"], optional): Desired temperature unit. Defaults to `"celsius"`.
             skip_on_fail (bool, optional): Whether to suppress initialization errors. Defaults to `True`.
             use_multi_channel (bool, optional): Whether to use a TCA9548A multiplexer. Defaults to `False`.
+            i2c_bus (str, optional): Bus the sensor is wired to. Defaults to `"i2c-1"`.
+            multiplexer (int, optional): Address of the TCA9548A the sensor sits behind. Defaults to `0x70`.
 
         Raises:
             ValueError: If `temp_unit` is not `"celsius"` or `"fahrenheit"`.
@@ -76,6 +81,8 @@ class SoilSensor:
         self._i2c_fail = False
         self.use_multi = use_multi_channel
         self.fake_data = fake_data
+        self.i2c_bus = i2c_bus
+        self.multiplexer = multiplexer
 
         # Connect to soil sensor:
         if not self.fake_data:
@@ -84,30 +91,23 @@ class SoilSensor:
     def __connect__(self):
         """Initializes the I²C interface and connects to the soil sensor.
 
-        This method supports both direct and multi-channel (TCA9548A) connections.
+        This method supports both direct and multi-channel (TCA9548A) connections;
+        both are borrowed from the shared `i2c_registry`.
 
         Raises:
             Exception: If connection fails and `skip_on_fail` is `False`.
         """
-        
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.tca = adafruit_tca9548a.TCA9548A(self.i2c)
-        self.stemma_obj = Seesaw(self.tca[self.addr])
-        exit()
-
         try:
             logger.info(
-                "Connecting (SCL:{} | SDA:{} | Address: {})".format(
-                    board.SCL, board.SDA, self.addr
+                "Connecting (Bus:{} | Address: {})".format(
+                    self.i2c_bus, self.addr
                 )
             )
-            self.i2c = busio.I2C(board.SCL, board.SDA)
-            
             if self.use_multi:
-                self.tca = adafruit_tca9548a.TCA9548A(self.i2c)
-                self.stemma_obj = Seesaw(self.tca[self.addr])     
-                exit()
+                self.i2c = i2c_registry.handle(self.i2c_bus, channel=self.addr, multiplexer=self.multiplexer)
+                self.stemma_obj = Seesaw(self.i2c)
             else:
+                self.i2c = i2c_registry.handle(self.i2c_bus)
                 self.stemma_obj = Seesaw(self.i2c, addr=self.addr)
         
         except Exception as e:
@@ -1,26 +1,66 @@
 import os
 import sys
-import busio
-import board
 from adafruit_tsl2591 import TSL2591
 from loguru import logger
-import adafruit_tca9548a
 from typing import *
 import numpy as np
 import time
 import random
 
+from devices.i2c_bus import i2c_registry, DEFAULT_BUS, DEFAULT_MULTIPLEXER
+
+# Lux calculation constants of the TSL2591 (same as adafruit_tsl2591):
+LUX_DF = 408.0
+LUX_COEFB = 1.64
+LUX_COEFC = 0.59
+LUX_COEFD = 0.86
+MAX_COUNT_100MS = 36863
+MAX_COUNT = 65535
+GAIN_FACTORS = {0x00: 1.0, 0x10: 25.0, 0x20: 428.0, 0x30: 9876.0}  # GAIN_LOW, GAIN_MED, GAIN_HIGH, GAIN_MAX
+
+
+def light_values(raw: np.ndarray, cpl: np.ndarray, max_counts: np.ndarray) -> np.ndarray:
+    """Lux, infrared and full spectrum from raw channel readings, one row per sensor.
+
+    Args:
+        raw (np.ndarray): `(N, 2)` array of `(channel_0, channel_1)`, as returned by `raw_luminosity`.
+        cpl (np.ndarray): Counts per lux of each sensor (`atime * again / LUX_DF`).
+        max_counts (np.ndarray): Saturation count of each sensor.
+
+    Raises:
+        RuntimeError: If a channel of any sensor is saturated.
+
+    Returns:
+        np.ndarray: `(N, 3)` array of `lux`, `infrared`, `spectrum`. `spectrum` is packed like the
+        driver's `full_spectrum` (adafruit-circuitpython-tsl2591 1.4.4): `channel_1 << 16 | channel_0`.
+    """
+    channel_0, channel_1 = raw[:, 0], raw[:, 1]
+    if np.any(raw >= max_counts[:, None]):
+        raise RuntimeError(
+            "Overflow reading light channels!, Try to reduce the gain of\n "
+            + "the sensor using adafruit_tsl2591.GAIN_LOW"
+        )
+    lux1 = (channel_0 - LUX_COEFB * channel_1) / cpl
+    lux2 = (LUX_COEFC * channel_0 - LUX_COEFD * channel_1) / cpl
+    spectrum = channel_1 * 65536.0 + channel_0
+    return np.stack([np.maximum(lux1, lux2), channel_1, spectrum], axis=1)
+
+
 class FusedLightSensor:
     """Aggregates multiple TSL2591 light sensors into a single logical sensor.
 
     This class averages the readings (lux, infrared, and full spectrum) from multiple
     LightSensor instances, optionally supporting TCA9548A multiplexer channels.
+    Calling it reads each sensor's two raw channels once and derives all three
+    values from that one sample, then averages every sensor in one reduction.
 
     Args:
         addresses (List[int]): List of I²C addresses (or multiplexer channels) for each sensor.
         descriptions (List[str]): List of human-readable descriptions for each sensor.
         skip_on_fail (bool, optional): Whether to ignore initialization failures. Defaults to True.
         use_multi_channel (bool, optional): Whether to use a TCA9548A multiplexer. Defaults to False.
+        i2c_bus (str, optional): Bus the sensors are wired to. Defaults to "i2c-1".
+        multiplexer (int, optional): Address of the TCA9548A the sensors sit behind. Defaults to 0x70.
 
     Example:
         >>> fused_sensor = FusedLightSensor([1, 2], ["Light #1", "Light #2"], use_multi_channel=True)
@@ -30,11 +70,31 @@ class FusedLightSensor:
         {'lux': 432.5, 'infrared': 120.3, 'spectrum': 550.1}
     """
 
-    def __init__(self, addresses:List[int], descriptions:List[str], skip_on_fail=True, use_multi_channel=False, fake_data=False):
+    def __init__(
+        self,
+        addresses: List[int],
+        descriptions: List[str],
+        skip_on_fail=True,
+        use_multi_channel=False,
+        fake_data=False,
+        i2c_bus: str = DEFAULT_BUS,
+        multiplexer: int = DEFAULT_MULTIPLEXER,
+    ):
         self.fake_data = fake_data
         self.addresses = addresses # direct i2c connection
         self.descriptions = descriptions
-        self.sensors = [LightSensor(addresses[i], descriptions[i], skip_on_fail, use_multi_channel, fake_data=fake_data) for i in range(len(addresses))]
+        self.sensors = [
+            LightSensor(
+                addresses[i],
+                descriptions[i],
+                skip_on_fail,
+                use_multi_channel,
+                fake_data=fake_data,
+                i2c_bus=i2c_bus,
+                multiplexer=multiplexer,
+            )
+            for i in range(len(addresses))
+        ]
 
 
     @property
@@ -90,13 +150,30 @@ class FusedLightSensor:
         """
         return ["lux", "infrared", "spectrum"]
 
+    def snapshot(self) -> np.ndarray:
+        """Lux, infrared and full spectrum of every readable sensor, each from a single raw read.
+
+        Raises:
+            RuntimeError: If no sensor is readable or a sensor is saturated.
+
+        Returns:
+            np.ndarray: `(N, 3)` array with one row per readable sensor.
+        """
+        sensors = [sensor for sensor in self.sensors if sensor.readable]
+        if len(sensors) == 0:
+            raise RuntimeError("None of the light sensors ({}) are readable".format(", ".join(self.descriptions)))
+        raw = np.array([sensor.raw_luminosity() for sensor in sensors], dtype=np.float64)
+        cpl = np.array([sensor.cpl for sensor in sensors])
+        max_counts = np.array([sensor.max_counts for sensor in sensors])
+        return light_values(raw, cpl, max_counts)
+
     def __call__(self):
         """Returns all averaged sensor readings as a dictionary.
 
         Returns:
             Dict[str, float]: {'lux': ..., 'infrared': ..., 'spectrum': ...}
         """
-        return {"lux": self.lux, "infrared": self.infrared, "spectrum": self.spectrum}
+        return dict(zip(self.keys, self.snapshot().mean(axis=0).tolist()))
 
 
 class LightSensor:
@@ -109,6 +186,8 @@ class LightSensor:
         description (str): Human-readable name for the sensor.
         skip_on_fail (bool, optional): Whether to skip initialization errors. Defaults to True.
         use_multi_channel (bool, optional): Whether to use a TCA9548A multiplexer. Defaults to False.
+        i2c_bus (str, optional): Bus the sensors are wired to. Defaults to "i2c-1".
+        multiplexer (int, optional): Address of the TCA9548A the sensors sit behind. Defaults to 0x70.
 
     Raises:
         Exception: If sensor initialization fails after multiple attempts and `skip_on_fail` is False.
@@ -121,9 +200,20 @@ class LightSensor:
         {'lux': 432.5, 'infrared': 120.3, 'spectrum': 550.1}
     """
 
-    def __init__(self, address: int, description: str, skip_on_fail=True, use_multi_channel=False, fake_data=False):
+    def __init__(
+        self,
+        address: int,
+        description: str,
+        skip_on_fail=True,
+        use_multi_channel=False,
+        fake_data=False,
+        i2c_bus: str = DEFAULT_BUS,
+        multiplexer: int = DEFAULT_MULTIPLEXER,
+    ):
         self.addr = address # direct i2c connection
         self.use_multi = use_multi_channel
+        self.i2c_bus = i2c_bus
+        self.multiplexer = multiplexer
         self.name = description
         self.skip_on_fail = skip_on_fail
         self._i2c_fail = False
@@ -137,23 +227,22 @@ class LightSensor:
     def __connect__(self):
         """Connects to the TSL2591 sensor over I²C.
 
-        Supports direct I²C or via TCA9548A multiplexer.
+        Supports direct I²C or via TCA9548A multiplexer; both are borrowed from the shared `i2c_registry`.
 
         Raises:
             Exception: If connection fails and `skip_on_fail` is False.
         """
         try:
             logger.info(
-                "Connecting (SCL:{} | SDA:{} | Address: {})".format(
-                    board.SCL, board.SDA, self.addr
+                "Connecting (Bus:{} | Address: {})".format(
+                    self.i2c_bus, self.addr
                 )
             )
-            self.i2c = busio.I2C(board.SCL, board.SDA)
-            
             if self.use_multi:
-                self.tca = adafruit_tca9548a.TCA9548A(self.i2c)
-                self.tsl2591 = TSL2591(self.tca[self.addr])
+                self.i2c = i2c_registry.handle(self.i2c_bus, channel=self.addr, multiplexer=self.multiplexer)
+                self.tsl2591 = TSL2591(self.i2c)
             else:
+                self.i2c = i2c_registry.handle(self.i2c_bus)
                 self.tsl2591 = TSL2591(self.i2c, address=self.addr)
 
         except Exception as e:
@@ -206,6 +295,32 @@ class LightSensor:
             return random.random()*100.0
         return self.tsl2591.full_spectrum
 
+    def raw_luminosity(self) -> Tuple[int, int]:
+        """One read of both channels: `(channel_0, channel_1)` (IR + visible, IR only).
+
+        The fake channels are what the sensor returns, so fake readings go through
+        the same lux and spectrum math as real ones.
+        """
+        if self.fake_data:
+            channel_0 = random.randint(0, 30000)
+            return channel_0, int(channel_0 * random.uniform(0.1, 0.5))
+        return self.tsl2591.raw_luminosity
+
+    @property
+    def cpl(self) -> float:
+        """Counts per lux at the current gain and integration time (no bus traffic)."""
+        if self.fake_data:
+            return 200.0 * GAIN_FACTORS[0x10] / LUX_DF  # driver defaults: GAIN_MED, 100 ms
+        atime = 100.0 * self.tsl2591._integration_time + 100.0
+        return atime * GAIN_FACTORS.get(self.tsl2591._gain, 1.0) / LUX_DF
+
+    @property
+    def max_counts(self) -> int:
+        """Channel count at which the sensor saturates for its integration time."""
+        if self.fake_data or self.tsl2591._integration_time == 0x00:
+            return MAX_COUNT_100MS
+        return MAX_COUNT
+
     def __init_probe__(self, probe_attempts=5):
         """Performs multiple read attempts to verify sensor is operational.
 
@@ -239,12 +354,14 @@ class LightSensor:
         return ["lux", "infrared", "spectrum"]
 
     def __call__(self):
-        """Returns sensor readings as a dictionary.
+        """Returns sensor readings as a dictionary, all derived from one raw read.
 
         Returns:
             Dict[str, float]: {'lux': ..., 'infrared': ..., 'spectrum': ...}
         """
-        return {"lux": self.lux, "infrared": self.infrared, "spectrum": self.spectrum}
+        raw = np.array([self.raw_luminosity()], dtype=np.float64)
+        values = light_values(raw, np.array([self.cpl]), np.array([self.max_counts]))
+        return dict(zip(self.keys, values[0].tolist()))
 
 
 if __name__ == "__main__":
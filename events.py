@@ -0,0 +1,84 @@
+from datetime import datetime
+from threading import Lock
+from types import SimpleNamespace
+from typing import *
+from loguru import logger
+
+from rules import RuleEngine
+
+"""
+Topic-based event bus between sensors and instruments.
+
+Every sensor publishes its readings to a topic named after it, and
+instruments subscribe to the keys of the topics their rules read. The bus
+only keeps the latest reading of each topic: a sensor that reports several
+times before the instruments run replaces its own pending reading instead of
+queueing behind it. Subscriber lists are worked out once, when the bus is
+built, so dispatching a reading is a dictionary lookup.
+"""
+
+
+class EventBus:
+    """Latest-value-per-topic pub/sub between sensors and instruments.
+
+    Example:
+        >>> bus = EventBus()
+        >>> bus.subscribe("main_temp_sensor_1", "fan_1", keys=["temperature"])
+        >>> bus.publish("main_temp_sensor_1", {"temperature": 80.0}, datetime.now())
+        >>> bus.publish("main_temp_sensor_1", {"temperature": 86.0}, datetime.now())
+        >>> bus.drain()
+        {'main_temp_sensor_1': ({'temperature': 86.0}, datetime(...))}
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Tuple[str, Optional[Tuple[str, ...]]]]] = {}
+        self._latest: Dict[str, Tuple[Dict, datetime]] = {}
+        self._lock = Lock()  # publish may be called from bus worker threads
+        self.published = 0
+        self.coalesced = 0
+
+    @classmethod
+    def from_engine(cls, engine: RuleEngine, sensor_tree: Dict[str, SimpleNamespace]) -> "EventBus":
+        """Subscribe every rule-driven instrument to the sensor keys its rule reads."""
+        bus = cls()
+        for sensor_name in sensor_tree:
+            for instrument_name, keys in engine.subscriptions(sensor_name).items():
+                bus.subscribe(sensor_name, instrument_name, keys=keys)
+        return bus
+
+    def subscribe(self, topic: str, subscriber: str, keys: Optional[List[str]] = None) -> None:
+        """Notify `subscriber` of readings on `topic` that carry any of `keys` (None for every reading)."""
+        subscribers = self._subscribers.setdefault(topic, [])
+        subscribers.append((subscriber, None if keys is None else tuple(keys)))
+        logger.debug("{} subscribed to {} ({})".format(subscriber, topic, "all keys" if keys is None else ", ".join(keys)))
+
+    def subscribers(self, topic: str, payload: Optional[Dict] = None) -> List[str]:
+        """Subscribers of `topic`; with a `payload`, only those that read one of its (non-None) keys."""
+        names = []
+        for subscriber, keys in self._subscribers.get(topic, []):
+            if payload is None or keys is None or any(payload.get(key, None) is not None for key in keys):
+                names.append(subscriber)
+        return names
+
+    def publish(self, topic: str, payload: Dict, timestamp: datetime) -> None:
+        """Make `payload` the pending reading of `topic`, replacing any reading not dispatched yet."""
+        with self._lock:
+            if topic in self._latest:
+                self.coalesced += 1
+            self._latest[topic] = (payload, timestamp)
+            self.published += 1
+
+    def drain(self) -> Dict[str, Tuple[Dict, datetime]]:
+        """Take the pending reading of every topic, leaving the bus empty.
+
+        Returns:
+            Dict[str, Tuple[Dict, datetime]]: `(payload, timestamp)` per topic.
+        """
+        with self._lock:
+            latest, self._latest = self._latest, {}
+        return latest
+
+    def pending(self) -> List[str]:
+        """Topics with a reading that has not been dispatched yet."""
+        with self._lock:
+            return list(self._latest)
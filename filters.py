@@ -0,0 +1,294 @@
+from typing import *
+import numpy as np
+from loguru import logger
+
+"""
+Streaming signal conditioning for sensor readings.
+
+A single bad sample (a humidity spike from condensation, a flash of sunlight
+on a light sensor) should not flip a relay. Each sensor can get a
+`SignalFilter` that keeps its last `window` readings in a fixed-size NumPy
+ring buffer and cleans every new reading in three optional stages:
+
+    1. Outlier rejection: a value further than `outlier_mad` scaled MADs from
+       the window median is replaced by that median (a causal Hampel filter).
+       The raw value still enters the window, so a real step change gets
+       through once it has lasted half a window. A flat window has a MAD of 0,
+       so the spread is floored per key by `min_spread`; a key whose spread is
+       still 0 rejects nothing.
+    2. Rolling median of the window.
+    3. EWMA with weight `ewma_alpha` on the newest value.
+
+Every reading costs a couple of medians over `window` rows, no matter how long
+the sensor has been running. All keys of a sensor are filtered together, one
+column per key.
+"""
+
+# Scales the median absolute deviation to the standard deviation of normally distributed noise:
+MAD_SCALE = 1.4826
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _partition_median(rows: np.ndarray) -> np.ndarray:
+    """Column medians of `rows`, which are partitioned in place (pass a scratch buffer).
+
+    `np.median` spends most of its time on argument handling when the window is
+    only a few rows; a partition of the preallocated buffer does the same work
+    without allocating.
+    """
+    half = rows.shape[0] // 2
+    if rows.shape[0] % 2:
+        rows.partition(half, axis=0)
+        return rows[half].copy()
+    rows.partition((half - 1, half), axis=0)
+    return 0.5 * (rows[half - 1] + rows[half])
+
+
+class RingBuffer:
+    """Fixed-size buffer of the last `size` rows; pushing overwrites the oldest row.
+
+    Args:
+        size (int): Number of rows kept.
+        width (int): Values per row.
+
+    Example:
+        >>> ring = RingBuffer(3, 1)
+        >>> for value in [1.0, 2.0, 3.0, 4.0]:
+        ...     ring.push(np.array([value]))
+        >>> np.sort(ring.values(), axis=0).ravel()
+        array([2., 3., 4.])
+    """
+
+    def __init__(self, size: int, width: int):
+        self.data = np.zeros((size, width), dtype=np.float64)
+        self.size = size
+        self.count = 0
+        self.head = 0  # row the next push writes to
+
+    def push(self, row: np.ndarray) -> None:
+        self.data[self.head] = row
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self) -> np.ndarray:
+        """The row pushed last."""
+        return self.data[self.head - 1]
+
+    def values(self) -> np.ndarray:
+        """Rows held so far, in no particular order (a view, not a copy)."""
+        return self.data if self.count == self.size else self.data[: self.count]
+
+
+class SignalFilter:
+    """Streaming outlier rejection, rolling median and EWMA over the readings of one sensor.
+
+    The numeric (or None) keys of the first reading are filtered; other keys and
+    keys that show up later pass through unchanged. A filtered key that is
+    missing from a reading, None or not a number holds its previous value in the
+    window. The latest raw and filtered readings are kept in `raw` and `filtered`.
+
+    Args:
+        window (int, optional): Readings kept for the median and MAD. Defaults to 5.
+        median (bool, optional): Output the rolling median of the window. Defaults to False.
+        ewma_alpha (float, optional): Smooth the output with this EWMA weight (0 < alpha <= 1).
+            Defaults to None (no smoothing).
+        outlier_mad (float, optional): Reject values further than this many scaled MADs from the
+            window median. Defaults to 3.5; None turns rejection off.
+        min_samples (int, optional): Readings needed before values are rejected. Defaults to 3.
+        min_spread (Union[float, Dict[str, float]], optional): Smallest spread (scaled MAD, in the
+            units of the key) used for rejection, for every key or per key. Defaults to 0.0.
+
+    Raises:
+        ValueError: If `window` is smaller than `min_samples` or `ewma_alpha` is out of range.
+
+    Example:
+        >>> signal_filter = SignalFilter(window=5, outlier_mad=3.5)
+        >>> for temperature in [80.1, 80.3, 80.2, 80.4]:
+        ...     signal_filter({"temperature": temperature})
+        >>> signal_filter({"temperature": 97.0})  # one spike
+        {'temperature': 80.3}
+        >>> signal_filter.raw
+        {'temperature': 97.0}
+    """
+
+    def __init__(
+        self,
+        window: int = 5,
+        median: bool = False,
+        ewma_alpha: Optional[float] = None,
+        outlier_mad: Optional[float] = 3.5,
+        min_samples: int = 3,
+        min_spread: Union[float, Dict[str, float]] = 0.0,
+    ):
+        if window < max(min_samples, 1):
+            raise ValueError("Filter window {} is shorter than min_samples ({})".format(window, min_samples))
+        if ewma_alpha is not None and not (0.0 < ewma_alpha <= 1.0):
+            raise ValueError("ewma_alpha must be in (0, 1], got {}".format(ewma_alpha))
+        self.window = window
+        self.median = median
+        self.ewma_alpha = ewma_alpha
+        self.outlier_mad = outlier_mad
+        self.min_samples = min_samples
+        self.min_spread = min_spread
+        self._min_spread: Optional[np.ndarray] = None  # per filtered key, once the keys are known
+
+        self.keys: Optional[List[str]] = None
+        self.ring: Optional[RingBuffer] = None
+        self._scratch: Optional[np.ndarray] = None  # window-sized buffer the medians are partitioned in
+        self.ewma: Optional[np.ndarray] = None
+        self.raw: Dict[str, Any] = {}
+        self.filtered: Dict[str, Any] = {}
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, filter_config: Optional[Dict]) -> Optional["SignalFilter"]:
+        """Build the filter of a device from its `"filter"` configuration entry (None if it has none)."""
+        if filter_config is None:
+            return None
+        return cls(
+            window=filter_config.get("window", 5),
+            median=filter_config.get("median", False),
+            ewma_alpha=filter_config.get("ewma_alpha", None),
+            outlier_mad=filter_config.get("outlier_mad", 3.5),
+            min_samples=filter_config.get("min_samples", 3),
+            min_spread=filter_config.get("min_spread", 0.0),
+        )
+
+    def __call__(self, reading: Dict[str, Any]) -> Dict[str, Any]:
+        """Filter one reading.
+
+        Returns:
+            Dict[str, Any]: The reading with every filtered key replaced by its filtered value.
+        """
+        self.raw = reading
+        if self.keys is None:
+            self.keys = [key for key, value in reading.items() if value is None or _is_number(value)]
+            self.ring = RingBuffer(self.window, len(self.keys))
+            self._scratch = np.empty((self.window, len(self.keys)), dtype=np.float64)
+            if isinstance(self.min_spread, dict):
+                self._min_spread = np.array([self.min_spread.get(key, 0.0) for key in self.keys], dtype=np.float64)
+            else:
+                self._min_spread = np.full(len(self.keys), float(self.min_spread))
+        if len(self.keys) == 0:
+            self.filtered = reading
+            return reading
+
+        values = np.array(
+            [value if _is_number(value) else np.nan for value in map(reading.get, self.keys)], dtype=np.float64
+        )
+        missing = np.isnan(values)
+        if missing.any():
+            if self.ring.count == 0:
+                self.filtered = reading  # nothing to hold the missing values with yet
+                return reading
+            values[missing] = self.ring.last()[missing]
+        self.ring.push(values)
+        out = values
+
+        if self.ring.count >= self.min_samples and (self.median or self.outlier_mad is not None):
+            window = self.ring.values()
+            scratch = self._scratch[: len(window)]
+            np.copyto(scratch, window)
+            center = _partition_median(scratch)
+            if self.outlier_mad is not None:
+                np.subtract(window, center, out=scratch)
+                np.abs(scratch, out=scratch)
+                spread = np.maximum(MAD_SCALE * _partition_median(scratch), self._min_spread)
+                outliers = (np.abs(values - center) > self.outlier_mad * spread) & (spread > 0.0)
+                if outliers.any():
+                    self.rejected += int(outliers.sum())
+                    logger.debug(
+                        "Rejected outlier {}".format(
+                            ", ".join("{}={}".format(self.keys[idx], values[idx]) for idx in np.flatnonzero(outliers))
+                        )
+                    )
+                    out = np.where(outliers, center, values)
+            if self.median:
+                out = center
+
+        if self.ewma_alpha is not None:
+            self.ewma = out if self.ewma is None else self.ewma_alpha * out + (1.0 - self.ewma_alpha) * self.ewma
+            out = self.ewma
+
+        self.filtered = {**reading, **dict(zip(self.keys, out.tolist()))}
+        return self.filtered
+
+    def run(self, readings: List[Dict[str, Any]], chunk_rows: int = 65536) -> List[Dict[str, Any]]:
+        """Filter a whole series of readings, with the same results as calling the filter on each in turn.
+
+        Meant for recorded history (ex: a replay). Once the window is full, the
+        medians and MADs of a chunk of readings are computed together over a
+        sliding window, and only the EWMA is stepped per reading. The filter is
+        left in the same state as after the equivalent calls.
+
+        Args:
+            readings (List[Dict[str, Any]]): Readings of this filter's sensor, oldest first.
+            chunk_rows (int, optional): Readings filtered together; bounds the sliding window's memory. Defaults to 65536.
+
+        Returns:
+            List[Dict[str, Any]]: The filtered readings.
+        """
+        filtered = []
+        idx = 0
+        # The first readings settle the keys and fill the window:
+        while idx < len(readings) and (self.ring is None or self.ring.count < self.window):
+            filtered.append(self(readings[idx]))
+            idx += 1
+        for start in range(idx, len(readings), chunk_rows):
+            filtered.extend(self._run_chunk(readings[start : start + chunk_rows]))
+        return filtered
+
+    def _run_chunk(self, readings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Called with a full window only.
+        width = len(self.keys)
+        values = np.array(
+            [[value if _is_number(value) else np.nan for value in map(reading.get, self.keys)] for reading in readings],
+            dtype=np.float64,
+        ).reshape(len(readings), width)
+        # The window (oldest row first) followed by the new readings; missing values hold the previous row:
+        rows = np.concatenate([np.roll(self.ring.data, -self.ring.head, axis=0), values])
+        missing = np.isnan(rows)
+        if missing.any():
+            source = np.where(missing, 0, np.arange(len(rows))[:, None])
+            rows = rows[np.maximum.accumulate(source, axis=0), np.arange(width)]
+        values = rows[self.window :]
+        out = values
+
+        if self.median or self.outlier_mad is not None:
+            windows = np.lib.stride_tricks.sliding_window_view(rows, self.window, axis=0)[1:]  # (readings, keys, window)
+            center = np.median(windows, axis=-1)
+            if self.outlier_mad is not None:
+                spread = np.maximum(
+                    MAD_SCALE * np.median(np.abs(windows - center[..., None]), axis=-1), self._min_spread
+                )
+                outliers = (np.abs(values - center) > self.outlier_mad * spread) & (spread > 0.0)
+                if outliers.any():
+                    self.rejected += int(outliers.sum())
+                    logger.debug("Rejected {} outliers in {} readings".format(int(outliers.sum()), len(readings)))
+                    out = np.where(outliers, center, values)
+            if self.median:
+                out = center
+
+        if self.ewma_alpha is not None:
+            # A recurrence; stepped in plain floats, one key at a time:
+            alpha, beta = self.ewma_alpha, 1.0 - self.ewma_alpha
+            smoothed = np.empty_like(out)
+            for col in range(width):
+                ewma = float(self.ewma[col])
+                column = []
+                for value in out[:, col].tolist():
+                    ewma = alpha * value + beta * ewma
+                    column.append(ewma)
+                smoothed[:, col] = column
+            self.ewma = smoothed[-1].copy()
+            out = smoothed
+
+        self.ring.data[:] = rows[-self.window :]
+        self.ring.head = 0
+        self.raw = readings[-1]
+        filtered = [{**reading, **dict(zip(self.keys, row))} for reading, row in zip(readings, out.tolist())]
+        self.filtered = filtered[-1]
+        return filtered
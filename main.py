@@ -1,7 +1,8 @@
 import json
 import os
 import sys
-from queue import Queue
+import signal
+import time
 from types import SimpleNamespace
 from typing import *
 from datetime import datetime
@@ -21,16 +22,69 @@ from devices.instrument.fan import *
 
 # scheduling imports:
 from scheduler import *
+from rules import RuleEngine, legacy_rule
+from filters import SignalFilter
+from events import EventBus
 from utils import emoji
 
+# control loop:
+from control import scheduler_registry, buffered_checkpoints, build_timers, poll_sensors, dispatch_events, run_interval_instrument
+from async_runtime import AsyncRuntime
+
 # database logging:
-from devices.database import DatabaseHandler, LogRecord, ImageRecord
+from devices.database import DatabaseHandler
+
+# loop timing:
+from devices.metrics import metrics
+
+# database retention:
+from devices.retention import RetentionManager
 
 # file manager:
 from devices.file_manager import exec_manager
+
+# I2C bus workers:
+from devices.i2c_bus import I2CBusPool, DEFAULT_BUS, DEFAULT_MULTIPLEXER, i2c_registry
+
+# latest reading of each sensor:
+from devices.reading_cache import ReadingCache
 from multiprocessing import Process
 
 
+# Configuration keys that make up the schedule of a sensor or camera:
+SCHEDULE_KEYS = ["cron", "catch_up", "grace_sec", "interval_sec", "datetime_str"]
+
+
+def sensor_scheduler(device: Dict) -> Scheduler:
+    """Scheduler for a sensor or camera entry: `cron` (with `catch_up`), `interval_sec` or `datetime_str`."""
+    if "cron" in device:
+        return CalendarScheduler(
+            device["cron"],
+            catch_up=device.get("catch_up", "skip"),
+            grace_sec=device.get("grace_sec", 60.0),
+        )
+    elif "interval_sec" in device:
+        return SensorScheduler(interval_sec=device["interval_sec"])
+    elif "datetime_str" in device:
+        datetime_obj = datetime.strptime(device["datetime_str"], "%y-%m-%d_%H-%M-%S")
+        return SensorScheduler(datetime_obj=datetime_obj)
+    raise ValueError("Must have cron, interval_sec or datetime_str")
+
+
+def i2c_address(value: Union[int, str]) -> int:
+    """I2C address from the configuration file (ex: `"0x71"` or `113`)."""
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def fused_setting(descriptions: List[str], values: List[Any], field: str) -> Any:
+    """The `field` every part of a fused sensor shares; parts configured differently are rejected."""
+    if any(value != values[0] for value in values[1:]):
+        raise ValueError(
+            "Fused sensors {} must share the same '{}' (got {})".format(", ".join(descriptions), field, values)
+        )
+    return values[0]
+
+
 def initialize_from_config(
     config_file: str, return_relay_module: bool = False, fake_data=False
 ):
@@ -46,6 +100,14 @@ def initialize_from_config(
     relay_info = config["relay_module"]
     relay_modules = RelayModule(relay_info, fake_data=fake_data)
 
+    # Extra multiplexers (ex: a second TCA9548A chained behind a channel of the first):
+    if not fake_data:
+        for mux in config.get("i2c", {}).get("multiplexers", []):
+            parent = None
+            if "parent" in mux:
+                parent = (i2c_address(mux["parent"]), mux["channel"])
+            i2c_registry.add_multiplexer(mux.get("bus", DEFAULT_BUS), i2c_address(mux["address"]), parent=parent)
+
     for dev in config["devices"].keys():
         # Switch case to generate the correct object:
         device = config["devices"][dev]
@@ -54,42 +116,58 @@ def initialize_from_config(
         device_type = None
         limiter_key = None
         connections = config["devices"][dev].get("connections", None)
+        bus_name, selections = None, []  # I2C bus and (multiplexer, channel) read from (sensors only)
+        signal_filter = None  # reading filter (sensors only)
+        rule = None  # sensor rule (instruments only)
+        i2c_bus = device.get("i2c_bus", DEFAULT_BUS)
+        multiplexer = i2c_address(device.get("multiplexer", DEFAULT_MULTIPLEXER))
 
         if dev_type == "light_sensor":
             i2c_addr = device["multiplex_idx"]
-            interval_sec = device["interval_sec"]
+            schedule = {key: device[key] for key in SCHEDULE_KEYS if key in device}
             light_sensors.append(
-                [i2c_addr, dev, interval_sec, connections, limiter_key]
+                [i2c_addr, dev, schedule, connections, limiter_key, i2c_bus, multiplexer, device.get("filter", None)]
             )
 
         elif dev_type == "temperature_sensor":
             i2c_addr = device["multiplex_idx"]
-            interval_sec = device["interval_sec"]
             device_obj = TemperatureSensor(
                 i2c_addr,
                 dev,
                 use_multi_channel=True,
                 temp_unit="fahrenheit",
                 fake_data=fake_data,
+                i2c_bus=i2c_bus,
+                multiplexer=multiplexer,
+                periodic_hz=device.get("periodic_hz", None),
             )
-            scheduler_obj = SensorScheduler(interval_sec=interval_sec)
+            scheduler_obj = sensor_scheduler(device)
             device_type = "sensor"
+            bus_name, selections = i2c_bus, [(multiplexer, i2c_addr)]
+            signal_filter = SignalFilter.from_config(device.get("filter", None))
 
         # TODO: Isn't implemented; would affect water pump
         elif dev_type == "soil_sensor":
             i2c_addr = device["multiplex_idx"]
-            interval_sec = device["interval_sec"]
             device_obj = SoilSensor(
-                i2c_addr, dev, use_multi_channel=True, fake_data=fake_data
+                i2c_addr,
+                dev,
+                use_multi_channel=True,
+                fake_data=fake_data,
+                i2c_bus=i2c_bus,
+                multiplexer=multiplexer,
             )
-            scheduler_obj = SensorScheduler(interval_sec=interval_sec)
+            scheduler_obj = sensor_scheduler(device)
             device_type = "sensor"
+            bus_name, selections = i2c_bus, [(multiplexer, i2c_addr)]
+            signal_filter = SignalFilter.from_config(device.get("filter", None))
 
         elif dev_type == "light":
             device_obj = LightBulb(dev, relay_modules, fake_data=fake_data)
             device_type = "device"
             limiters = device["sensor_keys"]
-            limiter_key = "lux"  # TODO: make this multiple limits; have to make DeviceScheduler accept multiple thresholds
+            limiter_key = "lux"  # only used by DeviceScheduler.change; `rule` covers every limit
+            rule = device.get("rule", legacy_rule(device))
             scheduler_obj = DeviceScheduler(
                 sensor_threshold=limiters[limiter_key],
                 interval_sec=10,
@@ -116,15 +194,7 @@ def initialize_from_config(
         elif dev_type == "camera":
             camera_id = device["usb_id"]
             save_path = device["save_path"]
-            if "interval_sec" in device:
-                interval_sec = device["interval_sec"]
-                scheduler_obj = SensorScheduler(interval_sec=interval_sec)
-            elif "datetime_str" in device:
-                datetime_str = device["datetime_str"]
-                datetime_obj = datetime.strptime(datetime_str, "%y-%m-%d_%H-%M-%S")
-                scheduler_obj = SensorScheduler(datetime_obj=datetime_obj)
-            else:
-                raise ValueError("Must have interval_sec or datetime_str")
+            scheduler_obj = sensor_scheduler(device)
 
             device_obj = GC0307(
                 camera_id,
@@ -138,7 +208,8 @@ def initialize_from_config(
         elif dev_type == "fan":
             device_type = "device"
             limiters = device["sensor_keys"]
-            limiter_key = "temperature"  # TODO: make this multiple limits; have to make DeviceScheduler accept multiple thresholds
+            limiter_key = "temperature"  # only used by DeviceScheduler.change; `rule` covers every limit
+            rule = device.get("rule", legacy_rule(device))
             duration_sec = device["duration"]
             interval_sec = device["interval_sec"]
 
@@ -176,6 +247,10 @@ def initialize_from_config(
                     ],  # TODO: break into its own class
                     run_alone=True,
                     limiter_key=limiter_key,
+                    bus=bus_name,
+                    selections=selections,
+                    rule=rule,
+                    filter=signal_filter,
                 )
             else:
                 device_tree_obj = SimpleNamespace(
@@ -185,6 +260,10 @@ def initialize_from_config(
                     scheduler=[scheduler_obj],
                     run_alone=False,
                     limiter_key=limiter_key,
+                    bus=bus_name,
+                    selections=selections,
+                    rule=rule,
+                    filter=signal_filter,
                 )
 
         # Some exceptions to consider:
@@ -201,11 +280,15 @@ def initialize_from_config(
         descs = [ls[1] for ls in light_sensors]
         connections = list(set([ls[3][0] for ls in light_sensors]))
         name = "+".join(descs)
-        avg_interval_sec = sum([ls[2] for ls in light_sensors]) / (len(light_sensors))
         device_obj = FusedLightSensor(
-            addrs, descs, use_multi_channel=True, fake_data=fake_data
+            addrs,
+            descs,
+            use_multi_channel=True,
+            fake_data=fake_data,
+            i2c_bus=light_sensors[0][5],
+            multiplexer=light_sensors[0][6],
         )
-        scheduler_obj = SensorScheduler(interval_sec=avg_interval_sec)
+        scheduler_obj = sensor_scheduler(fused_setting(descs, [ls[2] for ls in light_sensors], "schedule"))
         device_type = "sensor"
         device_tree_obj = SimpleNamespace(
             device=device_obj,
@@ -214,6 +297,10 @@ def initialize_from_config(
             scheduler=[scheduler_obj],
             run_alone=False,
             limiter_key=limiter_key,
+            bus=light_sensors[0][5],
+            selections=[(light_sensors[0][6], addr) for addr in addrs],  # read in this order
+            rule=None,
+            filter=SignalFilter.from_config(fused_setting(descs, [ls[7] for ls in light_sensors], "filter")),
         )
         sensor_tree[name] = device_tree_obj
 
@@ -223,7 +310,7 @@ def initialize_from_config(
         return sensor_tree, instrument_tree, log_path
 
 
-def generate_status_log(devices, i_queue: Queue = None) -> str:
+def generate_status_log(devices, event_bus: EventBus = None) -> str:
     status_log = "\n"
     for device_name, device in devices.items():
         device_obj, device_scheduler = device.device, device.scheduler
@@ -236,14 +323,14 @@ def generate_status_log(devices, i_queue: Queue = None) -> str:
         status_log += "\t{:<20} - {:<10} {}\n".format(device_name, status_str, status)
     status_log += "\n"
 
-    # Optional printing of active queue (only used for when we're in the main loop)
-    if i_queue is not None:
-        if i_queue.qsize() > 0:
-            status_log += "Active Queue Items:\n"
+    # Optional printing of pending readings (only used for when we're in the main loop)
+    if event_bus is not None:
+        pending = event_bus.pending()
+        if len(pending) > 0:
+            status_log += "Pending Events:\n"
 
-        for i in range(i_queue.qsize()):
-            dname, dconn, dsensor = i_queue.queue[i]
-            status_log += "\t ({}) to {}\n".format(dname, dconn)
+        for topic in pending:
+            status_log += "\t ({}) to {}\n".format(topic, event_bus.subscribers(topic))
 
     return status_log
 
@@ -257,6 +344,14 @@ def parse_arg():
         default=False,
         help="Flag to ",
     )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Run sensors and instruments as asyncio tasks instead of the polling loop",
+    )
     parser.add_argument(
         "--config",
         type=str,
@@ -273,17 +368,14 @@ if __name__ == "__main__":
     sensor_tree, instrument_tree, log_path = initialize_from_config(
         CONFIG_FILE, fake_data=args.fake_data
     )
-    interaction_queue = Queue()
-    logging_iteration = 1
-    loop_iteration = 0
 
     # 1. Declare device status
     logger.info("Sensor Status:")
-    status_str = generate_status_log(sensor_tree, interaction_queue)
+    status_str = generate_status_log(sensor_tree)
     logger.info(status_str)
 
     logger.info("Instrument Status:")
-    status_str = generate_status_log(instrument_tree, interaction_queue)
+    status_str = generate_status_log(instrument_tree)
     logger.info(status_str)
 
     # 1a. Initialize database variables for logging:
@@ -291,145 +383,126 @@ if __name__ == "__main__":
     start_timestamp = datetime.now()
 
     # 1a. Setup sensor logging system
-    db_handler = DatabaseHandler("./logs/internal.db")
-    file_manager_process = Process(target=exec_manager, args=('./logs', db_handler), daemon=True)
+    config = json.load(open(CONFIG_FILE, "r"))
+    db_config = config.get("database", {})
+    db_file_path = "./logs/internal.db"
+    db_handler = DatabaseHandler(
+        db_file_path,
+        batch_size=db_config.get("batch_size", 1),
+        flush_interval_sec=db_config.get("flush_interval_sec", None),
+        threaded=db_config.get("threaded", False),
+        queue_size=db_config.get("queue_size", 1000),
+        overflow_policy=db_config.get("overflow_policy", "block"),
+        write_retries=db_config.get("write_retries", 3),
+        retry_backoff_sec=db_config.get("retry_backoff_sec", 0.5),
+        heartbeat_mode=db_config.get("heartbeat_mode", "events"),
+        heartbeat_gap_sec=db_config.get("heartbeat_gap_sec", 30.0),
+        journal_mode=db_config.get("journal_mode", "WAL"),
+        busy_timeout_ms=db_config.get("busy_timeout_ms", 5000),
+    )
+    retention = None
+    if "retention" in config:
+        retention_config = config["retention"]
+        retention = RetentionManager(
+            db_file_path,
+            retention_config.get("tables", {}),
+            archive_path=retention_config.get("archive_path", None),
+            step_ms=retention_config.get("step_ms", 5.0),
+            chunk_rows=retention_config.get("chunk_rows", 200),
+            interval_sec=retention_config.get("interval_sec", 3600.0),
+        )
+
+    # Older databases stored sensor readings as JSON in `logs`; fold them into
+    # sensor_readings and the rollups (a no-op once it has run):
+    db_handler.backfill_from_logs()
+    file_manager_process = Process(target=exec_manager, args=('./logs', db_file_path), daemon=True)
     file_manager_process.start()
 
-    # 2. Main loop:
-    while True:
-        db_handler.heartbeat()
-
-        # Loop through each sensor and take a measurement of the greenhouse environment:
-        for device_name, device in sensor_tree.items():
-            device_obj = device.device
-            scheduler_list = device.scheduler
-
-            for scheduler in scheduler_list:
-                if scheduler.can_schedule():
-                    sensor_timestamp = datetime.now()
-
-                    # Read sensor data
-                    sensor_dict = device_obj()
-
-                    logger.info(f"Captured sensor data from {device_name} | group: {device.type}")
-                    # log sensor data:
-                    if device.type != "camera":
-                        record = LogRecord(
-                            name=device_name,
-                            level="INFO",
-                            message="{} sensor reading".format(device_name),
-                            metadata=json.dumps(sensor_dict),
-                        )
-                        db_handler.log(record)
-
-                        logger.debug("Placing {} into queue".format(device_name))
-                        interaction_queue.put(
-                            (
-                                device_name,
-                                device.connections,
-                                sensor_dict,
-                                sensor_timestamp,
-                            )
-                        )
-                    else:
-                        image_record = ImageRecord(
-                            name=sensor_dict["name"], path=sensor_dict["save_path"]
-                        )
-                        db_handler.record_image(image_record)
-
-        """
-        Once we've cycled through each applicable sensor reading,
-        check each instrument and determine if it should change state
-        """
-        while interaction_queue.qsize() > 0:
-            # Unload and unpack data object from queue:
-            dname, dconn, dsensor, dtimestamp = interaction_queue.get()
-
-            if len(dconn) > 0:
-                for _conn in dconn:
-                    _dev = instrument_tree[_conn]
-                    scheduler_list: List[DeviceScheduler] = _dev.scheduler
-
-                    # TODO: This is a workaround; break scheduler list into Namespace objects
-                    if len(scheduler_list) > 1:
-                        scheduler_list = [
-                            scheduler_list[0]
-                        ]  # Get just the sensor-based scheduler
-
-                    for scheduler in scheduler_list:
-                        # Can the instrument be changed?
-                        if scheduler.can_schedule():
-                            # What is the new state that the instrument should be in?
-                            new_state = scheduler.change(dsensor[_dev.limiter_key])
-                            scheduler.update_budget(
-                                new_state, dtimestamp
-                            )  # Update the internal scheduling budget (ex: light budget)
-                            _dev.device.trigger(state=new_state)
-
-                            record = LogRecord(
-                                name=dname,
-                                level="INFO",
-                                message="{} instrument state change".format(dname),
-                                metadata=json.dumps(
-                                    {"connection": _conn, "state": new_state}
-                                ),
-                            )
-                            db_handler.log(record)
-                        else:
-                            # if loop_iteration % logging_iteration == 0 or _dev.run_alone:
-                            """
-                            logger.warning(
-                                "{} scheduler is not ready to be polled!".format(_conn)
-                            )
-                            """
-
-        # Run through any instrument scheduler that is on an iterative timer (no sensor attached)
-        for instrument_name, instrument in instrument_tree.items():
-            if instrument.run_alone:
-                scheduler_list = instrument.scheduler
-                # TODO: This is a workaround; break scheduler list into Namespace objects
-                if len(scheduler_list) > 1:
-                    scheduler_list = [
-                        scheduler_list[1]
-                    ]  # Get just the iterative-based scheduler
-
-                for scheduler in scheduler_list:
-                    if scheduler.can_schedule():
-                        # What is the new state that the instrument should be in?
-                        new_state = scheduler.change(0)
-                        scheduler.update_budget(
-                            new_state, datetime.now()
-                        )  # Update the internal scheduling budget (ex: light budget)
-
-                        if instrument_name in ["fan_1", "fan_2"]:
-                            instrument.device.trigger(state=None)
-                        else:
-                            instrument.device.trigger(state=new_state)
-
-                        record = LogRecord(
-                            name=instrument_name,
-                            level="INFO",
-                            message="{} interval instrument state change".format(
-                                instrument_name
-                            ),
-                            metadata=json.dumps(
-                                {"connection": None, "state": new_state}
-                            ),
-                        )
-                        db_handler.log(record)
-                    else:
-                        pass
-                        """
-                        if loop_iteration % logging_iteration == 0:
-                            logger.warning(
-                                "(Iterative) {} scheduler is not ready to be polled!".format(
-                                    instrument_name
-                                )
-                            )
-                        """
-
-        time.sleep(1)  # tick every 1 second
-
-        loop_iteration += 1
-        if loop_iteration >= 1e10:
-            loop_iteration = 0  # prevent any possible overflow
+    # systemd stops the service with SIGTERM; turn it into SystemExit so the
+    # database buffer below gets flushed on the way out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    metrics_config = config.get("metrics", {})
+    metrics.configure(
+        report_interval_sec=metrics_config.get("report_interval_sec", 300.0),
+        snapshot_path=metrics_config.get("snapshot_path", None),
+        enabled=metrics_config.get("enabled", True),
+    )
+
+    scheduler_config = config.get("scheduler", {})
+    max_sleep_sec = scheduler_config.get("max_sleep_sec", 10.0)
+    bus_pool = I2CBusPool()
+    cache_config = config.get("cache", {})
+    reading_cache = ReadingCache(
+        sensor_tree,
+        bus_pool,
+        max_age_sec=cache_config.get("max_age_sec", 10.0),
+        max_ages={dev: entry["max_age_sec"] for dev, entry in config["devices"].items() if "max_age_sec" in entry},
+    )
+    engine = RuleEngine.from_trees(sensor_tree, instrument_tree)
+    event_bus = EventBus.from_engine(engine, sensor_tree)
+
+    # Pick up budgets, intervals and camera triggers where the last run left off:
+    schedulers = scheduler_registry(sensor_tree, instrument_tree)
+    buffered = buffered_checkpoints(sensor_tree)  # sensor timers; instruments and cameras are committed right away
+    db_handler.restore_schedulers(schedulers)
+    try:
+        if args.use_async:
+            # 2. Main loop (asyncio): every sensor and instrument is its own task
+            runtime = AsyncRuntime(
+                sensor_tree,
+                instrument_tree,
+                db_handler,
+                bus_pool,
+                engine,
+                event_bus=event_bus,
+                schedulers=schedulers,
+                reading_cache=reading_cache,
+                retention=retention,
+                max_sleep_sec=max_sleep_sec,
+            )
+            runtime.run()
+        else:
+            # 2. Main loop: sleep until the next scheduler is due instead of polling every second
+            timers = build_timers(sensor_tree, instrument_tree, max_sleep_sec=max_sleep_sec)
+            while True:
+                timers.sleep()
+                tick_start = time.perf_counter()
+                db_handler.heartbeat()
+                due = timers.pop_due()
+
+                # Take a measurement with each sensor that is due (each bus reads in parallel):
+                due_sensors = [
+                    (name, sensor_tree[name])
+                    for (kind, name, *_), scheduler in due
+                    if kind == "sensor" and scheduler.can_schedule()
+                ]
+                if due_sensors:
+                    poll_sensors(due_sensors, bus_pool, db_handler, event_bus, reading_cache=reading_cache)
+
+                """
+                Once we've cycled through each applicable sensor reading,
+                check each instrument and determine if it should change state
+                """
+                dispatch_events(event_bus, instrument_tree, engine, db_handler)
+
+                # Run through any instrument scheduler that is on an iterative timer (no sensor attached)
+                for (kind, name, *_), scheduler in due:
+                    if kind == "instrument" and scheduler.can_schedule():
+                        run_interval_instrument(name, instrument_tree[name], scheduler, db_handler)
+
+                for key, scheduler in due:
+                    timers.push(key, scheduler)
+                db_handler.checkpoint_schedulers(schedulers, buffered=buffered)
+
+                # Spend a few milliseconds on expiring old rows:
+                if retention is not None:
+                    retention.step()
+
+                metrics.observe("loop.tick", time.perf_counter() - tick_start)
+                metrics.report_if_due()
+    finally:
+        bus_pool.shutdown()
+        if retention is not None:
+            retention.close()
+        db_handler.close()
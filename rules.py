@@ -0,0 +1,206 @@
+from types import SimpleNamespace
+from typing import *
+import numpy as np
+from loguru import logger
+
+"""
+Rule engine for sensor-driven instruments.
+
+A rule is a tree of conditions over sensor readings:
+
+    {"any": [
+        {"key": "temperature", "op": "gt", "value": 85},
+        {"all": [
+            {"key": "relative_humidity", "op": "gt", "value": 60},
+            {"sensor": "main_temp_sensor_1", "key": "temperature", "op": "gt", "value": 75}
+        ]}
+    ]}
+
+A term without `"sensor"` reads `key` from whichever connected sensor last
+reported it. Rules are compiled once into flat NumPy arrays (terms -> AND
+groups -> OR per instrument), so every instrument is evaluated against the
+latest readings in a single vectorized pass. Time windows and budgets are
+applied afterwards by `DeviceScheduler.decide`.
+"""
+
+# Comparisons read as "<reading> <op> <value>":
+COMPARISONS = ["lt", "le", "gt", "ge", "eq", "ne"]
+
+# Result of each comparison (rows, in COMPARISONS order) for reading < / == / > value (columns):
+_TRUTH = np.array(
+    [
+        [True, False, False],  # lt
+        [True, True, False],  # le
+        [False, False, True],  # gt
+        [False, True, True],  # ge
+        [False, True, False],  # eq
+        [True, False, True],  # ne
+    ]
+)
+
+
+def legacy_rule(device_config: Dict) -> Optional[Dict]:
+    """Build a rule from the older `sensor_keys` / `compare` configuration.
+
+    Every limit in `sensor_keys` becomes one term and the instrument triggers
+    when any of them holds (ex: a fan runs when it is too hot *or* too humid).
+
+    Returns:
+        Dict: The rule, or None if the device has no `sensor_keys`.
+    """
+    if not ("sensor_keys" in device_config):
+        return None
+    op = device_config.get("compare", "gt")
+    return {"any": [{"key": key, "op": op, "value": value} for key, value in device_config["sensor_keys"].items()]}
+
+
+def _to_groups(node: Dict) -> List[List[Dict]]:
+    """Expand a rule tree into OR-of-AND groups of terms."""
+    if "any" in node:
+        return [group for child in node["any"] for group in _to_groups(child)]
+    if "all" in node:
+        groups = [[]]
+        for child in node["all"]:
+            groups = [group + child_group for group in groups for child_group in _to_groups(child)]
+        return groups
+
+    for field in ["key", "op", "value"]:
+        if not (field in node):
+            raise ValueError("Rule term {} is missing '{}'".format(node, field))
+    if not (node["op"] in COMPARISONS):
+        raise ValueError(
+            "{} is not a recognized comparison. Supported comparisons: {}".format(node["op"], ", ".join(COMPARISONS))
+        )
+    return [[node]]
+
+
+class RuleEngine:
+    """Evaluates the rules of every sensor-driven instrument in one vectorized pass.
+
+    Args:
+        rules (Dict[str, Dict]): Rule tree per instrument name.
+        sensor_connections (Dict[str, List[str]]): Instruments each sensor is connected to
+            (used to resolve terms without a `"sensor"`).
+
+    Raises:
+        ValueError: If a rule term is malformed or uses an unknown comparison.
+
+    Example:
+        >>> engine = RuleEngine(
+        ...     {"fan_1": {"any": [{"key": "temperature", "op": "gt", "value": 85}]}},
+        ...     {"main_temp_sensor_1": ["fan_1"]},
+        ... )
+        >>> engine.update("main_temp_sensor_1", {"temperature": 90.0, "relative_humidity": 40.0})
+        ['fan_1']
+        >>> engine.conditions()
+        {'fan_1': True}
+    """
+
+    def __init__(self, rules: Dict[str, Dict], sensor_connections: Dict[str, List[str]]):
+        self.instruments = list(rules)
+        self.index = {name: idx for idx, name in enumerate(self.instruments)}
+        self.sensor_connections = sensor_connections
+
+        # Slots hold the latest value of (sensor, key, instrument); sensor is None for
+        # "any connected sensor" terms, in which case the slot belongs to that instrument.
+        slots: Dict[Tuple[Optional[str], str, Optional[str]], int] = {}
+        slot_instruments: List[List[str]] = []
+        term_slot, term_op, term_value = [], [], []
+        group_starts, instrument_starts = [], []
+        for name in self.instruments:
+            groups = _to_groups(rules[name])
+            if not groups or not all(groups):
+                raise ValueError("Rule for {} has no conditions".format(name))
+            instrument_starts.append(len(group_starts))
+            for group in groups:
+                group_starts.append(len(term_slot))
+                for term in group:
+                    sensor = term.get("sensor", None)
+                    slot_key = (sensor, term["key"], None if sensor is not None else name)
+                    if not (slot_key in slots):
+                        slots[slot_key] = len(slots)
+                        slot_instruments.append([])
+                    if not (name in slot_instruments[slots[slot_key]]):
+                        slot_instruments[slots[slot_key]].append(name)
+                    term_slot.append(slots[slot_key])
+                    term_op.append(COMPARISONS.index(term["op"]))
+                    term_value.append(float(term["value"]))
+
+        self.slots = list(slots)
+        self.slot_instruments = slot_instruments
+        self.values = np.full(len(slots), np.nan)
+        self.term_slot = np.asarray(term_slot, dtype=np.intp)
+        self.term_op = np.asarray(term_op, dtype=np.intp)
+        self.term_value = np.asarray(term_value, dtype=np.float64)
+        self.group_starts = np.asarray(group_starts, dtype=np.intp)
+        self.instrument_starts = np.asarray(instrument_starts, dtype=np.intp)
+        self._term_range = np.arange(len(term_slot))
+        self._routes: Dict[str, Tuple[List[Tuple[str, int]], List[str]]] = {}
+        logger.debug(
+            "Compiled {} rules into {} terms over {} readings".format(len(self.instruments), len(term_slot), len(slots))
+        )
+
+    @classmethod
+    def from_trees(cls, sensor_tree: Dict[str, SimpleNamespace], instrument_tree: Dict[str, SimpleNamespace]) -> "RuleEngine":
+        """Build the engine from the `rule` of each instrument and the `connections` of each sensor."""
+        rules = {name: inst.rule for name, inst in instrument_tree.items() if getattr(inst, "rule", None) is not None}
+        connections = {name: sensor.connections or [] for name, sensor in sensor_tree.items()}
+        return cls(rules, connections)
+
+    def _route(self, sensor_name: str) -> Tuple[List[Tuple[str, int]], List[str]]:
+        """(key, slot) pairs fed by `sensor_name` and the instruments they affect (cached)."""
+        if not (sensor_name in self._routes):
+            # A fused sensor ("light_sensor_1+light_sensor_2") also answers to its parts:
+            names = set([sensor_name, *sensor_name.split("+")])
+            connected = set(self.sensor_connections.get(sensor_name, []))
+            routes, affected = [], []
+            for slot, (sensor, key, instrument) in enumerate(self.slots):
+                if (sensor is not None and sensor in names) or (sensor is None and instrument in connected):
+                    routes.append((key, slot))
+                    affected.extend(name for name in self.slot_instruments[slot] if not (name in affected))
+            self._routes[sensor_name] = (routes, affected)
+        return self._routes[sensor_name]
+
+    def subscriptions(self, sensor_name: str) -> Dict[str, List[str]]:
+        """Keys of `sensor_name` that each instrument's rule reads (ex: `{"fan_1": ["temperature"]}`)."""
+        routes, _ = self._route(sensor_name)
+        keys: Dict[str, List[str]] = {}
+        for key, slot in routes:
+            for name in self.slot_instruments[slot]:
+                keys.setdefault(name, [])
+                if not (key in keys[name]):
+                    keys[name].append(key)
+        return keys
+
+    def update(self, sensor_name: str, reading: Dict[str, Any]) -> List[str]:
+        """Store a sensor reading as the latest value of every slot it feeds.
+
+        Returns:
+            List[str]: Instruments whose rules use the reading.
+        """
+        routes, affected = self._route(sensor_name)
+        for key, slot in routes:
+            if key in reading and reading[key] is not None:
+                self.values[slot] = reading[key]
+        return affected
+
+    def evaluate(self) -> np.ndarray:
+        """Evaluate every rule against the latest readings.
+
+        Terms whose reading has not arrived yet are false.
+
+        Returns:
+            np.ndarray: Boolean condition per instrument, in the order of `instruments`.
+        """
+        if len(self.instruments) == 0:
+            return np.zeros(0, dtype=bool)
+        # The sign of (reading - value) answers every comparison through one lookup table:
+        sign = np.sign(self.values[self.term_slot] - self.term_value)
+        known = sign == sign  # NaN (no reading yet) is never equal to itself
+        terms = _TRUTH[self.term_op, np.where(known, sign, 0.0).astype(np.intp) + 1] & known
+        groups = np.logical_and.reduceat(terms, self.group_starts)
+        return np.logical_or.reduceat(groups, self.instrument_starts)
+
+    def conditions(self) -> Dict[str, bool]:
+        """`evaluate()` keyed by instrument name."""
+        return dict(zip(self.instruments, self.evaluate().tolist()))
@@ -1,12 +1,16 @@
 import os
 import sys
 import time
+import heapq
+import itertools
 import operator
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from loguru import logger
 from typing import *
 
+from devices.metrics import metrics
+
 """
 Types of scheduling:
     - Timer (in seconds)
@@ -16,27 +20,48 @@ Types of scheduling:
 
 # Base class:
 class Scheduler(ABC):
-    def __init__(self, interval_sec):
-        self.last_interval = time.time()
+    def __init__(self, interval_sec, clock: Callable[[], float] = time.time):
+        self.clock = clock  # wall-clock seconds; replaced by a virtual clock during replay
+        self.last_interval = clock()
         self.interval_sec = interval_sec
 
     @abstractmethod
     def can_schedule(self) -> bool:
         pass
 
+    def next_fire_time(self) -> float:
+        """Time on `clock` at which `can_schedule()` will next return True."""
+        return self.last_interval + self.interval_sec
+
+    def set_clock(self, clock: Callable[[], float]) -> None:
+        """Switch to another clock (ex: a replay's virtual clock) and restart the interval from its current time."""
+        self.clock = clock
+        self.last_interval = clock()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """JSON-serializable state needed to resume this scheduler after a restart."""
+        return {"last_interval": self.last_interval}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore state saved by `state_dict`."""
+        if "last_interval" in state:
+            # A clock that jumped backwards must not push the next run further out:
+            self.last_interval = min(float(state["last_interval"]), self.clock())
+
 
 # Generic sensor scheduler:
 class SensorScheduler(Scheduler):
-    def __init__(self, interval_sec=None, datetime_obj:datetime=None):
+    def __init__(self, interval_sec=None, datetime_obj:datetime=None, clock: Callable[[], float] = time.time):
         self.datetime_obj = datetime_obj
         self.already_triggered = False
+        self.triggered_date = None
         self.timeout_secs = 120
-        super().__init__(interval_sec)
+        super().__init__(interval_sec, clock=clock)
  
     def can_schedule(self) -> bool:
         if self.datetime_obj is not None:
             # Doing can_schedule with datetime rather than time.time:
-            current_datetime_obj = datetime.now()
+            current_datetime_obj = datetime.fromtimestamp(self.clock())
             dto_hour = self.datetime_obj.hour
             dto_min = self.datetime_obj.minute
             dto_sec = self.datetime_obj.second
@@ -46,27 +71,256 @@ class SensorScheduler(Scheduler):
             cdo_sec = current_datetime_obj.second
             
             if (cdo_hour == dto_hour) and (cdo_min == dto_min):
-                if self.already_triggered:
+                # The loop may not wake outside the minute between two days, so compare dates too:
+                if self.already_triggered and self.triggered_date == current_datetime_obj.date():
                     return False
                 self.already_triggered = True
+                self.triggered_date = current_datetime_obj.date()
                 return True
             else:
                 self.already_triggered = False
                 return False
         else:
-            current_time = time.time()
-            delta = current_time - self.last_interval
-            if delta >= self.interval_sec:
+            current_time = self.clock()
+            # Same expression as next_fire_time, so waking exactly at the deadline always fires:
+            if current_time >= self.last_interval + self.interval_sec:
                 self.last_interval = current_time
                 return True
             else:
                 return False
 
+    def next_fire_time(self) -> float:
+        if self.datetime_obj is None:
+            return super().next_fire_time()
+
+        # Next occurrence of the configured hour:minute that has not fired yet:
+        now = datetime.fromtimestamp(self.clock())
+        target = now.replace(hour=self.datetime_obj.hour, minute=self.datetime_obj.minute, second=0, microsecond=0)
+        fired_today = self.already_triggered and self.triggered_date == now.date()
+        if fired_today or now >= target + timedelta(minutes=1):
+            target += timedelta(days=1)
+        return max(target.timestamp(), now.timestamp())
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        state["already_triggered"] = self.already_triggered
+        state["triggered_date"] = self.triggered_date.isoformat() if self.triggered_date is not None else None
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super().load_state_dict(state)
+        self.already_triggered = state.get("already_triggered", self.already_triggered)
+        if state.get("triggered_date") is not None:
+            self.triggered_date = date.fromisoformat(state["triggered_date"])
+
+
+# Cron-style calendar:
+class CronSchedule:
+    """A five-field cron expression: `minute hour day-of-month month day-of-week`.
+
+    Each field takes `*`, a value, a range (`6-19`), a step (`*/15`, `6-19/2`)
+    or a comma-separated list of those. Days of the week run from 0 (Sunday)
+    to 6; 7 is also Sunday. As in cron, when both day fields are restricted a
+    day matches if either one does. Times are local.
+
+    Args:
+        expression (str): The cron expression (ex: `"*/15 6-19 * * *"`).
+
+    Raises:
+        ValueError: If the expression does not have five valid fields.
+
+    Example:
+        >>> schedule = CronSchedule("*/15 6-19 * * *")  # every 15 minutes from 06:00 to 19:45
+        >>> schedule.next_after(datetime(2025, 6, 1, 20, 0))
+        datetime.datetime(2025, 6, 2, 6, 0)
+    """
+
+    FIELDS = [("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7)]
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != len(self.FIELDS):
+            raise ValueError(
+                "{} is not a cron expression. Supported format: minute hour day month weekday".format(expression)
+            )
+        minutes, hours, days, months, weekdays = [
+            self._parse_field(part, name, low, high) for part, (name, low, high) in zip(parts, self.FIELDS)
+        ]
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = set(day % 7 for day in weekdays)
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, name: str, low: int, high: int) -> Set[int]:
+        values = set()
+        for item in field.split(","):
+            span, _, step = item.partition("/")
+            try:
+                step = int(step) if step else 1
+                if span == "*":
+                    start, end = low, high
+                elif "-" in span:
+                    start, end = [int(value) for value in span.split("-", 1)]
+                else:
+                    start = end = int(span)
+            except ValueError:
+                raise ValueError("{} is not a valid cron {} field".format(field, name))
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError("{} is outside the {} range {}-{}".format(field, name, low, high))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day: date) -> bool:
+        if not (day.month in self.months):
+            return False
+        day_ok = day.day in self.days
+        weekday_ok = (day.isoweekday() % 7) in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment: datetime) -> datetime:
+        """First fire instant strictly after `moment`.
+
+        Raises:
+            ValueError: If the expression never fires (ex: `0 0 31 2 *`).
+        """
+        moment = moment.replace(second=0, microsecond=0)
+        day = moment.date()
+        for _ in range(8 * 366):  # covers Feb 29th on a given weekday
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime(day.year, day.month, day.day, hour, minute)
+                        if candidate > moment:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError("{} never fires".format(self.expression))
+
+    def upcoming(self, after: float, count: int) -> List[float]:
+        """The next `count` fire instants after the Unix time `after`, as Unix times."""
+        instants = []
+        moment = datetime.fromtimestamp(after)
+        for _ in range(count):
+            moment = self.next_after(moment)
+            instants.append(moment.timestamp())
+        return instants
+
+
+# Calendar (cron) scheduler for sensors and cameras:
+class CalendarScheduler(Scheduler):
+    """Fires a sensor or camera at the instants of a cron expression.
+
+    The next `precompute` instants are worked out ahead of time, so
+    `next_fire_time` is a lookup and the main loop sleeps until the next
+    instant instead of checking the clock every second. Instants that pass
+    while the loop is busy or the greenhouse is off are handled by `catch_up`:
+
+    - `"skip"`: fire once if the latest missed instant is at most `grace_sec` old, otherwise skip them all.
+    - `"once"`: fire once for any number of missed instants.
+    - `"all"`: fire once per missed instant, back to back.
+
+    Args:
+        cron (str): Cron expression (see `CronSchedule`).
+        catch_up (str, optional): Policy for missed instants. Defaults to "skip".
+        grace_sec (float, optional): How late an instant may fire under `"skip"`. Defaults to 60.
+        precompute (int, optional): Instants computed at a time. Defaults to 32.
+        clock (Callable, optional): Time source. Defaults to `time.time`.
+
+    Raises:
+        ValueError: If the expression or the policy is invalid.
+
+    Example:
+        >>> scheduler = CalendarScheduler("*/15 6-19 * * *", catch_up="skip")
+        >>> scheduler.next_fire_time()  # the next quarter hour between 06:00 and 19:45
+        1760018400.0
+    """
+
+    CATCH_UP = ["skip", "once", "all"]
+
+    def __init__(
+        self,
+        cron: str,
+        catch_up: str = "skip",
+        grace_sec: float = 60.0,
+        precompute: int = 32,
+        clock: Callable[[], float] = time.time,
+    ):
+        if not (catch_up in self.CATCH_UP):
+            raise ValueError(
+                "{} is not a recognized catch-up policy. Supported policies: {}".format(catch_up, ", ".join(self.CATCH_UP))
+            )
+        super().__init__(None, clock=clock)
+        self.schedule = CronSchedule(cron)
+        self.catch_up = catch_up
+        self.grace_sec = grace_sec
+        self.precompute = precompute
+        self.last_fire = self.last_interval  # instants up to here have been handled
+        self.skipped = 0
+        self._upcoming: List[float] = []  # instants after `last_fire`, earliest first
+
+    def _next_instant(self) -> float:
+        if not self._upcoming:
+            self._upcoming = self.schedule.upcoming(self.last_fire, self.precompute)
+        return self._upcoming[0]
+
+    def _take_due(self, now: float) -> List[float]:
+        due = []
+        while self._next_instant() <= now:
+            due.append(self._upcoming.pop(0))
+            self.last_fire = due[-1]
+            if self.catch_up == "all":
+                break
+        return due
+
+    def can_schedule(self) -> bool:
+        now = self.clock()
+        due = self._take_due(now)
+        if not due:
+            return False
+        if self.catch_up == "skip" and now - due[-1] > self.grace_sec:
+            self.skipped += len(due)
+            logger.warning(
+                "Skipped {} missed fire times of '{}' (latest at {})".format(
+                    len(due), self.schedule.expression, datetime.fromtimestamp(due[-1])
+                )
+            )
+            return False
+        if len(due) > 1 or now - due[0] > self.grace_sec:
+            logger.info("Catching up on {} missed fire times of '{}'".format(len(due), self.schedule.expression))
+        self.last_interval = now
+        return True
+
+    def next_fire_time(self) -> float:
+        return self._next_instant()
+
+    def set_clock(self, clock: Callable[[], float]) -> None:
+        super().set_clock(clock)
+        self.last_fire = self.last_interval
+        self._upcoming = []
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        state["last_fire"] = self.last_fire
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super().load_state_dict(state)
+        if "last_fire" in state:
+            # Instants missed while the greenhouse was off are caught up according to the policy:
+            self.last_fire = min(float(state["last_fire"]), self.clock())
+            self._upcoming = []
+
 
 # Generic device scheduler:
 class DeviceScheduler(Scheduler):
-    def __init__(self, sensor_threshold=100, interval_sec=10, comparison="less", budget_struct:Optional[Dict]=None, accumulation_state:bool=True):
-        super().__init__(interval_sec)
+    def __init__(self, sensor_threshold=100, interval_sec=10, comparison="less", budget_struct:Optional[Dict]=None, accumulation_state:bool=True, clock: Callable[[], float] = time.time):
+        super().__init__(interval_sec, clock=clock)
         self.sensor_threshold = sensor_threshold
         self.comparison = comparison
         self.budget = budget_struct
@@ -88,6 +342,14 @@ class DeviceScheduler(Scheduler):
         self.last_state_change = None # Undefined last state change
         self.accumulation_state = accumulation_state
 
+        # Window open/close and the daily budget reset are precomputed as wall-clock
+        # instants, so checking them is a single comparison until the next transition:
+        self.window_open = True
+        self.next_transition = float("inf")  # next window open/close
+        self.next_midnight = 0.0  # next budget reset
+        self.closed_applied = False  # the "off" decision for the current closed window was made
+        self._refresh(self.clock())
+
         if self.comparison == "less":
             self.op = operator.lt
         elif self.comparison == "greater":
@@ -102,27 +364,50 @@ class DeviceScheduler(Scheduler):
             )
 
     def can_schedule(self) -> bool:
-        current_time = time.time()
-        delta = current_time - self.last_interval
-        if delta >= self.interval_sec:
+        current_time = self.clock()
+        if current_time >= self.last_interval + self.interval_sec:
             self.last_interval = current_time
             return True
         else:
             return False
 
+    def set_clock(self, clock: Callable[[], float]) -> None:
+        super().set_clock(clock)
+        self.window_open = True
+        self.next_transition = float("inf")
+        self.next_midnight = 0.0
+        self.closed_applied = False
+        self._refresh(self.clock())
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        state["current_budget"] = self.current_budget
+        state["budget_date"] = datetime.fromtimestamp(self.clock()).date().isoformat()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super().load_state_dict(state)
+        # The budget is daily; one saved on an earlier day has already been reset:
+        if state.get("budget_date") == datetime.fromtimestamp(self.clock()).date().isoformat():
+            self.current_budget = state.get("current_budget", self.current_budget)
+
     def change(self, sensor_input: float) -> bool:
         # sensor conditions:
-        current_timestamp = datetime.now()
-        can_run = True
-        if self.budget_start is not None:
-            if not self.in_timerange(self.budget_start, self.budget_end, current_timestamp):
-                can_run = False
-                logger.warning("Scheduler's change function is not in time range: {}".format(self.budget_start.time(), self.budget_end.time()))
-                
-        if self.op(self.sensor_threshold, sensor_input) and self.budget_sec >= self.current_budget and can_run:
-            return True
-        else:
+        return self.decide(self.op(self.sensor_threshold, sensor_input))
+
+    def decide(self, condition: bool) -> bool:
+        """New instrument state for an already evaluated sensor condition (ex: from a RuleEngine).
+
+        The condition only turns the instrument on while the time window allows it
+        and budget is left.
+        """
+        now = self.clock()
+        if now >= self.next_transition or now >= self.next_midnight:
+            self._refresh(now)
+        if not self.window_open:
+            self.closed_applied = True
             return False
+        return bool(condition) and self.budget_sec >= self.current_budget
 
     def in_timerange(self, start: datetime, end: datetime, check: datetime) -> bool:
         """Return True if check's time is within [start, end], ignoring date."""
@@ -131,25 +416,63 @@ class DeviceScheduler(Scheduler):
             return s <= c <= e
         else:       # Range crosses midnight
             return c >= s or c <= e
-    
+
+    def _refresh(self, now: float) -> None:
+        """Recompute the window state, the next window transition and the next budget reset."""
+        current = datetime.fromtimestamp(now)
+        if now >= self.next_midnight:
+            if self.next_midnight > 0.0:
+                logger.info("New day detected; reset budget")
+                self.current_budget = 0
+            midnight = datetime.combine(current.date() + timedelta(days=1), datetime.min.time())
+            self.next_midnight = midnight.timestamp()
+
+        if self.budget_start is None:
+            return
+
+        # Open/close instants from yesterday to tomorrow; the window is [start, end):
+        transitions = []
+        for day in [current.date() + timedelta(days=k) for k in (-1, 0, 1)]:
+            transitions.append((datetime.combine(day, self.budget_start.time()).timestamp(), True))
+            transitions.append((datetime.combine(day, self.budget_end.time()).timestamp(), False))
+        transitions.sort()
+        window_open = [state for instant, state in transitions if instant <= now][-1]
+        self.next_transition = min(instant for instant, _ in transitions if instant > now)
+
+        if window_open != self.window_open:
+            logger.info(
+                "Scheduler time window {} ({} - {})".format(
+                    "opened" if window_open else "closed", self.budget_start.time(), self.budget_end.time()
+                )
+            )
+            self.closed_applied = False
+        self.window_open = window_open
+
+    @property
+    def parked(self) -> bool:
+        """True while the window is closed and the instrument has already been switched off for it."""
+        now = self.clock()
+        if now >= self.next_transition:
+            self._refresh(now)
+        return not self.window_open and self.closed_applied
+
+    def next_fire_time(self) -> float:
+        # A parked instrument has nothing to do until its window opens again:
+        if self.parked:
+            return max(super().next_fire_time(), self.next_transition)
+        return super().next_fire_time()
+
     def update_budget(self, state, sensor_timestamp:datetime) -> None:
-        current_timestamp = datetime.now()
-        if current_timestamp.day != sensor_timestamp.day:
-            logger.info("New day detected; reset budget and skip this iteration")
-            self.current_budget = 0
+        now = self.clock()
+        if now >= self.next_transition or now >= self.next_midnight:
+            self._refresh(now)
+        if not self.window_open:
             return None
 
-        can_run = True
-        if self.budget_start is not None:
-            if not self.in_timerange(self.budget_start, self.budget_end, current_timestamp):
-                can_run = False
-                logger.warning("Scheduler update_budget is not in time range: {}".format(self.budget_start.time(), self.budget_end.time()))
-
-        if can_run:
-            self.current_budget += self.interval_sec
-        
-        if self.accumulation_state == state and can_run:
-            minute_duration = current_timestamp-sensor_timestamp
+        self.current_budget += self.interval_sec
+
+        if self.accumulation_state == state:
+            minute_duration = datetime.fromtimestamp(now) - sensor_timestamp
             self.current_budget += minute_duration.seconds
             logger.info("Current budget: {} | Budget: {}".format(self.current_budget, self.budget))
             return None
@@ -162,3 +485,89 @@ class DeviceScheduler(Scheduler):
         next_date_poll = dt.strftime("%-I:%M:%S %p %-m/%-d/%Y")
         delta = (current_time-next_date_poll)
         return delta.seconds
+
+
+# Deadline-driven timer:
+class TimerHeap:
+    """Orders schedulers by their next fire time so the main loop can sleep until the earliest one.
+
+    Each job is a scheduler under a hashable key. `sleep()` blocks until the
+    earliest deadline (never longer than `max_sleep_sec`, so periodic work such
+    as the database heartbeat still runs), `pop_due()` hands back the jobs whose
+    deadline has passed, and `push()` schedules a job again from its
+    `next_fire_time()`. Pushing a key that is already queued replaces its deadline.
+    How late each job is popped after its deadline is recorded as
+    `lateness.<key>` (tuple keys are joined with "/").
+
+    Args:
+        max_sleep_sec (float, optional): Longest single sleep in seconds. Defaults to 10.
+
+    Example:
+        >>> timers = TimerHeap(max_sleep_sec=10)
+        >>> timers.push("temperature_sensor_1", SensorScheduler(interval_sec=10))
+        >>> while True:
+        ...     timers.sleep()
+        ...     for key, scheduler in timers.pop_due():
+        ...         if scheduler.can_schedule():
+        ...             ...
+        ...         timers.push(key, scheduler)
+    """
+
+    def __init__(self, max_sleep_sec: float = 10.0):
+        self.max_sleep_sec = max_sleep_sec
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._jobs: Dict[Hashable, Tuple[float, Scheduler]] = {}
+        self._counter = itertools.count()  # tie-breaker so keys are never compared
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def push(self, key: Hashable, scheduler: Scheduler, deadline: Optional[float] = None) -> None:
+        """Queue `scheduler` under `key` at `deadline` (defaults to its next fire time)."""
+        if deadline is None:
+            deadline = scheduler.next_fire_time()
+        self._jobs[key] = (deadline, scheduler)
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+    def remove(self, key: Hashable) -> None:
+        """Stop scheduling `key`; its heap entry is dropped lazily."""
+        self._jobs.pop(key, None)
+
+    def _discard_stale(self) -> None:
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            job = self._jobs.get(key)
+            if job is not None and job[0] == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> Optional[float]:
+        """Earliest queued deadline, or None if nothing is queued."""
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def sleep(self) -> float:
+        """Sleep until the earliest deadline or for `max_sleep_sec`, whichever comes first.
+
+        Returns:
+            float: Seconds slept.
+        """
+        deadline = self.next_deadline()
+        delay = self.max_sleep_sec
+        if deadline is not None:
+            delay = min(delay, deadline - time.time())
+        if delay > 0:
+            time.sleep(delay)
+        return max(delay, 0.0)
+
+    def pop_due(self, now: Optional[float] = None) -> List[Tuple[Hashable, Scheduler]]:
+        """Remove and return every job whose deadline is at or before `now`, earliest first."""
+        now = time.time() if now is None else now
+        due = []
+        while self.next_deadline() is not None and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            due.append((key, self._jobs.pop(key)[1]))
+            if metrics.enabled:
+                name = "/".join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+                metrics.observe("lateness.{}".format(name), now - deadline)
+        return due